@@ -2,7 +2,8 @@ import argparse
 import json
 import sys
 
-from .config import build_provider_from_file
+from .config import build_provider_from_file, load_config
+from .environment import load_environment, build_plan, get_changes, print_plan, apply_plan
 from .constants import DEBIAN_VERSIONS
 from .exceptions import UserError
 from .minions import (
@@ -10,9 +11,11 @@ from .minions import (
     destroy_minion,
 )
 from .master import create_master
-from .providers import provider_map
-from .roles import get_minion_arguments_for_role, get_provider_for_role
-from .utils import log_error, log_warning
+from .providers import provider_map, wait_for_ssh_key_cleanup
+from .roles import compile_roles, get_minion_arguments_for_role, get_provider_for_role
+from .scripts import run_script
+from .ssh import configure_ssh_algorithms
+from .utils import log_error, log_warning, set_verbose
 from .version import __version__
 
 
@@ -20,10 +23,20 @@ def main(argv=None):
     try:
         cli = HartCLI()
         args = cli.get_args(argv)
+        set_verbose(args.verbose)
+        # Not passed on to the actions
+        del args.verbose
+        # Loaded once here and shared with the actions that use the config
+        cli.config = load_config(args.config)
+        configure_ssh_algorithms(**cli.config.get('ssh', {}))
         args.action(args)
     except UserError as error:
         log_error(str(error))
         sys.exit(1)
+    finally:
+        # Some providers delete the temporary ssh keys in the background
+        if not wait_for_ssh_key_cleanup():
+            sys.exit(1)
 
 
 class DefaultArgumentString(str):
@@ -33,7 +46,11 @@ class DefaultArgumentString(str):
 
 
 class HartCLI:
+    # Commands that only work on the config file and thus doesn't need a provider
+    provider_independent_commands = ('roles', 'plan', 'apply', 'run-script')
+
     def __init__(self):
+        self.config = None
         if sys.getfilesystemencoding() == 'ascii':
             raise UserError('Your system has incorrect locale settings, '
                 'leading to non-unicode default IO. Set f. ex '
@@ -53,6 +70,8 @@ class HartCLI:
         # Explicitly add help to be able to parse the provider before printing the help
         parser.add_argument('-h', '--help', action='store_true', help='Print help')
         parser.add_argument('-v', '--version', action='version', version='hart v%s' % __version__)
+        parser.add_argument('--verbose', action='store_true',
+            help='Print the full init log from new nodes, not just the steps')
 
         subparsers = parser.add_subparsers(dest='command',
             title='Commands',
@@ -64,6 +83,10 @@ class HartCLI:
         destroy_minion_parser = self.add_destroy_minion_parser(subparsers)
         list_regions_parser = self.add_list_regions_parser(subparsers)
         list_sizes_parser = self.add_list_sizes_parser(subparsers)
+        self.add_roles_parser(subparsers)
+        self.add_plan_parser(subparsers)
+        self.add_apply_parser(subparsers)
+        self.add_run_script_parser(subparsers)
 
         # Do an initial parse of just the provider arguments, to be able to add
         # provider-specific arguments to the full parse. If a provider is given
@@ -80,6 +103,8 @@ class HartCLI:
             elif provider_args.command == 'create-minion-from-role':
                 provider = get_provider_for_role(
                     provider_args.config, provider_args.role, provider_args.region)
+            elif provider_args.command in self.provider_independent_commands:
+                pass
             else:
                 raise UserError('No provider specified')
 
@@ -96,13 +121,14 @@ class HartCLI:
                 sys.exit(0)
             raise
 
-        # Add the same arguments to create-minion-from-role as create-minion
-        provider.add_create_minion_arguments(create_minion_from_role_parser)
-        provider.add_create_minion_arguments(create_minion_parser)
-        provider.add_create_minion_arguments(create_master_parser)
-        provider.add_destroy_minion_arguments(destroy_minion_parser)
-        provider.add_list_regions_arguments(list_regions_parser)
-        provider.add_list_sizes_arguments(list_sizes_parser)
+        if provider is not None:
+            # Add the same arguments to create-minion-from-role as create-minion
+            provider.add_create_minion_arguments(create_minion_from_role_parser)
+            provider.add_create_minion_arguments(create_minion_parser)
+            provider.add_create_minion_arguments(create_master_parser)
+            provider.add_destroy_minion_arguments(destroy_minion_parser)
+            provider.add_list_regions_arguments(list_regions_parser)
+            provider.add_list_sizes_arguments(list_sizes_parser)
 
         args = parser.parse_args(argv)
         args.provider = provider
@@ -138,14 +164,19 @@ class HartCLI:
         parser = subparsers.add_parser('create-master', help='Create a new saltmaster')
         parser.add_argument('minion_id')
         self._add_minion_master_role_shared_arguments(parser)
+        self._add_master_arguments(parser)
+        parser.set_defaults(action=self.cli_create_master)
+        return parser
 
+
+    def _add_master_arguments(self, parser): # pylint: disable=no-self-use
         parser.add_argument('-a', '--authorize-key',
             help='An ssh public key to add to .ssh/authorized_keys.')
         parser.add_argument('-g', '--grains', type=type_json,
             help="Grains to write to /etc/salt/minion.d/grains.conf")
-
-        parser.set_defaults(action=self.cli_create_master)
-        return parser
+        parser.add_argument('--apt-cache', action='store_true',
+            help='Run an apt-cacher-ng proxy on the master for the minions to '
+            'download packages through. It only listens on the private network.')
 
 
     def _add_minion_master_role_shared_arguments(self, parser): # pylint disable=no-self-use
@@ -170,6 +201,15 @@ class HartCLI:
             help='The salt version to install and pin. Default installs latest without any pin.')
         parser.add_argument('--minion-config', type=type_json,
             help='Minion config in JSON')
+        parser.add_argument('--defer-security-updates', action='store_true',
+            help='Apply security updates in the background after the node is '
+            'ready instead of before installing salt.')
+        parser.add_argument('--apt-proxy',
+            help='URL of a http proxy to download packages through, like '
+            'http://salt.example.com:3142.')
+        parser.add_argument('--apt-proxy-https', action='store_true',
+            help='Fetch the https salt repo through the apt proxy too, using the '
+            'http://HTTPS/// syntax only supported by apt-cacher-ng.')
 
 
     def add_destroy_minion_parser(self, subparsers):
@@ -196,6 +236,65 @@ class HartCLI:
         return parser
 
 
+    def add_roles_parser(self, subparsers):
+        parser = subparsers.add_parser('roles', help='Inspect the roles defined in the config')
+        roles_subparsers = parser.add_subparsers(dest='roles_command', title='Role commands')
+
+        show_parser = roles_subparsers.add_parser('show',
+            help='Show the merged parameters for roles in each provider and region')
+        show_parser.add_argument('role', nargs='?', help='Name of the role')
+        show_parser.add_argument('-a', '--all', action='store_true',
+            help='Show all roles defined in the config')
+        show_parser.set_defaults(action=self.cli_show_roles)
+        return parser
+
+
+    def add_plan_parser(self, subparsers):
+        parser = subparsers.add_parser('plan',
+            help='Show the nodes that would be created and destroyed to match an environment spec')
+        parser.add_argument('spec', help='Path to the environment spec')
+        parser.set_defaults(action=self.cli_plan)
+        return parser
+
+
+    def add_apply_parser(self, subparsers):
+        parser = subparsers.add_parser('apply',
+            help='Create and destroy nodes in parallel to match an environment spec')
+        parser.add_argument('spec', help='Path to the environment spec')
+        parser.add_argument('--max-workers', type=int, default=20,
+            help='How many nodes to create or destroy at the same time across '
+            'all providers. Default: %(default)s')
+        parser.add_argument('-y', '--yes', action='store_true',
+            help="Don't ask for confirmation before destroying nodes")
+        parser.set_defaults(action=self.cli_apply)
+        return parser
+
+
+    def add_run_script_parser(self, subparsers):
+        parser = subparsers.add_parser('run-script',
+            help='Run a script on existing minions in parallel over ssh')
+        parser.add_argument('script', help='Path to the script to run')
+        parser.add_argument('--role',
+            help='Run the script on the minions created from this role')
+        parser.add_argument('--target',
+            help='Run the script on the minions matching this salt compound target')
+        parser.add_argument('--max-workers', type=int, default=10,
+            help='How many minions to run the script on at the same time. '
+            'Default: %(default)s')
+        parser.set_defaults(action=self.cli_run_script)
+        return parser
+
+
+    def get_create_defaults(self, provider, master=False):
+        '''Get the default arguments the cli would use to create a node with the provider.'''
+        parser = argparse.ArgumentParser(add_help=False, conflict_handler='resolve')
+        self._add_minion_master_role_shared_arguments(parser)
+        if master:
+            self._add_master_arguments(parser)
+        provider.add_create_minion_arguments(parser)
+        return vars(parser.parse_args([]))
+
+
     def create_cli_create_minion_from_role(self, parser):
         def cli_create_minion_from_role(args):
             cli_kwargs = {}
@@ -258,6 +357,67 @@ class HartCLI:
             print('%s (%s)' % (location.name, location.id))
 
 
+    def cli_show_roles(self, args):
+        if not args.all and not args.role:
+            raise UserError('Specify a role to show, or --all to show all of them')
+
+        index = compile_roles(self.config)
+        index.validate()
+        if args.role and args.role not in index.roles:
+            # Let the index give a helpful error message
+            index.get(args.role)
+
+        for compiled_role in index.targets(None if args.all else args.role):
+            print('%s (%s, %s)' % (compiled_role.role, compiled_role.provider,
+                compiled_role.region or 'region from --region'))
+            for key, val in sorted(compiled_role.parameters.items()):
+                print('  %s = %s' % (key, json.dumps(val, sort_keys=True)))
+
+
+    def cli_plan(self, args):
+        environment = load_environment(args.spec)
+        plan = build_plan(environment, self.config, self.get_create_defaults, warn=False)
+        print_plan(plan)
+
+
+    def cli_apply(self, args):
+        environment = load_environment(args.spec)
+        plan = build_plan(environment, self.config, self.get_create_defaults)
+        print_plan(plan)
+        if not get_changes(plan):
+            return
+
+        if not args.yes and any(p.kind == 'destroy' for p in plan):
+            should_continue = input('Some nodes will be destroyed, continue? [y/N]')
+            if should_continue != 'y':
+                print('Aborting')
+                return
+
+        try:
+            results = apply_plan(plan, environment.limits, args.max_workers)
+        except KeyboardInterrupt:
+            print('Aborted by Ctrl-C or SIGINT, stopping')
+            sys.exit(1)
+
+        if any(result.error is not None for result in results.values()):
+            sys.exit(1)
+
+
+    def cli_run_script(self, args):
+        if not args.role and not args.target:
+            raise UserError('Specify the minions to run the script on with --role or --target')
+
+        try:
+            results = run_script(self.config, args.script, args.role,
+                args.target, args.max_workers)
+        except KeyboardInterrupt:
+            print('Aborted by Ctrl-C or SIGINT, stopping')
+            sys.exit(1)
+
+        if any(result.error is not None for result in results.values()):
+            sys.exit(1)
+
+
 def type_json(value):
     return json.loads(value)
 
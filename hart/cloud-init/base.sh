@@ -1,13 +1,56 @@
 set -euo nounset -o noclobber
 
+# Write the progress to a status file hart polls to know when the node is ready,
+# one line per step, ending with either 'done' or 'failed <details>'
+mkdir -p /run/hart
+hart_step=start
+hart_status () {
+    echo "$@" >> /run/hart/status
+}
+step () {
+    hart_step=$1
+    hart_status step "$1"
+}
+hart_exit () {
+    if [ "$1" -eq 0 ]; then
+        hart_status done
+{%- if defer_security_updates %}
+        systemd-run \
+            --no-block \
+            --unit=hart-security-updates \
+            --setenv=DEBIAN_FRONTEND=noninteractive \
+            apt-get --assume-yes \
+                -o Dpkg::Options::="--force-confdef" \
+                -o Dpkg::Options::="--force-confold" \
+                $security_sources upgrade
+{%- endif %}
+    else
+        hart_status failed "$hart_step exited with $1"
+    fi
+}
+trap 'hart_exit $?' EXIT
+
 # Help seed the random pool to make sure any parallel process that might
 # generate keys or do TLS has random data to pull from.
 echo '{{ random_seed }}' > /dev/random
 
+{% if minion_id_script %}
+step minion-id
+{% include minion_id_script %}
+
+# Deploy the ssh-canary as one of the first thing to ensure we can connect and
+# verify quickly. The same script is used for all nodes in a batch, thus include
+# the minion id to make the canary unique per node. The secret part is shared by
+# the nodes in the batch, thus this only tells them apart from nodes outside the
+# batch, not from each other.
+echo '{{ ssh_canary }}' "$minion_id" > /tmp/ssh-canary
+{% else %}
 # Deploy the ssh-canary as one of the first thing to ensure we can connect and
 # verify quickly
 echo '{{ ssh_canary }}' > /tmp/ssh-canary
+{% endif %}
 
+step configure
 {% if permit_root_ssh %}
 # Some providers (hey google) default to 'PermitRootLogin no' in the ssh config,
 # preventing us from being able to connect. Fix this.
@@ -25,6 +68,12 @@ iptables -A INPUT -m conntrack --ctstate ESTABLISHED -j ACCEPT
 printf '// Added by hart cloud-init\nAcquire::Languages "none";\n' \
     > /etc/apt/apt.conf.d/99hart-translations
 
+{% if apt_proxy -%}
+# Download packages through the caching proxy
+printf '// Added by hart cloud-init\nAcquire::http::Proxy "{{ apt_proxy }}";\n' \
+    > /etc/apt/apt.conf.d/99hart-proxy
+{% endif %}
+
 # Make sure apt doesn't prompt for anything
 apt_get_noninteractive () {
     export DEBIAN_FRONTEND=noninteractive
@@ -36,6 +85,7 @@ apt_get_noninteractive () {
 }
 
 {% if wait_for_apt %}
+step wait-for-apt
 # On some providers (notably, Vultr) there will be a apt-daily systemd service
 # that will start when the node boots, causing concurrent access problems for
 # this script. Thus wait until other instances are done before continuing, but
@@ -46,14 +96,11 @@ systemd-run \
     --wait /bin/true
 {% endif %}
 
-# Update the repo to get updated keys and archives, then install https transport
-# for apt before adding the salt repo using https, and gnupg for apt-key
-apt-get update
-apt_get_noninteractive install apt-transport-https gnupg
-
-cat <<EOF | gpg --dearmor > /usr/share/keyrings/salt-archive-keyring-2023.gpg
------BEGIN PGP PUBLIC KEY BLOCK-----
-
+step add-salt-repo
+# Add the salt repo with the key already dearmored to not need gnupg. apt
+# supports https by itself, thus everything can be installed after a single
+# update.
+base64 --decode > /usr/share/keyrings/salt-archive-keyring-2023.gpg <<EOF
 mQGNBGPazmABDAC6qc2st6/Uh/5AL325OB5+Z1XMFM2HhQNjB/VcYbLvcCx9AXsU
 eaEmNPm6OY3p5+j8omjpXPYSU7DUQ0lIutuAtwkDMROH7uH/r9IY7iu88S6w3q89
 bgbnqhu4mrSik2RNH2NqEiJkylz5rwj4F387y+UGH3aXIGryr+Lux9WxfqoRRX7J
@@ -91,12 +138,17 @@ DE501hwQsMH7WuvlIR8Oc2UGkEtzgukhmhpQPSsVPg54y9US+LkpztM+yq+zRu33
 gAfssli0MvSmkbcTDD22PGbgPMseyYxfw7vuwmjdqvi9Z4jdln2gyZ6sSZdgUMYW
 PGEjZDoMzsZx9Zx6SO9XCS7XgYHVc8/B2LGSxj+rpZ6lBbywH88lNnrm/SpQB74U
 4QVLffuw76FanTH6advqdWIqtlWPoAQcEkKf5CdmfT2ei2wX1QLatTs=
-=ZKPF
------END PGP PUBLIC KEY BLOCK-----
 EOF
 
 # Add the salt debian repo
-echo 'deb [signed-by=/usr/share/keyrings/salt-archive-keyring-2023.gpg] https://packages.broadcom.com/artifactory/saltproject-deb/ stable main' > /etc/apt/sources.list.d/saltstack.list
+{% if apt_proxy and apt_proxy_https -%}
+# The proxy can't cache https, thus let it fetch the repo over https instead
+# (the apt-cacher-ng syntax)
+salt_repo=http://HTTPS///packages.broadcom.com/artifactory/saltproject-deb/
+{% else -%}
+salt_repo=https://packages.broadcom.com/artifactory/saltproject-deb/
+{% endif -%}
+echo "deb [signed-by=/usr/share/keyrings/salt-archive-keyring-2023.gpg] $salt_repo stable main" > /etc/apt/sources.list.d/saltstack.list
 
 {% if salt_version -%}
 # Set a package pin for the desired salt version
@@ -107,17 +159,22 @@ Pin-Priority: 1001
 EOF
 {% endif %}
 
-apply_security_updates () {
-    local apt_security_parts
-    apt_security_parts=$(mktemp -d)
+apt-get update
+
+# Copy the sources that contain security updates to a separate directory, to be
+# able to apply only the security updates by passing these options to apt-get
+apt_security_parts=/run/hart/apt-security
+security_sources="-o Dir::Etc::SourceList=- -o Dir::Etc::SourceParts=$apt_security_parts"
+prepare_security_sources () {
+    mkdir -p "$apt_security_parts"
 
     # Extract sourcelists in oneline format that contain "security"
-    grep --ignore-case \
+    { grep --ignore-case \
         --recursive \
         --no-filename \
         --include="*.list" \
         security \
-        /etc/apt/sources.list /etc/apt/sources.list.d || true \
+        /etc/apt/sources.list /etc/apt/sources.list.d || true; } \
         > "$apt_security_parts/security.list"
 
     # Find deb822-style sourcelists and split the entries into parts by empty
@@ -139,14 +196,34 @@ apply_security_updates () {
         --null \
         security "$apt_security_parts" \
         | xargs --null --no-run-if-empty rm
-
-    apt_get_noninteractive upgrade \
-        -o Dir::Etc::SourceList="-" \
-        -o Dir::Etc::SourceParts="$apt_security_parts"
-    rm -rf "$apt_security_parts"
 }
 
-# Update the repo and apply all security updates. If people want to upgrade
-# other packages they can do so from salt.
-apt-get update
-apply_security_updates
+step security-updates
+# Apply all security updates. If people want to upgrade other packages they can
+# do so from salt.
+prepare_security_sources
+{% if defer_security_updates %}
+# The updates are applied in the background when the init script is done, make
+# apt wait for the lock instead of failing if salt installs packages meanwhile
+printf '// Added by hart cloud-init\nDPkg::Lock::Timeout "600";\n' \
+    > /etc/apt/apt.conf.d/99hart-lock-timeout
+security_updates=
+{% else %}
+# Find the packages with security updates as package=version, to upgrade them in
+# the same apt transaction as the other packages are installed
+security_updates=$(apt-get --simulate upgrade $security_sources \
+    | awk '/^Inst [^ ]+ \[/ { print $2 "=" substr($4, 2) }')
+{% endif %}
+
+# Install the given packages together with the security updates. Installing a
+# package marks it as manually installed, thus restore the mark for the updated
+# packages that were installed automatically.
+apt_get_install () {
+    local auto_installed
+    auto_installed=$(echo "$security_updates" | sed 's/=.*//' \
+        | xargs --no-run-if-empty apt-mark showauto)
+    apt_get_noninteractive install "$@" $security_updates
+    if [ -n "$auto_installed" ]; then
+        apt-mark auto $auto_installed
+    fi
+}
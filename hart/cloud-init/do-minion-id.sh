@@ -0,0 +1,4 @@
+# The node was created in a batch with the same user data for all nodes, the
+# droplet name is the minion id
+minion_id=$(curl --silent --fail --retry 5 --retry-connrefused \
+    http://169.254.169.254/metadata/v1/hostname)
@@ -0,0 +1,17 @@
+# The node was created in a batch with the same user data for all nodes, read
+# the minion id from the Name tag, which is set right after launch
+imds_token=$(curl --silent --fail --retry 5 --retry-connrefused --request PUT \
+    --header 'X-aws-ec2-metadata-token-ttl-seconds: 600' \
+    http://169.254.169.254/latest/api/token)
+attempts=0
+until minion_id=$(curl --silent --fail \
+        --header "X-aws-ec2-metadata-token: $imds_token" \
+        http://169.254.169.254/latest/meta-data/tags/instance/Name); do
+    attempts=$((attempts + 1))
+    if [ "$attempts" -ge 120 ]; then
+        echo 'The minion id was not tagged, is access to tags in the instance metadata enabled?'
+        exit 1
+    fi
+    echo 'Waiting for the minion id to be tagged'
+    sleep 1
+done
@@ -0,0 +1,5 @@
+# The node was created in a batch with the same startup script for all nodes,
+# the minion id is in the instance description
+minion_id=$(curl --silent --fail --retry 5 --retry-connrefused \
+    --header 'Metadata-Flavor: Google' \
+    http://metadata.google.internal/computeMetadata/v1/instance/description)
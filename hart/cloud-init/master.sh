@@ -4,6 +4,7 @@
 
 {% include 'base.sh' %}
 
+step configure-master
 # Create a dedicated user for saltstack since they don't do it by default
 # Ref. https://github.com/saltstack/salt/issues/38871
 {% if add_user %}
@@ -19,8 +20,17 @@ cat > /etc/salt/minion <<EOF
 {{ minion_config }}
 EOF
 
-# Install the core packages needed
-apt_get_noninteractive install salt-master salt-minion
+step install-salt
+{% if apt_cache -%}
+# Only let apt-cacher-ng listen on localhost until hart binds it to the private
+# network, to never expose it on the public IP
+mkdir -p /etc/apt-cacher-ng
+echo 'BindAddress: localhost' >| /etc/apt-cacher-ng/zz_hart.conf
+
+{% endif -%}
+# Install the core packages needed, and apt-cacher-ng to cache the packages the
+# minions download if requested
+apt_get_install salt-master salt-minion python3 python3-venv{% if apt_cache %} apt-cacher-ng{% endif %}
 
 # Salt versions 3006.{8,9} and 3007.{0,1} has a bug where there's a warning
 # always logged from this module, just remove it to prevent this.
@@ -39,8 +49,8 @@ cat > /etc/salt/minion.d/grains.conf <<EOF
 EOF
 {% endif %}
 
+step install-hart
 # Install hart
-apt_get_noninteractive install python3 python3-venv
 python3 -m venv /opt/hart-venv
 /opt/hart-venv/bin/pip install -U pip setuptools wheel
 /opt/hart-venv/bin/pip install hart
@@ -4,6 +4,7 @@
 
 {% include 'base.sh' %}
 
+step configure-minion
 # Add a trust root for the salt master to prevent MitM on bootstrap
 mkdir -p /etc/salt/pki/minion
 cat > /etc/salt/pki/minion/minion_master.pub <<EOF
@@ -15,6 +16,9 @@ cat > /etc/salt/minion <<EOF
 ################################
 
 {{ minion_config }}
+{%- if minion_id_script %}
+id: $minion_id
+{% endif %}
 EOF
 
 # Manually create the minion key so that it's available immediately when this script
@@ -25,8 +29,32 @@ openssl genrsa -out /etc/salt/pki/minion/minion.pem 2048
 umask "$old_umask"
 openssl rsa -in /etc/salt/pki/minion/minion.pem -pubout -out /etc/salt/pki/minion/minion.pub
 
-# Install the core packages needed
-apt_get_noninteractive install salt-minion
+step install-salt
+# Install the core packages needed. Don't let the package start salt-minion
+# since the key isn't trusted by the master yet, hart starts it once the key is
+# trusted. Other services are started as usual. Any existing policy is kept
+# and restored afterwards, also if the install fails.
+restore_policy_rc_d () {
+    rm -f /usr/sbin/policy-rc.d
+    if [ -e /run/hart/policy-rc.d ]; then
+        mv /run/hart/policy-rc.d /usr/sbin/policy-rc.d
+    fi
+}
+trap 'exit_code=$?; restore_policy_rc_d; hart_exit $exit_code' EXIT
+if [ -e /usr/sbin/policy-rc.d ]; then
+    mv /usr/sbin/policy-rc.d /run/hart/policy-rc.d
+fi
+cat >| /usr/sbin/policy-rc.d <<EOF
+#!/bin/sh
+case "\$1" in
+    salt-minion|salt-minion.service) exit 101;;
+esac
+exit 0
+EOF
+chmod 755 /usr/sbin/policy-rc.d
+apt_get_install salt-minion
+restore_policy_rc_d
+trap 'hart_exit $?' EXIT
 
 # Salt versions 3006.{8,9} and 3007.{0,1} has a bug where there's a warning
 # always logged from this module, just remove it to prevent this.
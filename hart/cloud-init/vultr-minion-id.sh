@@ -0,0 +1,4 @@
+# The node was created in a batch with the same startup script for all nodes,
+# the hostname set on creation is the minion id
+minion_id=$(curl --silent --fail --retry 5 --retry-connrefused \
+    http://169.254.169.254/latest/meta-data/hostname)
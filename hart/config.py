@@ -10,10 +10,24 @@ def build_provider_from_file(provider_alias, config_file='~/.hartrc', **kwargs):
     return build_provider_from_config(provider_alias, config, **kwargs)
 
 
+# Provider config that applies to all providers and thus isn't passed to the
+# provider constructor
+THROTTLING_OPTIONS = ('requests_per_second', 'request_burst', 'max_retries')
+
+
 def build_provider_from_config(provider_alias, config, **kwargs):
     constructor = provider_map[provider_alias]
-    provider_config = config['providers'][provider_alias]
-    return constructor(**provider_config, **kwargs)
+    provider_config = dict(config['providers'][provider_alias])
+    throttling_config = {}
+    for option in THROTTLING_OPTIONS:
+        if option in provider_config:
+            throttling_config[option] = provider_config.pop(option)
+    ssh_key_pool_size = provider_config.pop('ssh_key_pool_size', 0)
+    provider = constructor(**provider_config, **kwargs)
+    provider.configure_throttling(**throttling_config)
+    if ssh_key_pool_size:
+        provider.configure_ssh_key_pool(ssh_key_pool_size)
+    return provider
 
 
 def load_config(config_file):
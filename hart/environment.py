@@ -0,0 +1,262 @@
+import functools
+from collections import namedtuple
+
+from .config import load_config, build_provider_from_config
+from .exceptions import UserError
+from .master import create_master
+from .minions import (confirm_overwrite, create_minion, create_minions, destroy_minion,
+    destroy_minions, find_existing_minions)
+from .roles import compile_roles, build_minion_arguments
+from .scheduler import Scheduler, TaskResult
+from .utils import log_error
+
+# How many nodes to create in parallel with a single provider if not overridden
+# in the environment spec
+DEFAULT_PROVIDER_CONCURRENCY = 5
+
+Environment = namedtuple('Environment', 'master roles limits')
+RoleSpec = namedtuple('RoleSpec', 'role count overrides')
+PlannedNode = namedtuple('PlannedNode', 'kind minion_id provider arguments')
+
+
+def load_environment(spec_file):
+    '''
+    Load an environment spec, which looks like this:
+
+        [master]
+        minion_id = "salt.example.com"
+        provider = "do"
+        region = "sfo3"
+
+        [roles.app]
+        count = 3
+
+        [roles.db]
+        count = 1
+        size = "s-4vcpu-8gb"
+
+        [limits.do]
+        concurrency = 5
+        creates_per_minute = 30
+
+    The roles must be defined in the hart config, any other keys than count for
+    a role overrides the role config the same way as arguments on the cli.
+    '''
+    return parse_environment(load_config(spec_file))
+
+
+def parse_environment(spec):
+    master = spec.get('master')
+    if master is not None:
+        for key in ('minion_id', 'provider'):
+            if key not in master:
+                raise UserError('The master in the environment spec must have a %s' % key)
+
+    roles = []
+    for role, role_spec in spec.get('roles', {}).items():
+        overrides = dict(role_spec)
+        count = overrides.pop('count', 1)
+        if not isinstance(count, int) or count < 0:
+            raise UserError('Invalid count for role %r: %r' % (role, count))
+        roles.append(RoleSpec(role, count, overrides))
+
+    limits = spec.get('limits', {})
+    return Environment(master, roles, limits)
+
+
+def build_plan(environment, config, get_default_arguments, warn=True):
+    '''
+    Compute the nodes to create and destroy to make the running nodes match the
+    environment.
+
+    The nodes in each provider are listed once, and matched to the roles in the
+    environment by the role marker set when they were created. Roles that are
+    not in the environment are left alone.
+
+    :param get_default_arguments: Callable taking a provider and a bool whether
+        the node is a master, returning the default arguments to create the node
+        (ie the defaults from the cli).
+    :param warn: Whether to warn about nodes to create that can't be marked
+        with their role, turn off when the plan is only shown.
+    '''
+    index = compile_roles(config)
+    index.validate()
+    get_provider = functools.lru_cache(maxsize=None)(
+        lambda alias, region: build_provider_from_config(alias, config, region=region))
+    list_nodes = functools.lru_cache(maxsize=None)(lambda provider: provider.list_nodes())
+
+    plan = []
+    if environment.master:
+        master_arguments = dict(environment.master)
+        provider = get_provider(master_arguments.pop('provider'), master_arguments.get('region'))
+        minion_id = master_arguments['minion_id']
+        if any(node.minion_id == minion_id for node in list_nodes(provider)):
+            plan.append(PlannedNode('existing', minion_id, provider, {}))
+        else:
+            arguments = get_default_arguments(provider, True)
+            arguments.update(master_arguments)
+            arguments['provider'] = provider
+            plan.append(PlannedNode('master', minion_id, provider, arguments))
+
+    for role_spec in environment.roles:
+        overrides = dict(role_spec.overrides)
+        compiled_role = index.get(role_spec.role, overrides.pop('provider', None),
+            overrides.pop('region', None))
+        provider = get_provider(compiled_role.provider, compiled_role.region)
+        existing_nodes = [node for node in list_nodes(provider) if node.role == role_spec.role]
+        existing_nodes.sort(key=lambda n: n.minion_id)
+
+        for listed_node in existing_nodes[:role_spec.count]:
+            plan.append(PlannedNode('existing', listed_node.minion_id, provider, {}))
+
+        for listed_node in existing_nodes[role_spec.count:]:
+            plan.append(PlannedNode('destroy', listed_node.minion_id, provider, {
+                'node': listed_node.node,
+            }))
+
+        for _ in range(role_spec.count - len(existing_nodes)):
+            arguments = get_default_arguments(provider, False)
+            arguments.update(build_minion_arguments(compiled_role, provider, overrides, warn))
+            plan.append(PlannedNode('minion', arguments['minion_id'], provider, arguments))
+
+    return plan
+
+
+def print_plan(plan):
+    symbols = {
+        'master': '+',
+        'minion': '+',
+        'destroy': '-',
+        'existing': '=',
+    }
+    for planned_node in plan:
+        print('%s %s %s (%s)' % (symbols[planned_node.kind], planned_node.kind,
+            planned_node.minion_id, planned_node.provider.alias))
+
+    changes = get_changes(plan)
+    print('%d to create, %d to destroy' % (
+        len([p for p in changes if p.kind != 'destroy']),
+        len([p for p in changes if p.kind == 'destroy'])))
+
+
+def get_changes(plan):
+    return [planned_node for planned_node in plan if planned_node.kind != 'existing']
+
+
+def apply_plan(plan, limits=None, max_workers=20):
+    '''
+    Create and destroy the nodes in the plan. The master is created first, and
+    then all the minions in parallel. Destroys don't wait for anything.
+
+    Minions with the same config are created in batches with a single API call
+    for providers that support it, and destroyed together for providers that
+    support bulk destroys.
+
+    Returns a dict of minion id -> TaskResult.
+    '''
+    plan = get_changes(plan)
+
+    # Ask about overwriting existing minions before scheduling anything, the
+    # minions are created in worker threads which can't ask the user
+    minion_ids = [planned_node.minion_id for planned_node in plan if planned_node.kind == 'minion']
+    existing_minions = find_existing_minions(minion_ids) if minion_ids else {}
+    if existing_minions and not confirm_overwrite(existing_minions):
+        print('Existing minions were found and did not want to overwrite, aborting')
+        return {}
+
+    # creates_per_minute only limits the masters and minions being created, the
+    # destroys only count towards the concurrency of the provider
+    scheduler = Scheduler(max_workers)
+    for planned_node in plan:
+        alias = planned_node.provider.alias
+        provider_limits = (limits or {}).get(alias, {})
+        creates_per_minute = provider_limits.get('creates_per_minute')
+        scheduler.set_group_limits(alias,
+            concurrency=provider_limits.get('concurrency', DEFAULT_PROVIDER_CONCURRENCY),
+            rate=creates_per_minute/60 if creates_per_minute else None)
+
+    master_tasks = []
+    for planned_node in plan:
+        if planned_node.kind == 'master':
+            master_tasks.append(scheduler.add(planned_node.minion_id,
+                functools.partial(create_master, **planned_node.arguments),
+                group=planned_node.provider.alias))
+
+    batches = {}
+    for batch in get_minion_batches(plan):
+        provider = batch[0].provider
+        if len(batch) == 1:
+            task = functools.partial(create_minion, overwrite=True, **batch[0].arguments)
+        else:
+            arguments = dict(batch[0].arguments)
+            del arguments['minion_id']
+            minion_ids = [planned_node.minion_id for planned_node in batch]
+            task = functools.partial(create_minions, minion_ids, overwrite=True, **arguments)
+        name = scheduler.add(batch[0].minion_id, task, dependencies=master_tasks,
+            group=provider.alias)
+        if len(batch) > 1:
+            batches[name] = minion_ids
+
+    bulk_destroys = {}
+    for planned_node in plan:
+        if planned_node.kind != 'destroy':
+            continue
+
+        if planned_node.provider.bulk_destroy:
+            bulk_destroys.setdefault(planned_node.provider, []).append(planned_node)
+        else:
+            scheduler.add(planned_node.minion_id,
+                functools.partial(destroy_minion, planned_node.minion_id,
+                    planned_node.provider, **planned_node.arguments),
+                group=planned_node.provider.alias, rate_limited=False)
+
+    for provider, planned_nodes in bulk_destroys.items():
+        minion_ids = [planned_node.minion_id for planned_node in planned_nodes]
+        nodes = [planned_node.arguments['node'] for planned_node in planned_nodes]
+        name = scheduler.add(minion_ids[0],
+            functools.partial(destroy_minions, minion_ids, provider, nodes),
+            group=provider.alias, rate_limited=False)
+        batches[name] = minion_ids
+
+    results = scheduler.run()
+    for name, minion_ids in batches.items():
+        batch_result = results.pop(name)
+        for minion_id in minion_ids:
+            if batch_result.error is not None:
+                results[minion_id] = batch_result
+            else:
+                results[minion_id] = batch_result.value.get(minion_id,
+                    TaskResult(None, ValueError('Minion was not created')))
+
+    failed = [minion_id for minion_id, result in results.items() if result.error is not None]
+    if failed:
+        log_error('Failed to apply changes to %s' % ', '.join(failed))
+
+    print('Applied %d of %d changes' % (len(results) - len(failed), len(results)))
+    return results
+
+
+def get_minion_batches(plan):
+    '''
+    Group the minions to create that only differ by minion id, if the provider
+    can create several nodes at once. Returns a list of lists of planned nodes.
+    '''
+    batches = []
+    for planned_node in plan:
+        if planned_node.kind != 'minion':
+            continue
+
+        provider = planned_node.provider
+        if provider.batch_minion_id_script is not None:
+            arguments = dict(planned_node.arguments, minion_id=None)
+            for batch in batches:
+                if (batch[0].provider is provider
+                        and dict(batch[0].arguments, minion_id=None) == arguments
+                        and len(batch) < (provider.max_batch_size or float('inf'))):
+                    batch.append(planned_node)
+                    break
+            else:
+                batches.append([planned_node])
+        else:
+            batches.append([planned_node])
+    return batches
@@ -0,0 +1,165 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from .utils import log_warning
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class KeyAcceptor:
+    '''
+    Accepts the keys of new minions on the salt master.
+
+    The key of each minion is trusted by writing it to the accepted keys as
+    soon as it's known. If the minion tried to authenticate before that, salt
+    has put its key in minions_pre and the minion is waiting to retry. A
+    thread watches minions_pre while there are minions being connected, and
+    moves the pending keys that match the trusted keys to the accepted keys
+    the moment they appear, to not leave them pending.
+
+    The directory is watched with inotify where available, and polled
+    otherwise.
+    '''
+
+    def __init__(self, pki_dir='/etc/salt/pki/master', poll_interval=1):
+        self.pki_dir = pki_dir
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        # minion id -> public key
+        self._expected = {}
+        self._warned = set()
+        self._thread = None
+
+
+    def trust(self, minion_id, pubkey):
+        '''Accept the key for the minion, and any pending key matching it.'''
+        # Write to a temp file outside the key directories first to not let
+        # salt read a partially written key
+        accepted_path = self._get_key_path('minions', minion_id)
+        temp_path = os.path.join(self.pki_dir, '.hart-%s.tmp' % minion_id)
+        with open(temp_path, 'wb') as fh:
+            fh.write(pubkey.encode('utf-8'))
+            os.fchmod(fh.fileno(), 0o644)
+        os.replace(temp_path, accepted_path)
+
+        with self._lock:
+            self._expected[minion_id] = pubkey
+            self._accept_pending(minion_id, pubkey)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                    name='key-acceptor')
+                self._thread.start()
+
+
+    def forget(self, minion_id):
+        '''Stop watching for pending keys from the minion.'''
+        with self._lock:
+            self._expected.pop(minion_id, None)
+            self._warned.discard(minion_id)
+
+
+    def _get_key_path(self, category, minion_id):
+        return os.path.join(self.pki_dir, category, minion_id)
+
+
+    def _accept_pending(self, minion_id, pubkey):
+        pending_path = self._get_key_path('minions_pre', minion_id)
+        try:
+            with open(pending_path) as fh:
+                pending_key = fh.read()
+        except FileNotFoundError:
+            return
+
+        if pending_key.strip() != pubkey.strip():
+            if minion_id not in self._warned:
+                log_warning('The pending key for %s does not match the key read from the node, '
+                    'not accepting it' % minion_id)
+                self._warned.add(minion_id)
+            return
+
+        # The key is the same as the accepted one, thus this atomically
+        # removes the pending key without the minion ever being unaccepted
+        os.replace(pending_path, self._get_key_path('minions', minion_id))
+        print('Accepted early connection attempt from %s' % minion_id)
+
+
+    def _run(self):
+        inotify_fd = watch_directory(os.path.join(self.pki_dir, 'minions_pre'))
+        try:
+            while True:
+                with self._lock:
+                    if not self._expected:
+                        # Stop, a new thread is started by the next trust
+                        self._thread = None
+                        return
+
+                    for minion_id, pubkey in self._expected.items():
+                        try:
+                            self._accept_pending(minion_id, pubkey)
+                        except OSError as error:
+                            log_warning('Failed to accept the pending key for %s: %s' % (
+                                minion_id, error))
+
+                if inotify_fd is None:
+                    time.sleep(self.poll_interval)
+                else:
+                    wait_for_events(inotify_fd, self.poll_interval)
+        finally:
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+
+
+def watch_directory(path):
+    '''
+    Return an inotify file descriptor watching for files being written or
+    moved into the directory, or None if inotify isn't available.
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    # IN_NONBLOCK and IN_CLOEXEC have the same values as the O_ flags
+    inotify_fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if inotify_fd < 0:
+        return None
+
+    if inotify_add_watch(inotify_fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(inotify_fd)
+        return None
+
+    return inotify_fd
+
+
+def wait_for_events(inotify_fd, timeout):
+    '''
+    Block until there are events on the inotify file descriptor or the
+    timeout passes. Returns the names of the files in the events.
+    '''
+    readable, _, _ = select.select([inotify_fd], [], [], timeout)
+    if not readable:
+        return []
+
+    try:
+        data = os.read(inotify_fd, 64*1024)
+    except BlockingIOError:
+        return []
+
+    names = []
+    offset = 0
+    while offset < len(data):
+        _, _, _, name_length = _INOTIFY_EVENT.unpack_from(data, offset)
+        offset += _INOTIFY_EVENT.size
+        names.append(os.fsdecode(data[offset:offset + name_length].rstrip(b'\0')))
+        offset += name_length
+    return names
@@ -6,6 +6,10 @@ import yaml
 from . import utils
 from .constants import DEBIAN_VERSIONS
 from .ssh import get_verified_ssh_client, ssh_run_command, ssh_run_init_script
+from .utils import log_warning
+
+# Written by the init script, overriding the default listen addresses
+APT_CACHE_CONFIG_PATH = '/etc/apt-cacher-ng/zz_hart.conf'
 
 
 def create_master(
@@ -19,6 +23,10 @@ def create_master(
         private_networking=False,
         minion_config=None,
         grains=None,
+        defer_security_updates=False,
+        apt_proxy=None,
+        apt_proxy_https=False,
+        apt_cache=False,
         script=None,
         authorize_key=None,
         **kwargs
@@ -34,10 +42,14 @@ def create_master(
         private_networking,
         minion_config,
         grains,
+        defer_security_updates,
+        apt_proxy,
+        apt_proxy_https,
+        apt_cache,
         **kwargs
     )
     try:
-        connect_to_master(hart_node, script, authorize_key)
+        connect_to_master(hart_node, script, authorize_key, apt_cache)
     except:
         sys.stderr.write('Destroying master since it failed startup\n')
         hart_node.provider.destroy_node(hart_node.node, extra=hart_node.node_extra)
@@ -55,6 +67,10 @@ def create_master_node(
         private_networking=False,
         minion_config=None,
         grains=None,
+        defer_security_updates=False,
+        apt_proxy=None,
+        apt_proxy_https=False,
+        apt_cache=False,
         **kwargs
         ):
     ssh_canary = utils.create_token()
@@ -68,7 +84,7 @@ def create_master_node(
     if minion_config is not None:
         default_minion_config.update(minion_config)
 
-    cloud_init = cloud_init_template.render(**{
+    cloud_init = provider.build_user_data(cloud_init_template.render(**{
         'random_seed': utils.create_token(),
         'minion_config': yaml.dump(default_minion_config),
         'grains': yaml.dump({'grains': grains}) if grains else None,
@@ -77,7 +93,11 @@ def create_master_node(
         'wait_for_apt': DEBIAN_VERSIONS[debian_codename] >= 10,
         'permit_root_ssh': provider.username == 'root',
         'add_user': salt_version and int(salt_version[:salt_version.find('.')]) < 3006,
-    })
+        'defer_security_updates': defer_security_updates,
+        'apt_proxy': apt_proxy,
+        'apt_proxy_https': apt_proxy_https,
+        'apt_cache': apt_cache,
+    }))
 
     key_name = utils.build_ssh_key_name(minion_id)
 
@@ -107,13 +127,14 @@ def create_master_node(
             raise
 
 
-def connect_to_master(hart_node, script, authorize_key=None):
+def connect_to_master(hart_node, script, authorize_key=None, apt_cache=False):
     username = hart_node.provider.username
     with get_verified_ssh_client(
             hart_node.public_ip,
             hart_node.ssh_key,
             hart_node.ssh_canary,
-            username) as client:
+            username,
+            hart_node.minion_id) as client:
         hart_node.provider.wait_for_init_script(client, hart_node.node_extra)
         if authorize_key:
             ssh_run_command(client, 'echo "%s" >> ~/.ssh/authorized_keys' % authorize_key)
@@ -125,3 +146,25 @@ def connect_to_master(hart_node, script, authorize_key=None):
             log_stdout=False)
         print('Master created: %s@%s\nssh fingerprints: \n%s' % (
             username, hart_node.public_ip, master_pubkeys))
+        if apt_cache:
+            configure_apt_cache(client, hart_node)
+
+
+def configure_apt_cache(client, hart_node):
+    '''
+    Let apt-cacher-ng listen on the private IP of the master, which only
+    listens on localhost after the init script. It's never bound to the public
+    IP, since anyone could then use it as a proxy.
+    '''
+    private_ips = hart_node.node.private_ips
+    if not private_ips:
+        log_warning('The master has no private IP, the apt cache only listens on localhost. '
+            'Enable private networking to let the minions use it.')
+        return
+
+    sudo = 'sudo ' if hart_node.provider.username != 'root' else ''
+    ssh_run_command(client, "echo 'BindAddress: localhost %s' | %stee %s >/dev/null && "
+        "%ssystemctl restart apt-cacher-ng" % (private_ips[0], sudo, APT_CACHE_CONFIG_PATH, sudo),
+        timeout=30)
+    print('apt cache running at http://%s:3142, set it as apt_proxy for the minions to use it' % (
+        private_ips[0]))
@@ -1,19 +1,28 @@
 #!./venv/bin/python
 
+import contextlib
+import functools
 import json
-import os
 import subprocess
 import sys
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
 from . import utils
 from .constants import DEBIAN_VERSIONS
-from .ssh import get_verified_ssh_client, ssh_run_command, ssh_run_init_script
+from .keys import KeyAcceptor
+from .scheduler import Scheduler, TaskResult, run_steps
+from .ssh import (forget_host_keys, get_verified_ssh_client, ssh_run_command,
+    ssh_run_init_script)
 from .utils import log_error
 
+# Accepts the keys of the minions being connected, shared by all the minions
+# created in this process
+_key_acceptor = KeyAcceptor()
+
 
 def create_minion(
         minion_id,
@@ -25,7 +34,11 @@ def create_minion(
         tags=None,
         private_networking=False,
         minion_config=None,
+        defer_security_updates=False,
+        apt_proxy=None,
+        apt_proxy_https=False,
         script=None,
+        overwrite=False,
         **kwargs
         ):
     hart_node = create_node(
@@ -38,14 +51,72 @@ def create_minion(
         tags,
         private_networking,
         minion_config,
+        defer_security_updates,
+        apt_proxy,
+        apt_proxy_https,
+        overwrite=overwrite,
         **kwargs
     )
+    connect_or_destroy_minion(hart_node, script)
+
+
+def create_minions(
+        minion_ids,
+        provider,
+        region=None,
+        size=None,
+        salt_version=None,
+        debian_codename='bullseye',
+        tags=None,
+        private_networking=False,
+        minion_config=None,
+        defer_security_updates=False,
+        apt_proxy=None,
+        apt_proxy_https=False,
+        script=None,
+        overwrite=False,
+        **kwargs
+        ):
+    '''
+    Create several minions with the same config in a single call to the
+    provider, and connect to them in parallel. The provider must support
+    `create_nodes`.
+
+    :param overwrite: Overwrite the keys of existing minions with the same ids
+        without asking, for when the user has already confirmed it.
+
+    Returns a dict of minion id -> TaskResult.
+    '''
+    hart_nodes = create_nodes(
+        minion_ids,
+        provider,
+        region,
+        size,
+        salt_version,
+        debian_codename,
+        tags,
+        private_networking,
+        minion_config,
+        defer_security_updates,
+        apt_proxy,
+        apt_proxy_https,
+        overwrite=overwrite,
+        **kwargs
+    )
+    scheduler = Scheduler(max_workers=len(minion_ids))
+    for hart_node in hart_nodes:
+        scheduler.add(hart_node.minion_id,
+            functools.partial(connect_or_destroy_minion, hart_node, script))
+    return scheduler.run()
+
+
+def connect_or_destroy_minion(hart_node, script):
     try:
         connect_minion(hart_node, script)
     except:
         log_error('Destroying node since it failed to connect')
         hart_node.provider.destroy_node(hart_node.node, extra=hart_node.node_extra)
-        disconnect_minion(minion_id)
+        disconnect_minion(hart_node.minion_id)
         raise
 
 
@@ -55,15 +126,20 @@ def connect_minion(hart_node, script):
             hart_node.public_ip,
             hart_node.ssh_key,
             hart_node.ssh_canary,
-            username) as client:
+            username,
+            hart_node.minion_id) as client:
         hart_node.provider.wait_for_init_script(client, hart_node.node_extra)
         minion_pubkey = get_minion_pubkey(client, should_sudo=username != 'root')
         trust_minion_key(hart_node.minion_id, minion_pubkey)
+        start_minion(client, should_sudo=username != 'root')
         print('Minion added: %s' % hart_node.public_ip)
-        verify_minion_connection(client, hart_node.minion_id, username)
+        try:
+            verify_minion_connection(client, hart_node.minion_id, username)
+        finally:
+            _key_acceptor.forget(hart_node.minion_id)
         if script:
             ssh_run_init_script(client, script)
-        hart_node.provider.post_connect(hart_node)
+        hart_node.provider.post_connect(hart_node, client)
 
 
 def create_node(
@@ -76,34 +152,36 @@ def create_node(
         tags=None,
         private_networking=False,
         minion_config=None,
+        defer_security_updates=False,
+        apt_proxy=None,
+        apt_proxy_https=False,
+        overwrite=False,
         **kwargs
         ):
     ssh_canary = utils.create_token()
-    cloud_init_template = utils.get_cloud_init_template()
-    master_pubkey = get_master_pubkey()
     default_minion_config = {
         'id': minion_id,
     }
     if minion_config is not None:
         default_minion_config.update(minion_config)
 
-    cloud_init = cloud_init_template.render(**{
-        'random_seed': utils.create_token(),
-        'minion_config': yaml.dump(default_minion_config),
-        'salt_version': salt_version,
-        'ssh_canary': ssh_canary,
-        'master_pubkey': master_pubkey,
-        'wait_for_apt': DEBIAN_VERSIONS[debian_codename] >= 10,
-        'permit_root_ssh': provider.username == 'root',
-    })
-
-    key_name = utils.build_ssh_key_name(minion_id)
-
-    if not check_existing_minion(minion_id):
-        print('Existing minions were found and did want to overwrite, aborting')
-        return
-
-    with provider.create_temp_ssh_key(key_name) as (ssh_key, auth_key):
+    with contextlib.ExitStack() as stack:
+        prepared = prepare_nodes(stack, [minion_id], provider, region, debian_codename, size, {
+            'random_seed': utils.create_token(),
+            'minion_config': yaml.dump(default_minion_config),
+            'salt_version': salt_version,
+            'ssh_canary': ssh_canary,
+            'wait_for_apt': DEBIAN_VERSIONS[debian_codename] >= 10,
+            'permit_root_ssh': provider.username == 'root',
+            'defer_security_updates': defer_security_updates,
+            'apt_proxy': apt_proxy,
+            'apt_proxy_https': apt_proxy_https,
+        }, overwrite, **kwargs)
+        if prepared is None:
+            print('Existing minions were found and did want to overwrite, aborting')
+            return None
+
+        cloud_init, (ssh_key, auth_key) = prepared
         node = None
         if size:
             kwargs['size'] = size
@@ -129,13 +207,131 @@ def create_node(
             raise
 
 
-def destroy_minion(minion_id, provider, **kwargs):
+def create_nodes(
+        minion_ids,
+        provider,
+        region=None,
+        size=None,
+        salt_version=None,
+        debian_codename='bullseye',
+        tags=None,
+        private_networking=False,
+        minion_config=None,
+        defer_security_updates=False,
+        apt_proxy=None,
+        apt_proxy_https=False,
+        overwrite=False,
+        **kwargs
+        ):
+    # All the nodes get the same cloud-init script, which gets the minion id
+    # from the provider on boot
+    ssh_canary = utils.create_token()
+
+    with contextlib.ExitStack() as stack:
+        prepared = prepare_nodes(stack, minion_ids, provider, region, debian_codename, size, {
+            'random_seed': utils.create_token(),
+            'minion_config': yaml.dump(minion_config or {}),
+            'minion_id_script': provider.batch_minion_id_script,
+            'salt_version': salt_version,
+            'ssh_canary': ssh_canary,
+            'wait_for_apt': DEBIAN_VERSIONS[debian_codename] >= 10,
+            'permit_root_ssh': provider.username == 'root',
+            'defer_security_updates': defer_security_updates,
+            'apt_proxy': apt_proxy,
+            'apt_proxy_https': apt_proxy_https,
+        }, overwrite, **kwargs)
+        if prepared is None:
+            print('Existing minions were found and did want to overwrite, aborting')
+            return []
+
+        cloud_init, (ssh_key, auth_key) = prepared
+        nodes = []
+        if size:
+            kwargs['size'] = size
+        try:
+            nodes = provider.create_nodes(
+                minion_ids,
+                region,
+                debian_codename,
+                auth_key,
+                cloud_init,
+                private_networking,
+                tags,
+                **kwargs)
+            with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+                running_nodes = list(executor.map(provider.wait_for_public_ip,
+                    [node for node, _ in nodes]))
+
+            hart_nodes = []
+            for minion_id, node, (_, extra) in zip(minion_ids, running_nodes, nodes):
+                public_ip = node.public_ips[0]
+                print('Node %s running at %s' % (minion_id, public_ip))
+                hart_nodes.append(utils.HartNode(minion_id, public_ip, node, provider,
+                    ssh_key, '%s %s' % (ssh_canary, minion_id), extra))
+            return hart_nodes
+        except:
+            traceback.print_exc()
+            if nodes:
+                log_error('Destroying nodes since they failed initialization')
+                provider.destroy_nodes(nodes)
+            raise
+
+
+def prepare_nodes(stack, minion_ids, provider, region, debian_codename, size,
+        cloud_init_context, overwrite=False, **kwargs):
+    '''
+    Do everything needed before the nodes can be created, running the steps
+    that doesn't depend on each other in parallel. The temp ssh key is entered
+    on the exit stack, to be deleted when the stack is closed.
+
+    The existing minions are looked up in parallel with the other steps, but
+    the user is asked whether to overwrite them on the calling thread.
+
+    Returns a tuple of (cloud_init, (ssh_key, auth_key)), or None if there are
+    existing minions with the same ids that the user didn't want to overwrite.
+    '''
+    key_name = utils.build_ssh_key_name(minion_ids[0])
+    values = run_steps({
+        'master_pubkey': (get_master_pubkey, ()),
+        'cloud_init': (lambda master_pubkey: provider.build_user_data(
+            utils.get_cloud_init_template().render(master_pubkey=master_pubkey,
+                **cloud_init_context)), ('master_pubkey',)),
+        'existing_minions': (lambda: {} if overwrite else find_existing_minions(minion_ids), ()),
+        'lookups': (functools.partial(provider.prepare_create_node, region,
+            debian_codename, size, **kwargs), ()),
+        'ssh_key': (lambda: stack.enter_context(provider.create_temp_ssh_key(key_name)), ()),
+    })
+    existing_minions = values['existing_minions']
+    if existing_minions and not confirm_overwrite(existing_minions):
+        return None
+    return values['cloud_init'], values['ssh_key']
+
+
+def destroy_minion(minion_id, provider, node=None, **kwargs):
+    '''
+    :param node: The node for the minion, if already known. Looked up from the
+        provider if not given.
+    '''
     disconnect_minion(minion_id)
     print('Destroying minion')
-    node = provider.get_node(minion_id)
+    if node is None:
+        node = provider.get_node(minion_id)
     provider.destroy_node(node, **kwargs)
 
 
+def destroy_minions(minion_ids, provider, nodes):
+    '''
+    Destroy several minions from the same provider at once.
+
+    Returns a dict of minion id -> TaskResult.
+    '''
+    for minion_id in minion_ids:
+        disconnect_minion(minion_id)
+    print('Destroying %d minions' % len(minion_ids))
+    provider.destroy_nodes([(node, None) for node in nodes])
+    return {minion_id: TaskResult(None, None) for minion_id in minion_ids}
+
+
 def disconnect_minion(minion_id):
     print('Deleting the salt minion %s' % minion_id)
     subprocess.run([
@@ -143,6 +339,7 @@ def disconnect_minion(minion_id):
         '--delete=%s' % minion_id,
         '--yes',
     ], check=True)
+    forget_host_keys(minion_id)
 
 
 def destroy_node(hart_node):
@@ -154,53 +351,48 @@ def get_master_pubkey():
         return fh.read()
 
 
-def check_existing_minion(minion_id):
-    minions = json.loads(subprocess.check_output([
+def find_existing_minions(minion_ids):
+    '''
+    Find the minions that already have a key on the master.
+
+    Returns a dict of minion id -> the key categories it was found in.
+    '''
+    keys = json.loads(subprocess.check_output([
         'salt-key',
-        '--print', minion_id,
+        '--list=all',
         '--out=json',
     ]).decode('utf-8'))
 
-    existing_categories = minions.keys()
-    if existing_categories:
-        should_continue = input('Existing minions matching %s were found in %s, '
-            'overwrite? [y/N]' % (minion_id, ', '.join(existing_categories)))
-        return should_continue == 'y'
+    existing_minions = {}
+    for category, category_minion_ids in keys.items():
+        for minion_id in minion_ids:
+            if minion_id in category_minion_ids:
+                existing_minions.setdefault(minion_id, []).append(category)
+    return existing_minions
 
-    return True
 
+def confirm_overwrite(existing_minions):
+    '''
+    Ask the user whether to overwrite the existing minions, returns whether
+    they did. Reads from stdin, thus only call this from the main thread.
+    '''
+    should_continue = input('Existing minions were found: %s, overwrite? [y/N]' % ', '.join(
+        '%s (%s)' % (minion_id, ', '.join(categories))
+        for minion_id, categories in existing_minions.items()))
+    return should_continue == 'y'
 
-def trust_minion_key(minion_id, minion_pubkey):
-    with open('/etc/salt/pki/master/minions/%s' % minion_id, 'wb') as fh:
-        fh.write(minion_pubkey.encode('utf-8'))
-        os.fchmod(fh.fileno(), 0o644)
-
-    # If the minion connected before we trusted the key, remove the duplicate key in minions_pre
-    pre_key_path = '/etc/salt/pki/master/minions_pre/%s' % minion_id
-    try:
-        pre_fh = open(pre_key_path)
-    except IOError:
-        return
 
-    with pre_fh:
-        pre_key = pre_fh.read()
-
-    if pre_key.strip() == minion_pubkey.strip():
-        print('Got early connection attempt from minion, removing pre-accept key')
-        os.remove(pre_key_path)
+def trust_minion_key(minion_id, minion_pubkey):
+    _key_acceptor.trust(minion_id, minion_pubkey)
 
 
 def verify_minion_connection(client, minion_id, username):
-    # The restart is needed since the minion might have attempted connecting to
-    # the salt master before the key got trusted and thus might not be ready to
-    # respond to a ping from the master
     prefix = 'sudo ' if username != 'root' else ''
-    ssh_run_command(client,
-        '{0}salt-call test.ping && {0}service salt-minion restart'.format(prefix),
-        timeout=120)
+    ssh_run_command(client, '%ssalt-call test.ping' % prefix, timeout=120)
 
-    # Also test that the master can reach the minion, but the minion might take a moment
-    # to start so try a couple times
+    # Also test that the master can reach the minion. The minion was started
+    # after the key was trusted and thus authenticates on the first attempt,
+    # but might take a moment to start so try a couple times
     for i in range(5):
         try:
             subprocess.run(['salt', minion_id, 'test.ping'],
@@ -227,6 +419,15 @@ def verify_minion_connection(client, minion_id, username):
     ssh_run_command(client, 'rm %s' % authorized_keys_path)
 
 
+def start_minion(client, should_sudo):
+    '''
+    Start salt-minion, which isn't started by the init script to not have it
+    try to authenticate before the key is trusted. If it already did anyway,
+    the key acceptor accepts the pending key.
+    '''
+    ssh_run_command(client, '%sservice salt-minion start' % ('sudo ' if should_sudo else ''))
+
+
 def get_minion_pubkey(client, should_sudo):
     cmd = '%scat /etc/salt/pki/minion/minion.pub' % ('sudo ' if should_sudo else '')
     return ssh_run_command(client, cmd, log_stdout=False)
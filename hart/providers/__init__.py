@@ -1,6 +1,6 @@
 from .digitalocean import DOProvider
 from .ec2 import EC2Provider
-from .vultr import VultrProvider
+from .vultr import VultrProvider, wait_for_ssh_key_cleanup
 from .gce import GCEProvider
 
 provider_map = {}
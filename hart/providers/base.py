@@ -1,21 +1,177 @@
 import abc
 import contextlib
-import time
-import json
+import functools
+import gzip
+import threading
 from collections import namedtuple
 
-import paramiko
+from .polling import NodePoller
+from .throttling import ThrottledClient, call_with_retries, get_rate_limiter
+from ..exceptions import UserError
+from ..ssh import KeyPool, generate_ed25519_key, stream_command_output, wait_for_init_status
+from ..utils import is_verbose
 
 
 NodeSize = namedtuple('NodeSize', 'id memory cpu disk monthly_cost extras')
 Region = namedtuple('Region', 'id name')
+ListedNode = namedtuple('ListedNode', 'minion_id role node')
+
+# Name of the label or tag used to mark which role a node was created from
+ROLE_LABEL = 'hart-role'
+
+_node_poller_lock = threading.Lock()
+
+
+def cached_lookup(func):
+    '''
+    Cache the results of a provider method by its arguments, for lookups that
+    don't change while the provider is used. The cache is stored on the
+    provider instance to not keep the provider alive after it's used.
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        cache = self.__dict__.setdefault('_lookup_cache', {})
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = func(self, *args, **kwargs)
+        return cache[key]
+    return wrapper
+
+
+# Prefixes of the API methods that create resources
+CREATING_CALL_PREFIXES = ('create', 'import', 'insert', 'post', 'run')
+
+
+def is_creating_call(func, kwargs):
+    '''
+    Guess whether an API call creates resources from the name of the method,
+    or the HTTP method for raw requests. Calls with a client token are
+    idempotent and thus safe to retry like any other call.
+    '''
+    if 'ClientToken' in kwargs:
+        return False
+
+    name = getattr(func, '__name__', '')
+    if name == 'request':
+        return kwargs.get('method', 'GET') == 'POST'
+    return name.startswith(CREATING_CALL_PREFIXES)
 
 
 class BaseProvider(abc.ABC):
     username = 'root'
 
-
-    def post_connect(self, hart_node):
+    # Default API limits, can be overridden in the provider config
+    requests_per_second = 5
+    request_burst = 5
+    max_retries = 5
+
+    # Providers that can create several nodes with the same user data in a
+    # single API call set this to the cloud-init snippet that sets $minion_id
+    # on the node, and implement `create_nodes`
+    batch_minion_id_script = None
+    # The maximum number of nodes to create in one call to `create_nodes`
+    max_batch_size = None
+    # Whether `destroy_nodes` is faster than destroying the nodes one by one
+    bulk_destroy = False
+
+    # Providers that pass the user data directly to cloud-init can send it
+    # gzipped, cloud-init decompresses it before running it
+    compress_user_data = False
+    # The largest user data the provider accepts, in bytes
+    max_user_data_size = None
+
+    # Whether the init script is run by cloud-init, which lets a failure be
+    # detected even if the script never started
+    uses_cloud_init = True
+    # Command to print the init log as it's written, for --verbose
+    init_log_command = 'tail -f -n +1 /var/log/cloud-init-output.log'
+    init_script_timeout = 30*60
+
+    _node_poller = None
+    _ssh_key_pool = None
+
+
+    def configure_throttling(self, requests_per_second=None, request_burst=None,
+            max_retries=None):
+        if requests_per_second is not None:
+            self.requests_per_second = requests_per_second
+        if request_burst is not None:
+            self.request_burst = request_burst
+        if max_retries is not None:
+            self.max_retries = max_retries
+
+
+    def configure_ssh_key_pool(self, size):
+        '''
+        Keep `size` temp ssh keys generated ahead of time. This is mostly useful
+        for providers with slow key types, Ed25519 keys are cheap to generate.
+        '''
+        self._ssh_key_pool = KeyPool(self.generate_ssh_key, size)
+        self._ssh_key_pool.fill()
+
+
+    def throttle(self, client, nested=()):
+        '''Wrap an API client to rate limit and retry all calls made through it.'''
+        return ThrottledClient(client, self.call_api, nested)
+
+
+    def call_api(self, func, *args, **kwargs):
+        rate_limiter = get_rate_limiter(self.get_rate_limit_key(),
+            self.requests_per_second, self.request_burst)
+        is_retryable = self.is_retryable_error
+        if is_creating_call(func, kwargs):
+            is_retryable = self.is_retryable_create_error
+        return call_with_retries(functools.partial(func, *args, **kwargs),
+            is_retryable, self.max_retries, rate_limiter)
+
+
+    def get_rate_limit_key(self):
+        '''Providers that return the same key share the rate limit.'''
+        return self.alias
+
+
+    def is_retryable_error(self, error): # pylint: disable=no-self-use,unused-argument
+        '''Override this to retry API calls that failed with the given error.'''
+        return False
+
+
+    def is_retryable_create_error(self, error): # pylint: disable=no-self-use,unused-argument
+        '''
+        Override this to retry API calls creating resources that failed with
+        the given error. Only errors that are known to happen before the
+        provider acted on the request can be retried, like being throttled,
+        since a retry would otherwise create a duplicate resource.
+        '''
+        return False
+
+
+    def build_user_data(self, cloud_init):
+        '''
+        Encode the rendered cloud-init script as the user data to send to the
+        provider, compressing it if supported.
+        '''
+        encoded = cloud_init.encode('utf-8')
+        user_data = encoded
+        if self.compress_user_data:
+            # Don't store the time in the header, to get the same output for the
+            # same script
+            user_data = gzip.compress(encoded, mtime=0)
+            print('User data is %d bytes (%d uncompressed)' % (len(user_data), len(encoded)))
+        else:
+            print('User data is %d bytes' % len(user_data))
+
+        if self.max_user_data_size and len(user_data) > self.max_user_data_size:
+            raise UserError('The user data is %d bytes, but %s only accepts up to %d bytes' % (
+                len(user_data), self.alias, self.max_user_data_size))
+
+        return user_data if self.compress_user_data else cloud_init
+
+
+    def post_connect(self, hart_node, client=None):
+        '''
+        Override this to finish setting up the node after it's connected to
+        salt. `client` is the verified ssh connection to the node, if open.
+        '''
         pass
 
 
@@ -40,51 +196,57 @@ class BaseProvider(abc.ABC):
 
 
     def generate_ssh_key(self): # pylint: disable=no-self-use
-        # paramiko doesn't yet support creating Ed25519 keys :'(
-        return paramiko.ECDSAKey.generate()
+        return generate_ed25519_key()
 
 
     def wait_for_init_script(self, client, extra=None):
-        # Creds to https://stackoverflow.com/a/14158100 for a way to get the pid
-        _, stdout, stderr = client.exec_command(
-            'echo $$ && exec tail -f -n +1 /var/log/cloud-init-output.log')
-        tail_pid = int(stdout.readline())
-        for line in stdout:
-            print(line, end='')
-            if line.startswith('Cloud-init') and ' finished ' in line:
-                stdout.channel.close()
-                client.exec_command('kill %d' % tail_pid)
-                break
-
-        for line in stderr:
-            print('Cloud-init stderr: %s' % line.strip())
+        '''
+        Wait for the init script to finish, failing as soon as one of its steps
+        fails. The full init log is streamed with --verbose.
+        '''
+        self.follow_init_script(client, self.init_log_command,
+            check_cloud_init=self.uses_cloud_init)
+
+
+    def follow_init_script(self, client, log_command, check_cloud_init):
+        '''
+        Poll the status of the init script until it's done, streaming the output
+        of `log_command` with --verbose.
+        '''
+        log_channel = None
+        if is_verbose():
+            log_channel = stream_command_output(client, log_command)
+        try:
+            wait_for_init_status(client, self.init_script_timeout, check_cloud_init)
+        finally:
+            if log_channel is not None:
+                log_channel.close()
 
-        _, stdout, stderr = client.exec_command('cat /run/cloud-init/result.json', timeout=3)
-        if stdout.channel.recv_exit_status() != 0:
-            raise ValueError('Failed to get cloud-init status')
 
-        cloud_init_result = json.loads(''.join(stdout))
-        if cloud_init_result['v1']['errors']:
-            raise ValueError('cloud-init failed: %s' % ', '.join(cloud_init_result['v1']['errors']))
+    @property
+    def node_poller(self):
+        '''Poller shared by all threads waiting for nodes from this provider.'''
+        with _node_poller_lock:
+            if self._node_poller is None:
+                self._node_poller = NodePoller(self.get_nodes)
+            return self._node_poller
 
 
     def wait_for_public_ip(self, node):
-        if node.public_ips and node.public_ips[0] != '0.0.0.0':
+        if has_public_ip(node):
             return node
-        timeout = 180
-        start_time = time.time()
-        while True:
-            time.sleep(2)
-            node = self.get_node(node)
-            if node.public_ips and node.public_ips[0] != '0.0.0.0':
-                return node
-            if time.time() - start_time > timeout:
-                raise ValueError('Timed out waiting for node IP: %s' % node.id)
+        updated_node = self.node_poller.wait_for(node, has_public_ip, timeout=180)
+        if updated_node is None:
+            raise ValueError('Timed out waiting for node IP: %s' % node.id)
+        return updated_node
 
 
     @contextlib.contextmanager
     def create_temp_ssh_key(self, key_name):
-        local_key = self.generate_ssh_key()
+        if self._ssh_key_pool is not None:
+            local_key = self._ssh_key_pool.get()
+        else:
+            local_key = self.generate_ssh_key()
         # There's three different variants of the key here, the local key that
         # has the private part, the remote key which has the provider mapping to
         # delete it later, and the auth key, which is passed to the provider
@@ -121,11 +283,45 @@ class BaseProvider(abc.ABC):
         raise NotImplementedError()
 
 
+    def destroy_nodes(self, nodes):
+        '''
+        Destroy all the given (node, extra) tuples. Override this if the
+        provider can destroy several nodes at once.
+        '''
+        for node, extra in nodes:
+            self.destroy_node(node, extra)
+
+
     def get_node(self, node):
         '''node can be either a id or a Node as returned from `create_node`.'''
         raise NotImplementedError()
 
 
+    def get_nodes(self, nodes):
+        '''
+        Return a dict of node id -> updated node for the given nodes. Override
+        this to get all the nodes in a single API call.
+        '''
+        return {node.id: self.get_node(node) for node in nodes}
+
+
+    def list_nodes(self):
+        '''Return a list of ListedNode for all the nodes in the provider.'''
+        raise NotImplementedError()
+
+
+    @classmethod
+    def add_role_marker(cls, arguments, role, warn=True):
+        '''
+        Override this to mark nodes created from a role with the role name, to
+        enable finding the nodes for the role again with `list_nodes`.
+
+        :param warn: Whether to warn if the node can't be marked, false when
+            only validating or showing the arguments without creating a node.
+        '''
+        pass
+
+
     def get_regions(self, **kwargs):
         raise NotImplementedError()
 
@@ -134,6 +330,15 @@ class BaseProvider(abc.ABC):
         raise NotImplementedError()
 
 
+    def prepare_create_node(self, region, debian_codename, size=None, **kwargs):
+        '''
+        Override this to look up anything `create_node` needs up front, like
+        sizes and images. This is run in parallel with the other preparations
+        before the node is created, and the results should be cached.
+        '''
+        pass
+
+
     def create_node(self,
             minion_id,
             region,
@@ -145,3 +350,24 @@ class BaseProvider(abc.ABC):
             size=None,
             **kwargs):
         raise NotImplementedError()
+
+
+    def create_nodes(self,
+            minion_ids,
+            region,
+            debian_codename,
+            auth_key,
+            cloud_init,
+            private_networking,
+            tags,
+            size=None,
+            **kwargs):
+        '''
+        Create a node for each of the minion ids with the same cloud-init
+        script. Returns a list of (node, extra) in the same order as the ids.
+        '''
+        raise NotImplementedError()
+
+
+def has_public_ip(node):
+    return bool(node.public_ips) and node.public_ips[0] != '0.0.0.0'
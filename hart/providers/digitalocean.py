@@ -1,17 +1,25 @@
 import base64
 import hashlib
+import json
 
 from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider
 
 from ..constants import DEBIAN_VERSIONS
-from .base import NodeSize
-from .libcloud import BaseLibcloudProvider
+from .base import cached_lookup, NodeSize, ROLE_LABEL
+from .libcloud import BaseLibcloudProvider, get_private_method
 
 
 class DOProvider(BaseLibcloudProvider):
     alias = 'do'
     default_size = 's-1vcpu-1gb'
+    # DO allows 5000 requests per hour, and 250 per minute
+    requests_per_second = 1.3
+    request_burst = 20
+    batch_minion_id_script = 'do-minion-id.sh'
+    # The most droplets the API can create in a single request
+    max_batch_size = 10
+    max_user_data_size = 64*1024
 
     def __init__(self, token, **kwargs):
         constructor = get_driver(Provider.DIGITAL_OCEAN)
@@ -23,6 +31,11 @@ class DOProvider(BaseLibcloudProvider):
             help='Enable IPv6 on the droplet')
 
 
+    def prepare_create_node(self, region, debian_codename, size=None, **kwargs):
+        super().prepare_create_node(region, debian_codename, size, **kwargs)
+        self.get_image(debian_codename)
+
+
     def create_node(self,
             minion_id,
             region,
@@ -49,6 +62,56 @@ class DOProvider(BaseLibcloudProvider):
         return node, None
 
 
+    def create_nodes(self,
+            minion_ids,
+            region,
+            debian_codename,
+            auth_key,
+            cloud_init,
+            private_networking,
+            tags,
+            size=None,
+            **kwargs):
+        if size is None:
+            size = self.default_size
+
+        key_fingerprint = pubkey_to_fingerprint(auth_key.pubkey)
+        size = self.get_size(size)
+        image = self.get_image(debian_codename)
+        location = self.get_location(region)
+        # libcloud only supports creating a single droplet at a time
+        response = self.driver.connection.request('/v2/droplets', method='POST',
+            data=json.dumps({
+                'names': minion_ids,
+                'size': size.name,
+                'image': image.id,
+                'region': location.id,
+                'user_data': cloud_init,
+                'ssh_keys': [key_fingerprint],
+                'private_networking': private_networking,
+                'tags': tags,
+                'ipv6': kwargs.get('enable_ipv6'),
+            }))
+        nodes_by_name = {}
+        to_node = get_private_method(self.driver, '_to_node')
+        for droplet in response.object['droplets']:
+            node = to_node(droplet)
+            nodes_by_name[node.name] = node
+        return [(nodes_by_name[minion_id], None) for minion_id in minion_ids]
+
+
+    @classmethod
+    def add_role_marker(cls, arguments, role, warn=True):
+        tags = list(arguments.get('tags') or [])
+        tags.append('%s:%s' % (ROLE_LABEL, role))
+        arguments['tags'] = tags
+
+
+    def get_node_role(self, node):
+        return get_role_from_tags(node.extra.get('tags') or [])
+
+
+    @cached_lookup
     def get_image(self, debian_codename):
         target_image = 'debian-%d-x64' % DEBIAN_VERSIONS[debian_codename]
         for image in self.driver.list_images():
@@ -73,6 +136,14 @@ class DOProvider(BaseLibcloudProvider):
         return sizes
 
 
+def get_role_from_tags(tags):
+    prefix = '%s:' % ROLE_LABEL
+    for tag in tags:
+        if tag.startswith(prefix):
+            return tag[len(prefix):]
+    return None
+
+
 def pubkey_to_fingerprint(pubkey):
     '''Encodes the key fingerprint as colon-separated hex pairs, like ba:5e:ba:11.'''
     base64_bytes = pubkey.split(' ')[1]
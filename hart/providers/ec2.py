@@ -1,18 +1,21 @@
 import ipaddress
 import json
 import datetime
+import functools
 import sys
-import time
+import threading
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import ifaddr
-import paramiko
 from libcloud.compute.base import Node
 
-from .base import BaseProvider, NodeSize, Region
+from .base import BaseProvider, cached_lookup, ListedNode, NodeSize, Region, ROLE_LABEL
+from .throttling import call_with_retries
 from ..constants import DEBIAN_VERSIONS
 from ..exceptions import UserError
-from ..utils import remove_argument_from_parser
+from ..utils import create_token, log_error, remove_argument_from_parser
 
 
 # The pricing API is a supreme clusterfuck that requires lots of special care.
@@ -51,17 +54,56 @@ region_to_location_map = {
     'us-west-2': 'US West (Oregon)',
 }
 
+# Error codes returned when we're throttled, which are safe to retry also for
+# calls that create resources
+THROTTLING_ERROR_CODES = (
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+)
+
+# Error codes for temporary failures. These might happen after a resource was
+# created, thus are only retried for calls that don't create anything.
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES + (
+    'InternalError',
+    'ServiceUnavailable',
+    'Unavailable',
+)
+
+# Retries are handled by the provider to share the rate limit between all
+# clients, thus disable the retries in boto. This includes the retries on
+# connection errors, which are retried by the provider instead.
+BOTO_CONFIG = botocore.config.Config(retries={
+    'mode': 'standard',
+    'total_max_attempts': 1,
+})
+
 
 class EC2Provider(BaseProvider):
     username = 'admin'
     alias = 'ec2'
     default_size = 't3.micro'
+    # EC2 refills the token bucket for non-mutating actions at 20/s, and 5/s
+    # for mutating actions
+    requests_per_second = 5
+    request_burst = 20
+    # boto base64 encodes the user data, thus it can be binary
+    compress_user_data = True
+    max_user_data_size = 16*1024
+    batch_minion_id_script = 'ec2-minion-id.sh'
 
     def __init__(self, aws_access_key_id, aws_secret_access_key, region=None):
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
         self.region = region
         self._ec2 = None
+        # (vpc id, connection gateway) -> temp security group id
+        self._temp_security_groups = {}
+        # Temp security group id -> how many nodes are still using it
+        self._temp_security_group_users = {}
+        self._temp_security_groups_lock = threading.Lock()
+        self._subnets = {}
+        self._default_security_groups = {}
 
 
     @property
@@ -71,17 +113,35 @@ class EC2Provider(BaseProvider):
         if self._ec2:
             return self._ec2
 
-        self._ec2 = boto3.client('ec2',
-            region_name=self.region,
+        self._ec2 = self.build_client('ec2', self.region)
+        return self._ec2
+
+
+    def build_client(self, service, region):
+        return self.throttle(boto3.client(service,
+            region_name=region,
             aws_access_key_id=self.aws_access_key_id,
             aws_secret_access_key=self.aws_secret_access_key,
-        )
-        return self._ec2
+            config=BOTO_CONFIG,
+        ))
+
+
+    def get_rate_limit_key(self):
+        # The API limits are per region
+        return (self.alias, self.region)
 
 
-    def generate_ssh_key(self):
-        # EC2 only supports RSA for ssh keys
-        return paramiko.RSAKey.generate(2048)
+    def is_retryable_error(self, error):
+        return (get_error_code(error) in RETRYABLE_ERROR_CODES
+            or isinstance(error, (botocore.exceptions.ConnectionError,
+                botocore.exceptions.HTTPClientError)))
+
+
+    def is_retryable_create_error(self, error):
+        # botocore's ConnectionErrors are raised before the request is sent,
+        # while HTTPClientErrors like read timeouts might be after
+        return (get_error_code(error) in THROTTLING_ERROR_CODES
+            or isinstance(error, botocore.exceptions.ConnectionError))
 
 
     def add_create_minion_arguments(self, parser):
@@ -128,6 +188,13 @@ class EC2Provider(BaseProvider):
         self.ec2.delete_key_pair(KeyName=remote_key)
 
 
+    def prepare_create_node(self, region, debian_codename, size=None, **kwargs):
+        zone = kwargs.get('zone')
+        if zone:
+            self.get_subnet(zone, kwargs.get('subnet'))
+        self.get_image(debian_codename)
+
+
     def create_node(self,
             minion_id,
             region,
@@ -138,6 +205,68 @@ class EC2Provider(BaseProvider):
             tags,
             size=None,
             **kwargs):
+        instances, extra = self.run_instances(1, debian_codename, auth_key,
+            cloud_init, {'Name': minion_id, **tags}, size, **kwargs)
+        return launched_instance_to_node(instances[0], minion_id, self.ec2), extra
+
+
+    def create_nodes(self,
+            minion_ids,
+            region,
+            debian_codename,
+            auth_key,
+            cloud_init,
+            private_networking,
+            tags,
+            size=None,
+            **kwargs):
+        instances, extra = self.run_instances(len(minion_ids), debian_codename, auth_key,
+            cloud_init, tags, size,
+            # Expose the tags in the instance metadata to let the nodes read
+            # their minion id from the Name tag
+            metadata_options={
+                'HttpEndpoint': 'enabled',
+                'HttpTokens': 'required',
+                'InstanceMetadataTags': 'enabled',
+            },
+            **kwargs)
+
+        nodes = []
+        try:
+            for minion_id, instance in zip(minion_ids, instances):
+                # Tagging can fail if called right after run_instances, retry if not found
+                call_with_retries(functools.partial(self.ec2.create_tags,
+                        Resources=[instance['InstanceId']],
+                        Tags=[{'Key': 'Name', 'Value': minion_id}]),
+                    lambda error: get_error_code(error) == 'InvalidInstanceID.NotFound',
+                    max_retries=8, base_delay=1, max_delay=5)
+                nodes.append((launched_instance_to_node(instance, minion_id, self.ec2), extra))
+        except:
+            log_error('Destroying all nodes in the batch since tagging failed')
+            for instance in instances:
+                node = launched_instance_to_node(instance, None, self.ec2)
+                self.destroy_node(node, extra)
+            raise
+
+        return nodes
+
+
+    def run_instances(self,
+            count,
+            debian_codename,
+            auth_key,
+            cloud_init,
+            tags,
+            size=None,
+            metadata_options=None,
+            **kwargs):
+        '''
+        Launch `count` identical instances with the temporary security group for
+        the VPC.
+
+        Returns a tuple of the launched instances and the node extra shared by
+        all of them.
+        '''
         if size is None:
             size = self.default_size
 
@@ -148,31 +277,9 @@ class EC2Provider(BaseProvider):
         size = self.get_size(size)
         image = self.get_image(debian_codename)
 
-        subnet = kwargs.get('subnet')
-        subnet_ids = [subnet] if subnet else []
-        subnet_response = self.ec2.describe_subnets(SubnetIds=subnet_ids,
-            Filters=[{'Name': 'availability-zone', 'Values': [zone]}])
-        subnets = subnet_response['Subnets']
-
-        if not subnets and subnet:
-            raise UserError('No subnet matching %s in %s' % (subnet, zone))
-        elif not subnets:
-            raise UserError('No available subnets in %s' % zone)
-        elif len(subnets) > 1:
-            subnet_summary = []
-            for subnet in subnets:
-                for tag in subnet.get('Tags', []):
-                    if tag['Key'] == 'Name':
-                        subnet_summary.append('%s (%s)' % (subnet['SubnetId'], tag['Value']))
-                        break
-                else:
-                    subnet_summary.append(subnet['SubnetId'])
-            raise UserError('More than one subnet in availability zone, specify'
-                ' which one to use: %s' % (', '.join(subnet_summary)))
-
-        subnet = subnets[0]
-        temp_security_group = self.create_temp_security_group(minion_id,
-            kwargs.get('connection_gateway'), subnet['VpcId'])
+        subnet = self.get_subnet(zone, kwargs.get('subnet'))
+        temp_security_group = self.acquire_temp_security_group(
+            kwargs.get('connection_gateway'), subnet['VpcId'], count)
 
         block_devices = []
         volume_type = kwargs.get('volume_type')
@@ -196,40 +303,48 @@ class EC2Provider(BaseProvider):
                 'Ebs': ebs,
             })
 
-        tag_specifications = [{'Key': 'Name', 'Value': minion_id}]
+        tag_specifications = []
         for key, val in tags.items():
             tag_specifications.append({
                 'Key': key,
                 'Value': val,
             })
 
-        create_response = self.ec2.run_instances(
-            ImageId=image['ImageId'],
-            InstanceType=size,
-            KeyName=auth_key,
-            Placement={'AvailabilityZone': zone},
-            UserData=cloud_init,
-            MinCount=1,
-            MaxCount=1,
-            BlockDeviceMappings=block_devices,
-            NetworkInterfaces=[{
-                'AssociatePublicIpAddress': True,
-                'DeleteOnTermination': True,
-                'DeviceIndex': 0,
-                'SubnetId': subnet['SubnetId'],
-                'Groups': [temp_security_group],
-            }],
-            TagSpecifications=[{
+        run_kwargs = {}
+        if tag_specifications:
+            run_kwargs['TagSpecifications'] = [{
                 'ResourceType': 'instance',
                 'Tags': tag_specifications,
-            }],
-        )
-        instance = create_response['Instances'][0]
-
-        node = Node(id=instance['InstanceId'], name=minion_id, state=instance['State']['Name'],
-            public_ips=[], private_ips=[instance['PrivateIpAddress']],
-            driver=self.ec2, created_at=instance['LaunchTime'], extra=None)
-        return node, {
+            }]
+        if metadata_options:
+            run_kwargs['MetadataOptions'] = metadata_options
+
+        try:
+            create_response = self.ec2.run_instances(
+                ImageId=image['ImageId'],
+                InstanceType=size,
+                KeyName=auth_key,
+                Placement={'AvailabilityZone': zone},
+                UserData=cloud_init,
+                MinCount=count,
+                MaxCount=count,
+                # Makes the call idempotent, and thus safe to retry on any error
+                ClientToken=create_token(),
+                BlockDeviceMappings=block_devices,
+                NetworkInterfaces=[{
+                    'AssociatePublicIpAddress': True,
+                    'DeleteOnTermination': True,
+                    'DeviceIndex': 0,
+                    'SubnetId': subnet['SubnetId'],
+                    'Groups': [temp_security_group],
+                }],
+                **run_kwargs
+            )
+        except:
+            self.release_temp_security_group(temp_security_group, count)
+            raise
+
+        return create_response['Instances'], {
             'groupId': temp_security_group,
             'vpcId': subnet['VpcId'],
         }
@@ -243,27 +358,35 @@ class EC2Provider(BaseProvider):
             }])
         else:
             # This can fail if called right after run_instances, retry if not found
-            start_time = time.time()
-            exception = None
-            while time.time() - start_time < 20:
-                try:
-                    instance_response = self.ec2.describe_instances(InstanceIds=[node.id])
-                    break
-                except Exception as error:
-                    exception = error
-                    time.sleep(1)
-            else:
-                # no break
-                raise ValueError('Instance not found') from exception
+            instance_response = call_with_retries(
+                lambda: self.ec2.describe_instances(InstanceIds=[node.id]),
+                lambda error: get_error_code(error) == 'InvalidInstanceID.NotFound',
+                max_retries=8, base_delay=1, max_delay=5)
 
         instance = instance_response['Reservations'][0]['Instances'][0]
+        return self.instance_to_node(instance)
+
+
+    def get_nodes(self, nodes):
+        # Filtering on instance id instead of passing InstanceIds doesn't fail
+        # if some of the instances aren't visible yet
+        updated_nodes = {}
+        paginator = self.ec2.get_paginator('describe_instances')
+        results = paginator.paginate(Filters=[{
+            'Name': 'instance-id',
+            'Values': [node.id for node in nodes],
+        }])
+        for result in results:
+            for reservation in result['Reservations']:
+                for instance in reservation['Instances']:
+                    updated_nodes[instance['InstanceId']] = self.instance_to_node(instance)
+        return updated_nodes
+
+
+    def instance_to_node(self, instance):
         public_ip = instance.get('PublicIpAddress')
         public_ips = [public_ip] if public_ip else []
-        name = None
-        for tag in instance['Tags']:
-            if tag['Key'] == 'Name':
-                name = tag['Value']
-                break
+        name = get_tag(instance, 'Name')
         private_ip = instance.get('PrivateIpAddress')
         private_ips = [private_ip] if private_ip else []
         return Node(id=instance['InstanceId'], name=name, state=instance['State']['Name'],
@@ -271,16 +394,120 @@ class EC2Provider(BaseProvider):
             created_at=instance['LaunchTime'], extra=None)
 
 
-    def create_temp_security_group(self, minion_id, connection_gateway, vpc_id):
+    def list_nodes(self):
+        nodes = []
+        paginator = self.ec2.get_paginator('describe_instances')
+        results = paginator.paginate(Filters=[{
+            'Name': 'instance-state-name',
+            'Values': ['pending', 'running', 'stopping', 'stopped'],
+        }])
+        for response in results:
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    nodes.append(ListedNode(get_tag(instance, 'Name'),
+                        get_tag(instance, ROLE_LABEL), self.instance_to_node(instance)))
+        return nodes
+
+
+    @classmethod
+    def add_role_marker(cls, arguments, role, warn=True):
+        tags = arguments.get('tags') or {}
+        tags[ROLE_LABEL] = role
+        arguments['tags'] = tags
+
+
+    def get_subnet(self, zone, subnet_id=None):
+        key = (zone, subnet_id)
+        if key in self._subnets:
+            return self._subnets[key]
+
+        subnet_ids = [subnet_id] if subnet_id else []
+        subnet_response = self.ec2.describe_subnets(SubnetIds=subnet_ids,
+            Filters=[{'Name': 'availability-zone', 'Values': [zone]}])
+        subnets = subnet_response['Subnets']
+
+        if not subnets and subnet_id:
+            raise UserError('No subnet matching %s in %s' % (subnet_id, zone))
+        elif not subnets:
+            raise UserError('No available subnets in %s' % zone)
+        elif len(subnets) > 1:
+            subnet_summary = []
+            for subnet in subnets:
+                for tag in subnet.get('Tags', []):
+                    if tag['Key'] == 'Name':
+                        subnet_summary.append('%s (%s)' % (subnet['SubnetId'], tag['Value']))
+                        break
+                else:
+                    subnet_summary.append(subnet['SubnetId'])
+            raise UserError('More than one subnet in availability zone, specify'
+                ' which one to use: %s' % (', '.join(subnet_summary)))
+
+        self._subnets[key] = subnets[0]
+        return subnets[0]
+
+
+    def get_default_security_group(self, vpc_id):
+        if vpc_id in self._default_security_groups:
+            return self._default_security_groups[vpc_id]
+
+        response = self.ec2.describe_security_groups(
+            Filters=[{
+                'Name': 'group-name',
+                'Values': ['default'],
+            }, {
+                'Name': 'vpc-id',
+                'Values': [vpc_id],
+            }],
+        )
+        group_id = response['SecurityGroups'][0]['GroupId']
+        self._default_security_groups[vpc_id] = group_id
+        return group_id
+
+
+    def acquire_temp_security_group(self, connection_gateway, vpc_id, node_count=1):
+        '''
+        Get the temporary security group allowing ssh from this host into the
+        VPC, creating it if it doesn't exist. The group is shared between all
+        nodes being created in the VPC, and deleted when the last node using it
+        calls `release_temp_security_group`.
+        '''
+        key = (vpc_id, connection_gateway)
+        with self._temp_security_groups_lock:
+            group_id = self._temp_security_groups.get(key)
+            if group_id is None:
+                group_id = self.create_temp_security_group(connection_gateway, vpc_id)
+                self._temp_security_groups[key] = group_id
+                self._temp_security_group_users[group_id] = 0
+            self._temp_security_group_users[group_id] += node_count
+            return group_id
+
+
+    def release_temp_security_group(self, group_id, node_count=1):
+        with self._temp_security_groups_lock:
+            remaining_users = self._temp_security_group_users.pop(group_id, node_count) - node_count
+            if remaining_users > 0:
+                self._temp_security_group_users[group_id] = remaining_users
+                return
+
+            # Stop handing out the group before deleting it
+            for key, shared_group_id in list(self._temp_security_groups.items()):
+                if shared_group_id == group_id:
+                    del self._temp_security_groups[key]
+
+        print('Deleting temporary security group')
+        self.ec2.delete_security_group(GroupId=group_id)
+
+
+    def create_temp_security_group(self, connection_gateway, vpc_id):
         current_date = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%S')
-        name = 'temp-for-%s-%s' % (minion_id, current_date)
+        name = 'hart-temp-ssh-%s-%s-%s' % (vpc_id, current_date, create_token()[:8])
 
         # Get the external IPs for the current host to let through the firewall
         # to the minion for the initial ssh connection
         if connection_gateway:
             external_ips = [connection_gateway]
         else:
-            external_ips = list(get_host_public_ips())
+            external_ips = get_host_public_ips()
 
         if not external_ips:
             raise UserError('Could not find any public IPs on the current '
@@ -306,6 +533,7 @@ class EC2Provider(BaseProvider):
         return group_id
 
 
+    @cached_lookup
     def get_image(self, debian_codename):
         debian_version = DEBIAN_VERSIONS[debian_codename]
         official_debian_account = '136693071363'
@@ -319,7 +547,7 @@ class EC2Provider(BaseProvider):
         return dist_images[-1]
 
 
-    def post_connect(self, hart_node):
+    def post_connect(self, hart_node, client=None):
         # Delete the temp security group that allowed ssh
         # Detach the security group from the instance. An instance must have at
         # least one security group, so we attach the VPC default group.
@@ -331,19 +559,9 @@ class EC2Provider(BaseProvider):
 
 
     def delete_node_security_group(self, node, group_id, vpc_id):
-        response = self.ec2.describe_security_groups(
-            Filters=[{
-                'Name': 'group-name',
-                'Values': ['default'],
-            }, {
-                'Name': 'vpc-id',
-                'Values': [vpc_id],
-            }],
-        )
-        default_group = response['SecurityGroups'][0]
-        self.ec2.modify_instance_attribute(InstanceId=node.id, Groups=[default_group['GroupId']])
-        print('Deleting temporary security group')
-        response = self.ec2.delete_security_group(GroupId=group_id)
+        default_group = self.get_default_security_group(vpc_id)
+        self.ec2.modify_instance_attribute(InstanceId=node.id, Groups=[default_group])
+        self.release_temp_security_group(group_id)
 
 
     def destroy_node(self, node, extra=None, **kwargs):
@@ -364,11 +582,7 @@ class EC2Provider(BaseProvider):
                 'in any other region\n')
             region = 'us-east-1'
 
-        pricing = boto3.client('pricing',
-            region_name='us-east-1',
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-        )
+        pricing = self.build_client('pricing', 'us-east-1')
         sizes = []
         location = region_to_location_map[region]
         filters = [
@@ -435,11 +649,7 @@ class EC2Provider(BaseProvider):
         response = self.ec2.describe_regions()
         for region in response['Regions']:
             if include_zones:
-                region_boto = boto3.client('ec2',
-                    region_name=region['RegionName'],
-                    aws_access_key_id=self.aws_access_key_id,
-                    aws_secret_access_key=self.aws_secret_access_key,
-                )
+                region_boto = self.build_client('ec2', region['RegionName'])
                 az_response = region_boto.describe_availability_zones()
                 for zone in az_response['AvailabilityZones']:
                     # Don't fail if we don't know the name of the region to avoid
@@ -454,10 +664,33 @@ class EC2Provider(BaseProvider):
         return regions
 
 
+def launched_instance_to_node(instance, minion_id, driver):
+    # The instances returned from run_instances doesn't have a public IP yet
+    return Node(id=instance['InstanceId'], name=minion_id, state=instance['State']['Name'],
+        public_ips=[], private_ips=[instance['PrivateIpAddress']],
+        driver=driver, created_at=instance['LaunchTime'], extra=None)
+
+
+def get_error_code(error):
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+def get_tag(instance, key):
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+@functools.lru_cache(maxsize=None)
 def get_host_public_ips():
+    public_ips = []
     for adapter in ifaddr.get_adapters():
         for ip in adapter.ips:
             string_ip = ip.ip[0] if isinstance(ip.ip, tuple) else ip.ip
             address = ipaddress.ip_address(string_ip)
             if address.is_global:
-                yield '%s/%s' % (string_ip, address.max_prefixlen)
+                public_ips.append('%s/%s' % (string_ip, address.max_prefixlen))
+    return tuple(public_ips)
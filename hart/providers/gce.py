@@ -1,12 +1,15 @@
 import hashlib
+import time
 
+from libcloud.compute.base import Node
 from libcloud.compute.providers import get_driver
-from libcloud.compute.types import Provider
+from libcloud.compute.types import NodeState, Provider
 
-from .base import NodeSize, Region
-from .libcloud import BaseLibcloudProvider
+from .base import cached_lookup, NodeSize, Region, ROLE_LABEL
+from .libcloud import BaseLibcloudProvider, get_private_method
 from ..constants import DEBIAN_VERSIONS
 from ..exceptions import UserError
+from ..utils import log_error
 
 # Haven't found a way to get pretty location names from the API yet, thus
 # hardcoding these where we know them
@@ -45,6 +48,16 @@ region_pretty_names = {
 class GCEProvider(BaseLibcloudProvider):
     alias = 'gce'
     default_size = 'n1-standard-1'
+    requests_per_second = 20
+    request_burst = 20
+    batch_minion_id_script = 'gce-minion-id.sh'
+    bulk_destroy = True
+    # The limit for a single metadata value
+    max_user_data_size = 256*1024
+    # The startup script is run by the guest agent instead of cloud-init
+    uses_cloud_init = False
+    init_log_command = ('journalctl --follow --lines=all --output=cat '
+        '--unit=google-startup-scripts.service')
 
     def __init__(self, user_id, key, project, region=None, **kwargs):
         constructor = get_driver(Provider.GCE)
@@ -52,6 +65,12 @@ class GCEProvider(BaseLibcloudProvider):
         self.region = region
 
 
+    def is_retryable_error(self, error):
+        if getattr(error, 'code', None) in ('rateLimitExceeded', 'userRateLimitExceeded'):
+            return True
+        return super().is_retryable_error(error)
+
+
     def get_sizes(self, **kwargs):
         sizes = []
         # TODO: Integrate with pricing API, these will be estimates based on 2020-01-31 Iowa pricing
@@ -135,6 +154,15 @@ class GCEProvider(BaseLibcloudProvider):
             'init script, or from salt)')
 
 
+    def prepare_create_node(self, region, debian_codename, size=None, **kwargs):
+        zone = kwargs.get('zone')
+        if zone:
+            self.get_machine_type(size or self.default_size, zone)
+            self.get_disk_type(kwargs.get('volume_type'), zone)
+        self.get_image(debian_codename)
+        self.get_subnet(region, kwargs.get('subnet'))
+
+
     def create_node(self,
             minion_id,
             region,
@@ -145,6 +173,20 @@ class GCEProvider(BaseLibcloudProvider):
             tags,
             size=None,
             **kwargs):
+        return self.create_nodes([minion_id], region, debian_codename, auth_key, cloud_init,
+            private_networking, tags, size, **kwargs)[0]
+
+
+    def create_nodes(self,
+            minion_ids,
+            region,
+            debian_codename,
+            auth_key,
+            cloud_init,
+            private_networking,
+            tags,
+            size=None,
+            **kwargs):
         if size is None:
             size = self.default_size
 
@@ -152,23 +194,11 @@ class GCEProvider(BaseLibcloudProvider):
         if not desired_zone:
             raise UserError('You must specify the GCE zone to launch in')
 
-        zone = self.driver.ex_get_zone(desired_zone)
-        if not zone:
-            raise UserError('Unknown zone %r' % desired_zone)
-
-        subnet_string = kwargs.get('subnet')
-        # The arm image looks like
-        # debian-<debian-numeric-version>-<debian-codename>-arm64-v20231010
-        # The x86-64 image looks like
-        # debian-<debian-numeric-version>-<debian-codename>-v20231010
-        # To avoid getting the wrong arch on the image we need to include enough
-        # of the prefix to identify the image uniquely
-        image = self.driver.ex_get_image('debian-%d-%s-v' % (
-            DEBIAN_VERSIONS[debian_codename], debian_codename))
-        volume_type = kwargs.get('volume_type')
-        disk_type = self.driver.ex_get_disktype(volume_type, zone=zone)
-        regional_subnets = self.driver.ex_list_subnetworks(region)
-        subnet = get_selected_or_default_subnet(regional_subnets, subnet_string)
+        zone = self.get_zone(desired_zone)
+        machine_type = self.get_machine_type(size, desired_zone)
+        image = self.get_image(debian_codename)
+        disk_type = self.get_disk_type(kwargs.get('volume_type'), desired_zone)
+        subnet = self.get_subnet(region, kwargs.get('subnet'))
         disks = [{
             'autoDelete': True,
             'boot': True,
@@ -198,54 +228,172 @@ class GCEProvider(BaseLibcloudProvider):
             "https://www.googleapis.com/auth/logging.write",
             "https://www.googleapis.com/auth/monitoring.write",
         ]
-        node = self.driver.create_node(
-            name=name_from_minion_id(minion_id),
-            size=size,
-            location=zone,
-            image=None, # Specified in the disk params
-            description=minion_id,
-            ex_tags=tags,
-            ex_network=subnet.network,
-            ex_subnetwork=subnet,
-            ex_metadata={
-                'sshKeys': auth_key,
-                'startup-script': cloud_init,
-                # We assume that if you manage servers with salt you want to use salt to
-                # manage ssh access, but we allow this to be overridden
-                'enable-oslogin': kwargs.get('enable_oslogin', False),
-            },
-            ex_labels=kwargs.get('labels'),
-            ex_disks_gce_struct=disks,
-            ex_service_accounts=[{"scopes": oauth_scopes}]
-        )
-        return node, None
-
-
-    def wait_for_init_script(self, client, extra=None):
-        # Creds to https://stackoverflow.com/a/14158100 for a way to get the pid
-        _, stdout, _ = client.exec_command(
-            'echo $$ && exec tail -f -n +1 /var/log/syslog')
-        tail_pid = int(stdout.readline())
-        for line in stdout:
-            print(line, end='')
-            if 'Script "startup-script" failed with error:' in line:
-                # Best effort attempt to detect script failure, not sure if this
-                # will always appear, but worst case we'll time out if it fails
-                # and we don't find a marker.
-                stdout.channel.close()
-                client.exec_command('kill %d' % tail_pid)
-                raise ValueError('Init script failed')
-
-            if 'hart-init-complete' in line:
-                stdout.channel.close()
-                client.exec_command('kill %d' % tail_pid)
-                break
+
+        # Send all the inserts before waiting for any of them, GCE creates the
+        # instances in parallel
+        operations = []
+        create_node_request = get_private_method(self.driver, '_create_node_req')
+        for minion_id in minion_ids:
+            request, node_data = create_node_request(
+                name_from_minion_id(minion_id),
+                machine_type,
+                None, # Specified in the disk params
+                zone,
+                network=subnet.network,
+                tags=tags,
+                metadata={
+                    'sshKeys': auth_key,
+                    'startup-script': cloud_init,
+                    # We assume that if you manage servers with salt you want to use salt to
+                    # manage ssh access, but we allow this to be overridden
+                    'enable-oslogin': kwargs.get('enable_oslogin', False),
+                },
+                description=minion_id,
+                ex_service_accounts=[{"scopes": oauth_scopes}],
+                ex_disks_gce_struct=disks,
+                ex_subnetwork=subnet,
+                ex_labels=kwargs.get('labels'),
+            )
+            operations.append(self.driver.connection.request(request, method='POST',
+                data=node_data).object)
+
+        finished_operations = self.wait_for_operations(operations)
+
+        nodes = []
+        errors = []
+        for minion_id, operation in zip(minion_ids, finished_operations):
+            if 'error' in operation:
+                errors.append('%s: %s' % (minion_id, format_operation_error(operation)))
+            else:
+                nodes.append((Node(
+                    id=operation['targetId'],
+                    name=name_from_minion_id(minion_id),
+                    state=NodeState.PENDING,
+                    public_ips=[],
+                    private_ips=[],
+                    driver=self.driver,
+                    extra={
+                        'zone': zone,
+                        'description': minion_id,
+                    },
+                ), None))
+
+        if errors:
+            if nodes:
+                log_error('Destroying the created nodes since not all could be created')
+                self.destroy_nodes(nodes)
+            raise ValueError('Failed to create nodes:\n%s' % '\n'.join(errors))
+
+        return nodes
+
+
+    def wait_for_operations(self, operations, timeout=300):
+        '''
+        Wait for all the operations to finish. Each round lists the pending
+        operations in each zone with a single request instead of polling every
+        operation. Returns the finished operations in the same order.
+        '''
+        operations = list(operations)
+        start_time = time.time()
+        while True:
+            # zone -> operation name -> index
+            pending = {}
+            for i, operation in enumerate(operations):
+                if operation['status'] != 'DONE':
+                    zone = operation['zone'].rsplit('/', 1)[-1]
+                    pending.setdefault(zone, {})[operation['name']] = i
+            if not pending:
+                return operations
+
+            if time.time() - start_time > timeout:
+                raise ValueError('Timed out waiting for %d GCE operations' % (
+                    sum(len(names) for names in pending.values())))
+
+            time.sleep(2)
+            for zone, indexes in pending.items():
+                for operation in self.list_zone_operations(zone, indexes):
+                    operations[indexes[operation['name']]] = operation
+
+
+    def list_zone_operations(self, zone, names):
+        '''Get the operations with the given names in the zone.'''
+        params = {
+            'filter': ' OR '.join('(name = "%s")' % name for name in names),
+            'maxResults': 500,
+        }
+        while True:
+            response = self.driver.connection.request('/zones/%s/operations' % zone,
+                params=params).object
+            yield from response.get('items', [])
+            if 'nextPageToken' not in response:
+                return
+            params = dict(params, pageToken=response['nextPageToken'])
+
+
+    @cached_lookup
+    def get_zone(self, zone_name):
+        zone = self.driver.ex_get_zone(zone_name)
+        if not zone:
+            raise UserError('Unknown zone %r' % zone_name)
+        return zone
+
+
+    @cached_lookup
+    def get_machine_type(self, size, zone_name):
+        return self.driver.ex_get_size(size, self.get_zone(zone_name))
+
+
+    @cached_lookup
+    def get_image(self, debian_codename):
+        # The arm image looks like
+        # debian-<debian-numeric-version>-<debian-codename>-arm64-v20231010
+        # The x86-64 image looks like
+        # debian-<debian-numeric-version>-<debian-codename>-v20231010
+        # To avoid getting the wrong arch on the image we need to include enough
+        # of the prefix to identify the image uniquely
+        return self.driver.ex_get_image('debian-%d-%s-v' % (
+            DEBIAN_VERSIONS[debian_codename], debian_codename))
+
+
+    @cached_lookup
+    def get_disk_type(self, volume_type, zone_name):
+        return self.driver.ex_get_disktype(volume_type, zone=self.get_zone(zone_name))
+
+
+    @cached_lookup
+    def get_subnet(self, region, subnet_string):
+        regional_subnets = self.driver.ex_list_subnetworks(region)
+        return get_selected_or_default_subnet(regional_subnets, subnet_string)
 
 
     def destroy_node(self, node, extra=None, **kwargs):
         self.driver.destroy_node(node, ex_sync=False)
 
 
+    def destroy_nodes(self, nodes):
+        # Deletes all the nodes at once and waits for them together
+        results = self.driver.ex_destroy_multiple_nodes([node for node, _ in nodes])
+        failed = [node.name for (node, _), destroyed in zip(nodes, results) if not destroyed]
+        if failed:
+            raise ValueError('Failed to destroy %s' % ', '.join(failed))
+
+
+    @classmethod
+    def add_role_marker(cls, arguments, role, warn=True):
+        labels = arguments.get('labels') or {}
+        labels[ROLE_LABEL] = role
+        arguments['labels'] = labels
+
+
+    def get_node_minion_id(self, node):
+        # The node name is derived from the minion id, but the full id is in the description
+        return node.extra.get('description') or node.name
+
+
+    def get_node_role(self, node):
+        return (node.extra.get('labels') or {}).get(ROLE_LABEL)
+
+
     def get_node(self, node):
         if isinstance(node, str):
             node = self.driver.ex_get_node(name_from_minion_id(node))
@@ -268,6 +416,11 @@ def name_from_minion_id(minion_id):
     return 'hart-%s-%s' % (sanitized_name[:47], hashed_id[:6])
 
 
+def format_operation_error(operation):
+    return ', '.join(error.get('message', error.get('code', 'Unknown error'))
+        for error in operation['error'].get('errors', []))
+
+
 def get_selected_or_default_subnet(subnets, subnet_string):
     if not subnets:
         raise UserError('No subnets available in the given region')
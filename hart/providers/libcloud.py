@@ -1,11 +1,46 @@
+
+import requests
+from libcloud.common.exceptions import BaseHTTPError
+from libcloud.common.types import ProviderError
 from libcloud.compute.base import NodeAuthSSHKey
 
-from .base import BaseProvider, Region
+from .base import BaseProvider, cached_lookup, ListedNode, Region
 from ..exceptions import UserError
 
 
+# Status codes indicating we're being throttled, which are safe to retry also
+# for calls that create resources
+THROTTLED_STATUS_CODES = (429,)
+
+# Status codes indicating that the provider had a temporary failure. These
+# might happen after a resource was created, thus are only retried for calls
+# that don't create anything.
+RETRYABLE_STATUS_CODES = THROTTLED_STATUS_CODES + (500, 502, 503, 504)
+
+
 class BaseLibcloudProvider(BaseProvider):
-    driver = None
+    _driver = None
+
+    @property
+    def driver(self):
+        return self._driver
+
+
+    @driver.setter
+    def driver(self, driver):
+        self._driver = self.throttle(driver, nested=('connection',))
+
+
+    def is_retryable_error(self, error):
+        return (get_status_code(error) in RETRYABLE_STATUS_CODES
+            or isinstance(error, requests.exceptions.ConnectionError))
+
+
+    def is_retryable_create_error(self, error):
+        # Timing out while connecting means the request was never sent
+        return (get_status_code(error) in THROTTLED_STATUS_CODES
+            or isinstance(error, requests.exceptions.ConnectTimeout))
+
 
     def create_remote_ssh_key(self, key_name, ssh_key, public_key):
         '''Return a tuple of (remote_key, auth_key)'''
@@ -18,6 +53,12 @@ class BaseLibcloudProvider(BaseProvider):
         self.driver.delete_key_pair(remote_key)
 
 
+    def prepare_create_node(self, region, debian_codename, size=None, **kwargs):
+        self.get_size(size or self.default_size)
+        self.get_location(region)
+
+
+    @cached_lookup
     def get_size(self, size_name):
         sizes = self.driver.list_sizes()
         for size in sizes:
@@ -27,6 +68,7 @@ class BaseLibcloudProvider(BaseProvider):
         raise UserError('Unknown size: %s' % size_name)
 
 
+    @cached_lookup
     def get_location(self, location_id):
         for location in self.driver.list_locations():
             if location_id in (location.name, location.id):
@@ -50,9 +92,57 @@ class BaseLibcloudProvider(BaseProvider):
             node_id, self.__class__.__name__))
 
 
+    def get_nodes(self, nodes):
+        # Nodes are matched by name like in get_node, since the ID isn't
+        # always known right after creation
+        node_ids = {node.name: node.id for node in nodes}
+        updated_nodes = {}
+        for node in self.driver.list_nodes():
+            if node.name in node_ids:
+                updated_nodes[node_ids[node.name]] = node
+        return updated_nodes
+
+
+    def list_nodes(self):
+        nodes = []
+        for node in self.driver.list_nodes():
+            nodes.append(ListedNode(self.get_node_minion_id(node), self.get_node_role(node), node))
+        return nodes
+
+
+    def get_node_minion_id(self, node): # pylint: disable=no-self-use
+        return node.name
+
+
+    def get_node_role(self, node): # pylint: disable=no-self-use,unused-argument
+        return None
+
+
     def get_regions(self, **kwargs):
         regions = []
         for location in self.driver.list_locations():
             regions.append(Region(location.id, location.name))
         regions.sort(key=lambda r: r.name)
         return regions
+
+
+def get_status_code(error):
+    if isinstance(error, BaseHTTPError):
+        return error.code
+    if isinstance(error, ProviderError):
+        return error.http_code
+    return None
+
+
+def get_private_method(driver, name):
+    '''
+    Get a private method from a libcloud driver, for functionality libcloud
+    doesn't expose publicly. These might change between libcloud versions,
+    thus fail with a clear error if it's missing.
+    '''
+    method = getattr(driver, name, None)
+    if method is None:
+        raise ValueError('The installed libcloud version does not have %s.%s, which hart '
+            'depends on. Install a libcloud version supported by hart.' % (
+                type(getattr(driver, '_client', driver)).__name__, name))
+    return method
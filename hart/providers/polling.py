@@ -0,0 +1,107 @@
+import threading
+import time
+
+from ..utils import log_warning
+
+
+class NodePoller:
+    '''
+    Polls the status of all the nodes being waited for with a single API call
+    per tick, and hands the updated nodes out to the waiting threads.
+
+    `get_nodes` is called with a list of nodes and should return a dict of
+    node id -> updated node. Nodes missing from the result are assumed to not
+    be visible in the API yet and are polled again on the next tick.
+
+    A failed poll is retried on the next tick, the waiters only fail if
+    `max_failures` polls in a row have failed.
+    '''
+
+    def __init__(self, get_nodes, interval=2, max_failures=3):
+        self.interval = interval
+        self.max_failures = max_failures
+        self._get_nodes = get_nodes
+        self._condition = threading.Condition()
+        # node id -> (node, number of waiters)
+        self._waiting = {}
+        self._nodes = {}
+        self._error = None
+        self._failures = 0
+        self._generation = 0
+        self._thread = None
+
+
+    def wait_for(self, node, predicate, timeout):
+        '''
+        Block until the updated node satisfies `predicate`, and return it.
+        Returns None if the timeout is reached first.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._add_waiter(node)
+            try:
+                while True:
+                    generation = self._generation
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._condition.wait_for(
+                            lambda: self._generation != generation, remaining):
+                        return None
+
+                    if self._error is not None:
+                        raise self._error
+
+                    updated_node = self._nodes.get(node.id)
+                    if updated_node is not None and predicate(updated_node):
+                        return updated_node
+            finally:
+                self._remove_waiter(node)
+
+
+    def _add_waiter(self, node):
+        _, waiters = self._waiting.get(node.id, (node, 0))
+        self._waiting[node.id] = (node, waiters + 1)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                name='node-poller')
+            self._thread.start()
+
+
+    def _remove_waiter(self, node):
+        _, waiters = self._waiting[node.id]
+        if waiters == 1:
+            del self._waiting[node.id]
+            self._nodes.pop(node.id, None)
+        else:
+            self._waiting[node.id] = (node, waiters - 1)
+
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._condition:
+                if not self._waiting:
+                    # Stop, a new thread is started by the next waiter
+                    self._thread = None
+                    return
+                nodes = [node for node, _ in self._waiting.values()]
+
+            try:
+                updated_nodes = self._get_nodes(nodes)
+                error = None
+            except Exception as e: # pylint: disable=broad-except
+                updated_nodes = {}
+                error = e
+
+            with self._condition:
+                self._nodes.update(updated_nodes)
+                if error is None:
+                    self._failures = 0
+                    self._error = None
+                else:
+                    self._failures += 1
+                    if self._failures >= self.max_failures:
+                        self._error = error
+                    else:
+                        log_warning('Failed to poll the nodes, trying again: %s' % error)
+                self._generation += 1
+                self._condition.notify_all()
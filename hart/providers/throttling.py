@@ -0,0 +1,81 @@
+import functools
+import random
+import threading
+import time
+
+from ..scheduler import TokenBucket
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+class ThrottledClient:
+    '''
+    Proxy for an API client that passes all method calls through `call`, which
+    is expected to rate limit and retry them.
+
+    Attributes listed in `nested` are wrapped the same way, for clients that
+    expose parts of the API on other objects (like libcloud's `connection`).
+    '''
+
+    def __init__(self, client, call, nested=()):
+        self._client = client
+        self._call = call
+        self._nested = nested
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self._nested:
+            return ThrottledClient(attr, self._call)
+
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def throttled(*args, **kwargs):
+            return self._call(attr, *args, **kwargs)
+        return throttled
+
+
+    def __repr__(self):
+        return '<ThrottledClient %r>' % self._client
+
+
+def get_rate_limiter(key, rate, burst):
+    '''
+    Get the rate limiter for the given key, creating it if needed. This enables
+    all providers sharing the same API limits to share the rate limiter.
+    '''
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(key)
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(rate, burst)
+            _rate_limiters[key] = rate_limiter
+        return rate_limiter
+
+
+def call_with_retries(func, is_retryable, max_retries, rate_limiter=None,
+        base_delay=0.5, max_delay=30):
+    '''
+    Call func until it succeeds, retrying with exponential backoff and jitter
+    as long as it raises errors that `is_retryable` returns True for.
+    '''
+    attempt = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire()
+
+        try:
+            return func()
+        except Exception as error: # pylint: disable=broad-except
+            if attempt >= max_retries or not is_retryable(error):
+                raise
+
+            # Jitter the delay to prevent parallel requests from retrying in lockstep
+            delay = min(max_delay, base_delay * 2**attempt)
+            delay = delay/2 + random.uniform(0, delay/2)
+            attempt += 1
+            print('API call failed, retrying in %.1fs (%s)' % (delay, error))
+            time.sleep(delay)
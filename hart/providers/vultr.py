@@ -1,5 +1,8 @@
 import datetime
+import hashlib
 import json
+import shlex
+import threading
 import time
 import subprocess
 
@@ -7,19 +10,66 @@ from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider, NodeState
 from libcloud.utils.py3 import httplib
 
-from .base import NodeSize
+from .base import cached_lookup, NodeSize, ROLE_LABEL
 from .libcloud import BaseLibcloudProvider
 from ..constants import DEBIAN_VERSIONS
 from ..exceptions import UserError
+from ..ssh import ssh_run_command
+from ..utils import log_error, log_warning
+
+
+# The ssh keys being deleted in the background, see VultrProvider.destroy_remote_ssh_key
+_key_cleanup_threads = []
+# (remote key, error) for the keys that couldn't be deleted
+_key_cleanup_errors = []
+_key_cleanup_lock = threading.Lock()
+
+
+def wait_for_ssh_key_cleanup():
+    '''
+    Wait for the ssh keys being deleted in the background to be deleted, and
+    log the keys that couldn't be deleted. Returns whether all keys were deleted.
+    '''
+    while True:
+        with _key_cleanup_lock:
+            if not _key_cleanup_threads:
+                break
+            thread = _key_cleanup_threads.pop()
+        thread.join()
+
+    with _key_cleanup_lock:
+        errors = list(_key_cleanup_errors)
+        _key_cleanup_errors.clear()
+
+    for remote_key, error in errors:
+        log_error('Failed to delete the ssh key %s (id %s) from Vultr, delete it manually: %s' % (
+            remote_key.name, remote_key.id, error))
+    return not errors
 
 
 class VultrProvider(BaseLibcloudProvider):
     alias = 'vultr'
     default_size = '201'
+    requests_per_second = 2
+    request_burst = 2
+    batch_minion_id_script = 'vultr-minion-id.sh'
 
     def __init__(self, token, **kwargs):
         constructor = get_driver(Provider.VULTR)
         self.driver = constructor(token)
+        # Hash of the script content -> startup script id
+        self._startup_scripts = {}
+        # Startup script id -> how many nodes are still using it
+        self._startup_script_users = {}
+        self._startup_scripts_lock = threading.Lock()
+        # ssh key id -> nodes created with the key
+        self._key_users = {}
+        self._key_users_lock = threading.Lock()
+
+
+    def prepare_create_node(self, region, debian_codename, size=None, **kwargs):
+        super().prepare_create_node(region, debian_codename, size, **kwargs)
+        self.get_image(debian_codename)
 
 
     def create_node(self,
@@ -32,61 +82,124 @@ class VultrProvider(BaseLibcloudProvider):
             tags,
             size=None,
             **kwargs):
+        return self.create_nodes([minion_id], region, debian_codename, auth_key, cloud_init,
+            private_networking, tags, size, **kwargs)[0]
+
+
+    def create_nodes(self,
+            minion_ids,
+            region,
+            debian_codename,
+            auth_key,
+            cloud_init,
+            private_networking,
+            tags,
+            size=None,
+            **kwargs):
         if size is None:
             size = self.default_size
 
         size = self.get_size(size)
         image = self.get_image(debian_codename)
         location = self.get_location(region)
-        # Vultr has replaced cloud-init with their own startup script
-        # implementation. This doesn't seem to be reflected in their docs,
-        # but a comment here indicates as much:
-        # https://discuss.vultr.com/discussion/582/cloud-init-user-data-testing/p3
-        script_id = self.create_temp_startup_script(minion_id, cloud_init)
-        node_extra = {
-            'script_id': script_id,
-            'private_networking': private_networking,
-            'debian_codename': debian_codename,
-        }
         tag = None
         if len(tags) > 1:
             raise UserError('Can only set a single tag on vultr')
         elif tags:
             tag = tags[0]
 
-        node = self.driver.create_node(minion_id, size, image, location, ex_ssh_key_ids=[
-            auth_key.id
-        ], ex_create_attr={
-            'script_id': script_id,
-            'notify_activate': False,
-            'enable_private_network': 'yes' if private_networking else 'no',
-            'hostname': minion_id,
-            'tag': tag,
-        })
-        # Vultr has a race condition where if the ssh key is deleted too early,
-        # ie before the node has read it on startup, it won't be available to
-        # use for logging in. Thus we delay the return here until the node state
-        # indicates it's ready to continue.
-        start_time = time.time()
-        while time.time() - start_time < 180:
-            print('Waiting for node to boot (%s)' % node.state)
-            time.sleep(2)
-            node = self.get_node(node)
-            if node.state != NodeState.PENDING:
-                print('Node in state %s, continuing' % node.state)
-                break
-        else:
-            # Can't auto-destroy since the API doesn't enable destroying nodes
-            # before they are initialized
-            raise ValueError('Failed to start node before timeout')
+        # Vultr has replaced cloud-init with their own startup script
+        # implementation. This doesn't seem to be reflected in their docs,
+        # but a comment here indicates as much:
+        # https://discuss.vultr.com/discussion/582/cloud-init-user-data-testing/p3
+        script_id = self.acquire_startup_script(cloud_init, len(minion_ids))
+        nodes = []
+        try:
+            for minion_id in minion_ids:
+                node = self.driver.create_node(minion_id, size, image, location, ex_ssh_key_ids=[
+                    auth_key.id
+                ], ex_create_attr={
+                    'script_id': script_id,
+                    'notify_activate': False,
+                    'enable_private_network': 'yes' if private_networking else 'no',
+                    'hostname': minion_id,
+                    'tag': tag,
+                })
+                nodes.append((node, {
+                    'script_id': script_id,
+                    'private_networking': private_networking,
+                    'debian_codename': debian_codename,
+                }))
+        except:
+            self.release_startup_script(script_id, len(minion_ids) - len(nodes))
+            if nodes:
+                log_error('Destroying the created nodes since not all could be created')
+                self.destroy_nodes(nodes)
+            raise
+
+        # The key can't be deleted until these have booted, see destroy_remote_ssh_key
+        with self._key_users_lock:
+            self._key_users.setdefault(auth_key.id, []).extend(node for node, _ in nodes)
+
+        return nodes
+
+
+    @classmethod
+    def add_role_marker(cls, arguments, role, warn=True):
+        # Vultr only supports a single tag, thus only mark the role if no
+        # other tag is used
+        if not arguments.get('tags'):
+            arguments['tags'] = ['%s:%s' % (ROLE_LABEL, role)]
+        elif warn:
+            log_warning('Vultr only supports a single tag, thus the node is not marked with '
+                'the role %r. hart plan and apply will not find it as part of the role.' % role)
+
+
+    def get_node_role(self, node):
+        tag = node.extra.get('tag') or ''
+        prefix = '%s:' % ROLE_LABEL
+        return tag[len(prefix):] if tag.startswith(prefix) else None
+
+
+    def acquire_startup_script(self, cloud_init, node_count=1):
+        '''
+        Get a startup script with the given content, creating it if needed.
+        Scripts are shared by all nodes using the same content, and deleted
+        when the last node has released it.
+        '''
+        script_hash = hashlib.sha256(cloud_init.encode('utf-8')).hexdigest()
+        with self._startup_scripts_lock:
+            script_id = self._startup_scripts.get(script_hash)
+            if script_id is None:
+                script_id = self.create_temp_startup_script(script_hash, cloud_init)
+                self._startup_scripts[script_hash] = script_id
+                self._startup_script_users[script_id] = 0
+            self._startup_script_users[script_id] += node_count
+            return script_id
+
+
+    def release_startup_script(self, script_id, node_count=1):
+        with self._startup_scripts_lock:
+            remaining_users = self._startup_script_users.pop(script_id, node_count) - node_count
+            if remaining_users > 0:
+                self._startup_script_users[script_id] = remaining_users
+                return
 
-        return node, node_extra
+            for script_hash, shared_script_id in list(self._startup_scripts.items()):
+                if shared_script_id == script_id:
+                    del self._startup_scripts[script_hash]
+
+        print('Deleting start up script with id %d' % script_id)
+        params = {'SCRIPTID': script_id}
+        result = self.driver.connection.post('/v1/startupscript/destroy', params)
+        if result.status != httplib.OK:
+            print('Failed to delete temp startupscript %s' % script_id)
 
 
-    def create_temp_startup_script(self, minion_id, cloud_init):
+    def create_temp_startup_script(self, script_hash, cloud_init):
         current_date = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%S')
         params = {
-            'name': 'temp-script-for-%s-%s' % (minion_id, current_date),
+            'name': 'hart-temp-script-%s-%s' % (script_hash[:16], current_date),
             'script': cloud_init,
         }
 
@@ -106,13 +219,7 @@ class VultrProvider(BaseLibcloudProvider):
 
         script_id = node_extra['script_id']
         node_extra['script_id'] = None
-
-        print('Start up script with id %d' % script_id)
-
-        params = {'SCRIPTID': script_id}
-        result = self.driver.connection.post('/v1/startupscript/destroy', params)
-        if result.status != httplib.OK:
-            print('Failed to delete temp startupscript %s' % script_id)
+        self.release_startup_script(script_id)
 
 
     def create_remote_ssh_key(self, key_name, ssh_key, public_key):
@@ -129,6 +236,53 @@ class VultrProvider(BaseLibcloudProvider):
         return key_pair, key_pair
 
 
+    def destroy_remote_ssh_key(self, remote_key):
+        # Vultr has a race condition where if the ssh key is deleted too early,
+        # ie before the node has read it on startup, it won't be available to
+        # use for logging in. Thus delete the key in the background when all
+        # the nodes using it have booted, to not block connecting to them.
+        with self._key_users_lock:
+            nodes = self._key_users.pop(remote_key.id, [])
+
+        # Not a daemon thread on purpose, and joined by wait_for_ssh_key_cleanup
+        # before hart exits, since exiting earlier would leave the key behind
+        thread = threading.Thread(target=self._destroy_ssh_key_in_background,
+            args=(remote_key, nodes), name='vultr-key-cleanup')
+        with _key_cleanup_lock:
+            _key_cleanup_threads.append(thread)
+        thread.start()
+
+
+    def _destroy_ssh_key_in_background(self, remote_key, nodes):
+        try:
+            self.destroy_ssh_key_after_boot(remote_key, nodes)
+        except Exception as error: # pylint: disable=broad-except
+            with _key_cleanup_lock:
+                _key_cleanup_errors.append((remote_key, error))
+
+
+    def destroy_ssh_key_after_boot(self, remote_key, nodes, timeout=180):
+        for node in nodes:
+            if is_booted(node):
+                continue
+
+            try:
+                booted_node = self.node_poller.wait_for(node, is_booted, timeout)
+            except Exception as error: # pylint: disable=broad-except
+                # Still delete the key, it's worse to leave it on the account
+                log_warning('Failed to wait for node %s to boot, deleting the ssh key anyway: %s'
+                    % (node.name, error))
+                break
+
+            if booted_node is None:
+                log_warning('Node %s did not boot in time, deleting the ssh key anyway' % (
+                    node.name))
+
+        super().destroy_remote_ssh_key(remote_key)
+        print('Destroyed ssh key %s' % remote_key.name)
+
+
+    @cached_lookup
     def get_image(self, debian_codename):
         for image in self.driver.list_images():
             if (image.extra['family'] == 'debian'
@@ -169,17 +323,10 @@ class VultrProvider(BaseLibcloudProvider):
             super().wait_for_init_script(client, node_extra)
             return
 
-        # Creds to https://stackoverflow.com/a/14158100 for a way to get the pid
-        _, stdout, stderr = client.exec_command('echo $$ && exec tail -f /var/log/firstboot.log')
-        tail_pid = int(stdout.readline())
-        for line in stdout:
-            print(line, end='')
-            if line.startswith('hart-init-complete'):
-                stdout.channel.close()
-                client.exec_command('kill %d' % tail_pid)
-                return
-
-        raise ValueError('Failed to complete init script: %s' % ''.join(stderr).strip())
+        # The older images run the startup script outside of cloud-init and log
+        # it to a custom location, but it writes the same status file
+        self.follow_init_script(client, 'tail -f -n +1 /var/log/firstboot.log',
+            check_cloud_init=False)
 
 
     def get_sizes(self, **kwargs):
@@ -198,7 +345,7 @@ class VultrProvider(BaseLibcloudProvider):
         return sizes
 
 
-    def post_connect(self, hart_node):
+    def post_connect(self, hart_node, client=None):
         if not hart_node.node_extra['private_networking']:
             return
 
@@ -219,11 +366,19 @@ class VultrProvider(BaseLibcloudProvider):
             raise ValueError("Couldn't find private network attached to server")
 
         interface = 'ens7'
+        if client is not None:
+            add_private_ip_over_ssh(client, interface, ip, netmask)
+            return
+
         enable_network_interfaces_d(hart_node.minion_id)
         add_ip_to_device(hart_node.minion_id, 'private', interface, ip, netmask)
         bring_up_interface_with_label(hart_node.minion_id, interface)
 
 
+def is_booted(node):
+    return node.state != NodeState.PENDING
+
+
 def add_ip(minion_id, current_device_ip, ip, netmask, ip_kind):
     '''
     :param minion_id: The minion id
@@ -301,6 +456,17 @@ def add_ip_to_device(minion_id, ip_kind, label, ip, netmask):
     '''
     :param ip_kind: What kind of IP this is. Either 'reserved' or 'private'.
     '''
+    lines = get_interface_config(ip_kind, label, ip, netmask)
+    subprocess.run([
+        'salt',
+        minion_id,
+        'file.write',
+        '/etc/network/interfaces.d/20-hart-%s-ip' % ip_kind,
+        'args=[%s]' % ', '.join("'%s'" % line for line in lines),
+    ], check=True)
+
+
+def get_interface_config(ip_kind, label, ip, netmask):
     mtu = 1450 if ip_kind == 'private' else None
     lines = [
         'auto %s' % label,
@@ -310,14 +476,25 @@ def add_ip_to_device(minion_id, ip_kind, label, ip, netmask):
     ]
     if mtu:
         lines.append('mtu %d' % mtu)
+    return lines
 
-    subprocess.run([
-        'salt',
-        minion_id,
-        'file.write',
-        '/etc/network/interfaces.d/20-hart-%s-ip' % ip_kind,
-        'args=[%s]' % ', '.join("'%s'" % line for line in lines),
-    ], check=True)
+
+def add_private_ip_over_ssh(client, label, ip, netmask):
+    '''
+    Does the same as `enable_network_interfaces_d`, `add_ip_to_device` and
+    `bring_up_interface_with_label` for a private IP, but over an open ssh
+    connection to the node instead of through salt.
+    '''
+    lines = get_interface_config('private', label, ip, netmask)
+    ssh_run_command(client, ' && '.join([
+        "sed -i 's|^#source /etc/network/interfaces.d/\\*$|source /etc/network/interfaces.d/*|' "
+            "/etc/network/interfaces",
+        "(grep -qxF 'source /etc/network/interfaces.d/*' /etc/network/interfaces "
+            "|| echo 'source /etc/network/interfaces.d/*' >> /etc/network/interfaces)",
+        "printf '%%s\\n' %s > /etc/network/interfaces.d/20-hart-private-ip" % ' '.join(
+            shlex.quote(line) for line in lines),
+        'ifup %s' % label,
+    ]), timeout=60)
 
 
 def bring_up_interface_with_label(minion_id, label):
@@ -1,59 +1,234 @@
 import binascii
+import copy
 import datetime
 import os
+import types
+from collections import namedtuple
 
 from .config import load_config, build_provider_from_config
 from .exceptions import UserError
+from .providers import provider_map
 
 DEFAULT_MINION_NAMING_SCHEME = '{unique_id}.{region}.{provider}.{role}'
 
-def get_provider_for_role(config_file, role, region):
-    config = load_config(config_file)
+# Parameters that are tables in the config file themselves, and thus can't be
+# confused with a region table under a provider
+TABLE_PARAMETERS = ('minion_config', 'labels', 'tags', 'grains')
+
+CompiledRole = namedtuple('CompiledRole', 'role provider region parameters')
+
+
+class RoleIndex:
+    '''
+    Index of fully merged role parameters.
+
+    The config for each role is layered hart -> role -> provider -> region once
+    when the index is built for the providers the role declares, lookups after
+    that doesn't do any merging. Roles are only compiled for other providers
+    when looked up.
+
+    The index and the top level of the parameters are read-only. The nested
+    tables are copies owned by each compiled role, callers that need to modify
+    them must copy them first, like `build_minion_arguments` does.
+    '''
+
+    def __init__(self, compiled_roles, default_providers, declared_targets, core_config,
+            role_configs):
+        self._compiled_roles = types.MappingProxyType(compiled_roles)
+        self._default_providers = types.MappingProxyType(default_providers)
+        self._declared_targets = frozenset(declared_targets)
+        self._core_config = core_config
+        self._role_configs = types.MappingProxyType(role_configs)
+
+
+    @property
+    def roles(self):
+        return sorted(self._default_providers)
+
+
+    def targets(self, role=None):
+        '''Return the compiled roles for all provider and regions declared in the config.'''
+        targets = []
+        for key in self._declared_targets:
+            if role is None or key[0] == role:
+                targets.append(self._compiled_roles[key])
+        targets.sort(key=lambda t: (t.role, t.provider, t.region or ''))
+        return targets
+
+
+    def get(self, role, provider_alias=None, region=None):
+        if role not in self._default_providers:
+            raise_unknown_role(self._default_providers, role)
+
+        if provider_alias is None:
+            provider_alias = self._default_providers[role]
+            if provider_alias is None:
+                raise UserError('No provider specified for role %r' % role)
+
+        base = self._compiled_roles.get((role, provider_alias, None))
+        if base is None:
+            if provider_alias not in provider_map:
+                raise UserError('Unknown provider %r' % provider_alias)
+            # The role doesn't declare the provider, thus there's no provider
+            # specific config to look up
+            base = compile_role(self._core_config, role, self._role_configs[role],
+                provider_alias)
+
+        if region is None:
+            region = base.region
+            if region is None:
+                return base
+
+        compiled_role = self._compiled_roles.get((role, provider_alias, region))
+        if compiled_role is None:
+            # No config specific to this region, thus only the region differs
+            # from the provider defaults
+            compiled_role = base._replace(region=region)
+        return compiled_role
+
+
+    def get_minion_arguments(self, role, provider, region=None, cli_kwargs=None):
+        compiled_role = self.get(role, provider.alias, region)
+        return build_minion_arguments(compiled_role, provider, cli_kwargs)
+
+
+    def validate(self):
+        '''Raise a UserError listing every declared role that would fail to build.'''
+        errors = []
+        for compiled_role in self.targets():
+            try:
+                validate_compiled_role(compiled_role)
+            except UserError as error:
+                errors.append('%s (%s, %s): %s' % (compiled_role.role, compiled_role.provider,
+                    compiled_role.region, error))
+
+        if errors:
+            raise UserError('Invalid role config:\n%s' % '\n'.join(errors))
+
+
+def compile_roles(config, roles=None):
+    '''
+    Build a RoleIndex of all the roles in the given config, or only the given
+    roles, for callers that only need to look up a single role.
+    '''
     core_config = config.get('hart', {})
-    role_config = get_role_config(config, role)
+    compiled_roles = {}
+    default_providers = {}
+    declared_targets = set()
+    role_configs = config.get('roles', {})
+    if roles is not None:
+        for role in roles:
+            if role not in role_configs:
+                raise_unknown_role(role_configs, role)
+        role_configs = {role: role_configs[role] for role in roles}
+
+    for role, role_config in role_configs.items():
+        # The provider set for hart takes precedence over the one for the role
+        default_provider = core_config.get('provider', role_config.get('provider'))
+        default_providers[role] = default_provider
+
+        for provider_alias in provider_map:
+            if provider_alias != default_provider and provider_alias not in role_config:
+                continue
+
+            base = compile_role(core_config, role, role_config, provider_alias)
+            compiled_roles[(role, provider_alias, None)] = base
+            regions = list(get_region_tables(role_config.get(provider_alias, {})))
+            if base.region is None:
+                # The region will have to be given on the cli
+                declared_targets.add((role, provider_alias, None))
+            elif base.region not in regions:
+                regions.append(base.region)
+
+            for region in regions:
+                compiled_roles[(role, provider_alias, region)] = compile_role(core_config,
+                    role, role_config, provider_alias, region)
+                declared_targets.add((role, provider_alias, region))
+
+    return RoleIndex(compiled_roles, default_providers, declared_targets, core_config,
+        role_configs)
+
+
+def compile_role(core_config, role, role_config, provider_alias, region=None):
+    provider_config = role_config.get(provider_alias, {})
+    region_tables = get_region_tables(provider_config)
 
     merged_config = {}
     merged_config.update(core_config)
+    merged_config.update({key: val for key, val in role_config.items()
+        if key not in provider_map})
+    merged_config.update({key: val for key, val in provider_config.items()
+        if key not in region_tables})
 
+    default_region = merged_config.pop('region', None)
     if region is None:
-        region = merged_config.pop('region', None)
+        region = default_region
 
-    provider_alias = merged_config.pop('provider', role_config.pop('provider', None))
-    return build_provider_from_config(provider_alias, config, region=region)
+    merged_config.update(region_tables.get(region, {}))
+    merged_config.pop('region', None)
+    merged_config.pop('provider', None)
 
+    # The loaded config is shared between all the compiled roles, copy it to
+    # make sure they can't modify each other
+    parameters = types.MappingProxyType(copy.deepcopy(merged_config))
+    return CompiledRole(role, provider_alias, region, parameters)
 
-def get_minion_arguments_for_role(config_file, role, provider=None, region=None, cli_kwargs=None):
-    if cli_kwargs is None:
-        cli_kwargs = {}
 
+def get_region_tables(provider_config):
+    return {key: val for key, val in provider_config.items()
+        if isinstance(val, dict) and key not in TABLE_PARAMETERS}
+
+
+def validate_compiled_role(compiled_role):
+    if compiled_role.region is None:
+        # The region can be given on the cli, thus we can only check the rest
+        compiled_role = compiled_role._replace(region='<region>')
+    provider = provider_map[compiled_role.provider]
+    build_minion_arguments(compiled_role, provider, warn=False)
+
+
+def get_provider_for_role(config_file, role, region):
     config = load_config(config_file)
-    core_config = config.get('hart', {})
-    role_config = get_role_config(config, role)
+    compiled_role = compile_roles(config, [role]).get(role, region=region)
+    return build_provider_from_config(compiled_role.provider, config, region=compiled_role.region)
 
-    merged_config = {}
-    merged_config.update(core_config)
+
+def get_minion_arguments_for_role(config_file, role, provider=None, region=None, cli_kwargs=None):
+    if cli_kwargs is None:
+        cli_kwargs = {}
 
     if region is None:
-        region = merged_config.pop('region', None)
+        region = cli_kwargs.get('region')
 
-    provider_alias = merged_config.pop('provider', role_config.pop('provider', None))
+    config = load_config(config_file)
+    index = compile_roles(config, [role])
+    compiled_role = index.get(role, provider.alias if provider else None, region)
     if provider is None:
-        provider = build_provider_from_config(provider_alias, config, region=region)
+        provider = build_provider_from_config(compiled_role.provider, config,
+            region=compiled_role.region)
+
+    return build_minion_arguments(compiled_role, provider, cli_kwargs)
+
 
-    provider_config = role_config.pop(provider.alias, {})
-    merged_config.update(role_config)
+def build_minion_arguments(compiled_role, provider, cli_kwargs=None, warn=True):
+    '''
+    Build the kwargs to `create_minion` from a compiled role.
 
-    region_config = provider_config.pop(region, {})
-    merged_config.update(provider_config)
-    merged_config.update(region_config)
-    merged_config.update(cli_kwargs)
+    The provider can be either a provider instance or class, only the alias and
+    default size is used.
 
-    # We might not know the region until getting the provider config, thus try
-    # to get it again
+    :param warn: Whether to warn about the node not being possible to find
+        again as part of the role. Turn off when no node will be created.
+    '''
+    role = compiled_role.role
+    region = compiled_role.region
     if region is None:
-        region = merged_config.pop('region')
-    else:
-        merged_config.pop('region', None)
+        raise UserError('No region specified for role %r' % role)
+
+    merged_config = copy.deepcopy(dict(compiled_role.parameters))
+    if cli_kwargs:
+        merged_config.update(cli_kwargs)
+    merged_config.pop('region', None)
 
     size = merged_config.setdefault('size', provider.default_size)
 
@@ -97,24 +272,16 @@ def get_minion_arguments_for_role(config_file, role, provider=None, region=None,
     merged_config['region'] = region
     merged_config['minion_config'] = default_minion_config
 
-    if provider.alias == 'gce':
-        merged_config.setdefault('labels', {}).update({
-            'hart-role': role,
-        })
+    provider.add_role_marker(merged_config, role, warn)
 
     return merged_config
 
 
-def get_role_config(config, role):
-    roles = config.get('roles', {})
-    role_config = roles.get(role)
-    if role_config is None:
-        if roles:
-            raise UserError('Unknown role %r, must be one of %s' % (
-                role, ', '.join(repr(r) for r in config.get('roles', {}))))
-        else:
-            raise UserError('Unknown role %r, no roles defined in config' % role)
-    return role_config
+def raise_unknown_role(roles, role):
+    if roles:
+        raise UserError('Unknown role %r, must be one of %s' % (
+            role, ', '.join(repr(r) for r in roles)))
+    raise UserError('Unknown role %r, no roles defined in config' % role)
 
 
 def build_minion_id(naming_scheme, **kwargs):
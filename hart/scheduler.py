@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .utils import log_error
+
+
+TaskResult = namedtuple('TaskResult', 'value error')
+
+
+class DependencyFailed(Exception):
+    '''Set as the error for tasks that were skipped since a dependency failed.'''
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket allowing `rate` operations per second on average,
+    with bursts of up to `burst` operations.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                    self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class Scheduler:
+    '''
+    Runs tasks in parallel in dependency order.
+
+    Tasks can be put in a group to limit how many tasks from the group can run
+    at the same time, and how often tasks in the group can be started. This is
+    used to stay within the limits of each provider. Tasks added with
+    `rate_limited=False` only count towards the concurrency of their group.
+    '''
+
+    def __init__(self, max_workers=20, log_errors=True):
+        self.max_workers = max_workers
+        self.log_errors = log_errors
+        self._tasks = {}
+        self._group_limits = {}
+
+
+    def set_group_limits(self, group, concurrency=None, rate=None, burst=1):
+        '''
+        :param concurrency: How many tasks in the group can run at the same time.
+        :param rate: How many tasks in the group can be started per second.
+        '''
+        bucket = TokenBucket(rate, burst) if rate else None
+        self._group_limits[group] = (concurrency, bucket)
+
+
+    def add(self, name, func, dependencies=(), group=None, rate_limited=True):
+        if name in self._tasks:
+            raise ValueError('Duplicate task %r' % name)
+        for dependency in dependencies:
+            if dependency not in self._tasks:
+                raise ValueError('Task %r depends on unknown task %r' % (name, dependency))
+        self._tasks[name] = (func, tuple(dependencies), group, rate_limited)
+        return name
+
+
+    def run(self):
+        '''Run all the tasks and return a dict of task name -> TaskResult.'''
+        results = {}
+        pending = list(self._tasks)
+        running = {}
+        running_per_group = {}
+
+        # Not using the executor as a context manager since that waits for the
+        # running tasks on exit, which would hang on Ctrl-C
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                for name in list(pending):
+                    _, dependencies, group, _ = self._tasks[name]
+                    failed = [d for d in dependencies
+                        if d in results and results[d].error is not None]
+                    if failed:
+                        pending.remove(name)
+                        results[name] = TaskResult(None, DependencyFailed(
+                            'Skipped since %s failed' % ', '.join(failed)))
+                        continue
+
+                    if any(d not in results for d in dependencies):
+                        continue
+
+                    concurrency, _ = self._group_limits.get(group, (None, None))
+                    if concurrency and running_per_group.get(group, 0) >= concurrency:
+                        continue
+
+                    pending.remove(name)
+                    running_per_group[group] = running_per_group.get(group, 0) + 1
+                    running[executor.submit(self._run_task, name)] = name
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    group = self._tasks[name][2]
+                    running_per_group[group] -= 1
+                    results[name] = future.result()
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        executor.shutdown()
+        return results
+
+
+    def _run_task(self, name):
+        func, _, group, rate_limited = self._tasks[name]
+        _, bucket = self._group_limits.get(group, (None, None))
+        if bucket and rate_limited:
+            bucket.acquire()
+
+        try:
+            return TaskResult(func(), None)
+        except Exception as error: # pylint: disable=broad-except
+            if self.log_errors:
+                log_error('%s failed: %s' % (name, error))
+            return TaskResult(None, error)
+
+
+def run_steps(steps, max_workers=10):
+    '''
+    Run the steps of a single operation, with independent steps running
+    concurrently.
+
+    `steps` is a dict of name -> (func, dependencies), in an order where
+    dependencies come before the steps that need them. Each func is called
+    with the results of its dependencies as keyword arguments.
+
+    Returns a dict of name -> result. If any step fails the error is raised
+    after the steps already running have finished.
+    '''
+    values = {}
+    scheduler = Scheduler(max_workers, log_errors=False)
+    for name, (func, dependencies) in steps.items():
+        def run_step(name=name, func=func, dependencies=dependencies):
+            values[name] = func(**{dependency: values[dependency] for dependency in dependencies})
+            return values[name]
+        scheduler.add(name, run_step, dependencies)
+
+    results = scheduler.run()
+    for name in steps:
+        error = results[name].error
+        if error is not None and not isinstance(error, DependencyFailed):
+            raise error
+
+    return values
@@ -0,0 +1,205 @@
+import binascii
+import functools
+import json
+import os
+import shlex
+import subprocess
+
+import paramiko
+
+from .config import build_provider_from_config
+from .exceptions import UserError
+from .providers.base import has_public_ip
+from .roles import compile_roles
+from .scheduler import Scheduler
+from .ssh import (connect_to_node, generate_ed25519_key, get_file_checksum,
+    get_recorded_host_keys, ssh_run_command, upload_file)
+from .utils import log_error
+
+
+def run_script(config, script, role=None, target=None, max_workers=10):
+    '''
+    Run a local script on existing minions in parallel over ssh.
+
+    The minions are found by listing the nodes in every provider and region
+    the roles are configured for, limited to the nodes created from `role`
+    and the minions matching the salt `target`, if given.
+
+    The minions don't keep the ssh key they were created with, thus a new
+    temporary key is authorized through salt for the run. The connections are
+    rejected if the node doesn't present the host key recorded when it was
+    created, or one of the host keys read through salt if none was recorded.
+
+    Returns a dict of minion id -> TaskResult with the script output.
+    '''
+    hosts = find_hosts(config, role, target)
+    if not hosts:
+        raise UserError('No minions matched')
+
+    ssh_key = generate_ed25519_key()
+    key_comment = 'hart-run-script-%s' % binascii.hexlify(os.urandom(4)).decode('utf-8')
+    host_keys = {}
+    scheduler = Scheduler(max_workers)
+    try:
+        for username, minion_ids in group_by_username(hosts).items():
+            host_keys.update(authorize_ssh_key(minion_ids, username, ssh_key, key_comment))
+
+        for minion_id, (provider, public_ip) in sorted(hosts.items()):
+            # Prefer the host key recorded when the node was created, to detect
+            # if it has changed since
+            node_host_keys = get_recorded_host_keys(minion_id) or host_keys.get(minion_id, [])
+            scheduler.add(minion_id, functools.partial(run_script_on_host, minion_id,
+                public_ip, provider.username, ssh_key, node_host_keys, script))
+        results = scheduler.run()
+    finally:
+        for username, minion_ids in group_by_username(hosts).items():
+            revoke_ssh_key(minion_ids, username, key_comment)
+
+    failed = [minion_id for minion_id, result in results.items() if result.error is not None]
+    if failed:
+        log_error('Script failed on %s' % ', '.join(failed))
+
+    print('Ran script on %d of %d minions' % (len(results) - len(failed), len(results)))
+    return results
+
+
+def find_hosts(config, role=None, target=None):
+    '''
+    Return a dict of minion id -> (provider, public ip) for the matching minions.
+
+    The nodes are listed in every provider and region the roles are configured
+    for. When only a target is given, the configured providers that no role
+    uses are listed too, to find the minions created without a role, and it's
+    an error if any of the minions matching the target isn't found.
+    '''
+    index = compile_roles(config)
+    locations = set()
+    for compiled_role in index.targets(role):
+        if compiled_role.region is not None:
+            locations.add((compiled_role.provider, compiled_role.region))
+
+    if role is None and target is not None:
+        role_providers = {provider_alias for provider_alias, _ in locations}
+        for provider_alias in config.get('providers', {}):
+            if provider_alias not in role_providers:
+                # Lists the nodes in all regions, except for EC2 which uses the
+                # default region of boto
+                locations.add((provider_alias, None))
+
+    hosts = {}
+    for provider_alias, region in sorted(locations):
+        provider = build_provider_from_config(provider_alias, config, region=region)
+        for listed_node in provider.list_nodes():
+            if role is not None and listed_node.role != role:
+                continue
+            if not has_public_ip(listed_node.node):
+                continue
+            hosts[listed_node.minion_id] = (provider, listed_node.node.public_ips[0])
+
+    if target is not None:
+        # Minions that don't respond are included with an error message
+        matched = {minion_id for minion_id, response
+            in run_salt(['--compound', target, 'test.ping']).items() if response is True}
+        hosts = {minion_id: host for minion_id, host in hosts.items() if minion_id in matched}
+
+        # With a role the target also matches minions outside of it, which are
+        # left out on purpose
+        missing = matched - set(hosts)
+        if role is None and missing:
+            raise UserError('No node with a public IP was found in the configured providers for '
+                '%s' % ', '.join(sorted(missing)))
+
+    return hosts
+
+
+def group_by_username(hosts):
+    usernames = {}
+    for minion_id, (provider, _) in hosts.items():
+        usernames.setdefault(provider.username, []).append(minion_id)
+    return usernames
+
+
+def authorize_ssh_key(minion_ids, username, ssh_key, key_comment):
+    '''
+    Add the public key to the authorized keys of the minions through salt.
+
+    Returns a dict of minion id -> list of host keys for the minions that
+    responded.
+    '''
+    authorized_keys_path = '%s/.ssh/authorized_keys' % get_home_directory(username)
+    public_key = '%s %s %s' % (ssh_key.get_name(), ssh_key.get_base64(), key_comment)
+    command = ' && '.join([
+        'install -d -m 700 -o {user} -g {user} {ssh_dir}',
+        'echo {public_key} >> {path}',
+        'chown {user}: {path}',
+        'cat /etc/ssh/ssh_host_*_key.pub',
+    ]).format(
+        user=shlex.quote(username),
+        ssh_dir=shlex.quote(os.path.dirname(authorized_keys_path)),
+        public_key=shlex.quote(public_key),
+        path=shlex.quote(authorized_keys_path),
+    )
+
+    host_keys = {}
+    for minion_id, output in run_salt(['--list', ','.join(minion_ids), 'cmd.run', command]).items():
+        host_keys[minion_id] = parse_host_keys(output)
+    return host_keys
+
+
+def revoke_ssh_key(minion_ids, username, key_comment):
+    authorized_keys_path = '%s/.ssh/authorized_keys' % get_home_directory(username)
+    try:
+        run_salt(['--list', ','.join(minion_ids), 'cmd.run',
+            'sed -i /%s/d %s' % (key_comment, shlex.quote(authorized_keys_path))])
+    except ValueError as error:
+        log_error('Failed to remove the temp ssh key from the minions: %s' % error)
+
+
+def parse_host_keys(output):
+    '''Parse the host keys from lines in the format of the .pub files.'''
+    host_keys = []
+    for line in output.splitlines():
+        # Parse the line as a known_hosts entry to let paramiko handle the key types
+        try:
+            entry = paramiko.hostkeys.HostKeyEntry.from_line('host %s' % line)
+        except paramiko.hostkeys.InvalidHostKey:
+            # Not a key, like an error message if the minion failed to run the command
+            continue
+        if entry is not None and entry.key is not None:
+            host_keys.append(entry.key)
+    return host_keys
+
+
+def run_script_on_host(minion_id, public_ip, username, ssh_key, host_keys, script):
+    if not host_keys:
+        raise ValueError('No host keys found through salt, not connecting')
+
+    client = connect_to_node(public_ip, ssh_key, username, host_keys)
+    try:
+        # Name the script by content to let the upload be skipped if the node
+        # already has it
+        remote_script_path = 'hart-script-%s' % get_file_checksum(script)[:12]
+        upload_file(client, script, remote_script_path, mode=0o700)
+        command = './%s' % remote_script_path
+        if username != 'root':
+            command = 'sudo ' + command
+        return ssh_run_command(client, command, timeout=None,
+            output_prefix='[%s] ' % minion_id)
+    finally:
+        client.close()
+
+
+def run_salt(arguments):
+    '''Run a salt command on the master, returning the output for each minion.'''
+    # salt exits with an error if any of the minions didn't respond, which is
+    # included in the output like the other responses
+    result = subprocess.run(['salt', '--out=json', '--static'] + arguments,
+        stdout=subprocess.PIPE, check=False)
+    try:
+        return json.loads(result.stdout.decode('utf-8'))
+    except ValueError:
+        raise ValueError('salt failed with exit code %d' % result.returncode)
+
+
+def get_home_directory(username):
+    return '/root' if username == 'root' else '/home/%s' % username
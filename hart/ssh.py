@@ -1,16 +1,76 @@
 import base64
+import collections
 import contextlib
+import fcntl
+import functools
 import hashlib
+import io
+import json
 import os
+import shlex
 import time
 import select
 import socket
+import tempfile
+import threading
 
 import paramiko
-from paramiko.ssh_exception import SSHException
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from paramiko.ssh_exception import BadHostKeyException, SSHException
 
+from .exceptions import UserError
 from .utils import log_error
 
+# Each write is split into packets by paramiko, larger chunks just means fewer
+# calls into it
+UPLOAD_CHUNK_SIZE = 2**20
+UPLOAD_WINDOW_SIZE = 16*2**20
+
+# The key exchange is CPU heavy, thus limit how many connections can be set up
+# at the same time when connecting to many nodes in parallel
+MAX_CONCURRENT_HANDSHAKES = 8
+# Keep the connections from being dropped by firewalls and NAT while idle, like
+# while waiting for cloud-init to finish
+KEEPALIVE_INTERVAL = 30
+
+_handshake_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_HANDSHAKES)
+
+# The status file written by the cloud-init templates, and how often to poll it
+INIT_STATUS_PATH = '/run/hart/status'
+INIT_STATUS_POLL_INTERVAL = 2
+
+# The host keys of the nodes, recorded by minion id when the canary has been
+# verified. In the known_hosts format used by ssh. Updates are serialized
+# between the threads in this process with the lock, and between processes
+# with a flock on a lock file next to it.
+KNOWN_HOSTS_PATH = '~/.hart/known_hosts'
+_known_hosts_lock = threading.Lock()
+
+# The algorithms to offer when connecting to nodes, in order of preference.
+# Curve25519 and Ed25519 are the cheapest to compute for the handshake, and the
+# GCM ciphers don't need a separate MAC. These can be overridden in the [ssh]
+# table in the config.
+DEFAULT_SSH_ALGORITHMS = {
+    'kex': ('curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256',
+        'diffie-hellman-group14-sha256'),
+    'ciphers': ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com', 'aes128-ctr',
+        'aes256-ctr'),
+    'macs': ('hmac-sha2-256-etm@openssh.com', 'hmac-sha2-256', 'hmac-sha2-512'),
+    'host_key_types': ('ssh-ed25519', 'ecdsa-sha2-nistp256', 'rsa-sha2-512',
+        'rsa-sha2-256'),
+}
+
+# Maps the config keys to the attributes of paramiko's SecurityOptions
+SECURITY_OPTION_ATTRIBUTES = {
+    'kex': 'kex',
+    'ciphers': 'ciphers',
+    'macs': 'digests',
+    'host_key_types': 'key_types',
+}
+
+_ssh_algorithms = dict(DEFAULT_SSH_ALGORITHMS)
+
 
 class IgnorePolicy(paramiko.MissingHostKeyPolicy):
     def missing_host_key(self, client, hostname, key):
@@ -25,12 +85,26 @@ class IgnorePolicy(paramiko.MissingHostKeyPolicy):
         )
 
 
-def ssh_run_command(client, command, timeout=3, log_stdout=True):
+class UnknownHostKeyPolicy(paramiko.MissingHostKeyPolicy):
+    def missing_host_key(self, client, hostname, key):
+        raise ValueError('%s presented an unknown %s host key' % (hostname, key.get_name()))
+
+
+def ssh_run_command(client, command, timeout=3, log_stdout=True, output_prefix=None):
+    '''
+    Run a command and return its stdout, logging the output as it comes in.
+
+    :param output_prefix: Prefix every line of output with this, to tell apart
+        the output from several nodes running commands at the same time. The
+        output is then logged a line at a time instead of as it arrives.
+    '''
     captured_stdout = []
     session = client.get_transport().open_session()
     session.exec_command(command)
     chunksize = 1024
     start_time = time.time()
+    stdout_log = PrefixedLog(print, output_prefix)
+    stderr_log = PrefixedLog(log_error, output_prefix)
     while True:
         (reads_ready, _, _) = select.select([session], [], [], 1)
         if timeout and time.time() - start_time > timeout:
@@ -46,17 +120,20 @@ def ssh_run_command(client, command, timeout=3, log_stdout=True):
                 got_data = True
                 captured_stdout.append(chunk)
                 if log_stdout:
-                    print(chunk, end='')
+                    stdout_log.write(chunk)
 
         if session.recv_stderr_ready():
             chunk = reads_ready[0].recv_stderr(chunksize).decode('utf-8')
             if chunk:
                 got_data = True
-                log_error(chunk, end='')
+                stderr_log.write(chunk)
 
         if not got_data:
             break
 
+    stdout_log.flush()
+    stderr_log.flush()
+
     while not session.exit_status_ready():
         if timeout and time.time() - start_time > timeout:
             raise ValueError('Timed out waiting for command %r to return an exit code' % command)
@@ -69,60 +146,439 @@ def ssh_run_command(client, command, timeout=3, log_stdout=True):
     return ''.join(captured_stdout)
 
 
+class PrefixedLog:
+    '''
+    Passes output through to `log`, or a line at a time with the prefix
+    added to each line if a prefix is given.
+    '''
+
+    def __init__(self, log, prefix=None):
+        self.log = log
+        self.prefix = prefix
+        self._partial_line = ''
+
+
+    def write(self, output):
+        if self.prefix is None:
+            self.log(output, end='')
+            return
+
+        lines = (self._partial_line + output).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self.log(self.prefix + line)
+
+
+    def flush(self):
+        if self._partial_line:
+            self.log(self.prefix + self._partial_line)
+            self._partial_line = ''
+
+
 def ssh_run_init_script(client, local_script_path):
-    sftp_client = client.open_sftp()
     # Preserving this on disk as a record of how the node was created
     remote_script_path = '/root/hart-init'
-    with sftp_client.file(remote_script_path, 'wx') as remote_file:
-        with open(local_script_path, 'rb') as local_file:
-            chunk_size = 16*2**10
-            for chunk in iter(lambda: local_file.read(chunk_size), b''):
-                remote_file.write(chunk)
-    sftp_client.chmod(remote_script_path, 0o700)
-    sftp_client.close()
+    upload_file(client, local_script_path, remote_script_path, mode=0o700)
     print('Running custom init script')
     ssh_run_command(client, remote_script_path, timeout=None)
 
 
+def upload_file(client, local_path, remote_path, mode=0o600):
+    '''
+    Upload a file over sftp and verify its checksum on the node.
+
+    The file is skipped if the node already has the same content at the remote
+    path, and an upload that was interrupted is resumed from where it stopped
+    if the partial content matches the start of the file. The file is written
+    to a temporary path first and renamed in place when complete, thus the
+    remote path is never left with partial content.
+
+    An existing remote file with different content is never replaced, a
+    ValueError is raised instead.
+    '''
+    checksum = get_file_checksum(local_path)
+    remote_checksum = get_remote_checksum(client, remote_path)
+    if remote_checksum == checksum:
+        print('%s is already uploaded' % remote_path)
+        return
+
+    if remote_checksum is not None:
+        raise ValueError('%s already exists on the node with different content' % remote_path)
+
+    partial_path = remote_path + '.part'
+    start_time = time.time()
+    # A larger window than the default lets more writes be in flight at once
+    sftp_client = paramiko.SFTPClient.from_transport(client.get_transport(),
+        window_size=UPLOAD_WINDOW_SIZE)
+    try:
+        try:
+            offset = sftp_client.stat(partial_path).st_size
+        except FileNotFoundError:
+            offset = 0
+
+        with open(local_path, 'rb') as local_file:
+            if offset and (offset > os.fstat(local_file.fileno()).st_size
+                    or get_remote_checksum(client, partial_path, offset)
+                        != get_prefix_checksum(local_file, offset)):
+                print('Restarting upload of %s, the partial upload is from a different file' % (
+                    remote_path))
+                offset = 0
+            if offset:
+                print('Resuming upload of %s at %d bytes' % (remote_path, offset))
+            local_file.seek(offset)
+
+            with sftp_client.file(partial_path, 'r+b' if offset else 'wb') as remote_file:
+                remote_file.seek(offset)
+                # Don't wait for each write to be acknowledged before sending the
+                # next, the errors are raised when the file is closed
+                remote_file.set_pipelined(True)
+                for chunk in iter(lambda: local_file.read(UPLOAD_CHUNK_SIZE), b''):
+                    remote_file.write(chunk)
+
+        if get_remote_checksum(client, partial_path) != checksum:
+            sftp_client.remove(partial_path)
+            raise ValueError('Checksum mismatch after uploading %s' % remote_path)
+
+        sftp_client.chmod(partial_path, mode)
+        # Unlike posix_rename, a plain sftp rename fails if the target exists,
+        # in case something created it during the upload
+        try:
+            sftp_client.rename(partial_path, remote_path)
+        except IOError as error:
+            raise ValueError('Failed to move %s in place: %s' % (remote_path, error))
+    finally:
+        sftp_client.close()
+
+    log_action('upload', start_time)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_file_checksum(path, size, mtime): # pylint: disable=unused-argument
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_checksum(path):
+    '''
+    Get the sha256 of a local file. The checksum is cached as long as the file
+    is unchanged, to only read the file once when uploading it to many nodes.
+    '''
+    stat = os.stat(path)
+    return _get_file_checksum(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def get_prefix_checksum(fh, size):
+    '''Get the sha256 of the first `size` bytes of an open file.'''
+    digest = hashlib.sha256()
+    fh.seek(0)
+    remaining = size
+    while remaining:
+        chunk = fh.read(min(remaining, UPLOAD_CHUNK_SIZE))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def get_remote_checksum(client, remote_path, size=None):
+    '''
+    Get the sha256 of a file on the node, or None if it doesn't exist. If size
+    is given, only the first `size` bytes of the file are included.
+    '''
+    quoted_path = shlex.quote(remote_path)
+    if size is None:
+        command = 'sha256sum %s' % quoted_path
+    else:
+        command = 'head --bytes=%d %s | sha256sum' % (size, quoted_path)
+    output = ssh_run_command(client,
+        'if [ -f %s ]; then %s; fi' % (quoted_path, command),
+        timeout=60, log_stdout=False)
+    return output.split()[0] if output.strip() else None
+
+
 @contextlib.contextmanager
-def get_verified_ssh_client(ip, ssh_key, canary, username='root'):
+def get_verified_ssh_client(ip, ssh_key, canary, username='root', minion_id=None):
+    '''
+    Connect to a new node and verify the canary. The connection is kept alive
+    for as long as the context is open, and is closed when it exits.
+
+    If the minion id is given, the host key of the node is recorded once the
+    canary is verified, to verify later connections to the node against.
+    '''
     client = connect_to_node(ip, ssh_key, username)
     print('Connected')
 
-    # We might not be connected to the right box yet, but we should help seed
-    # the random pool as early as possible in the boot sequence. There's nothing
-    # sensitive here as we'll disconnect if the canary fails in the next step
-    # and the minion will be destroyed. Doing this in addition to seeding over
-    # cloud-init since the contents of cloud-init is rarely safe from someone
-    # that manages to compromise the server.
-    print('Seeding random pool')
-    seed_client_random_pool(client)
-
-    # Verify the ssh canary as the first thing to not run any potentially
-    # dangerous operations on an untrusted box
-    wait_for_verified_ssh_canary(client, canary, should_sudo=username != 'root')
-    print('Verified connection')
     try:
+        # We might not be connected to the right box yet, but we should help seed
+        # the random pool as early as possible in the boot sequence. There's nothing
+        # sensitive here as we'll disconnect if the canary fails in the next step
+        # and the minion will be destroyed. Doing this in addition to seeding over
+        # cloud-init since the contents of cloud-init is rarely safe from someone
+        # that manages to compromise the server.
+        print('Seeding random pool')
+        seed_client_random_pool(client)
+
+        # Verify the ssh canary as the first thing to not run any potentially
+        # dangerous operations on an untrusted box
+        wait_for_verified_ssh_canary(client, canary, should_sudo=username != 'root')
+        print('Verified connection')
+        if minion_id is not None:
+            record_host_key(minion_id, client.get_transport().get_remote_server_key())
         yield client
-    except:
+    finally:
         client.close()
+
+
+def record_host_key(minion_id, host_key, path=KNOWN_HOSTS_PATH):
+    '''Record the verified host key for a node, replacing any earlier keys.'''
+    with lock_known_hosts(path):
+        host_keys = load_known_hosts(path)
+        if minion_id in host_keys:
+            del host_keys[minion_id]
+        host_keys.add(minion_id, host_key.get_name(), host_key)
+        save_known_hosts(host_keys, path)
+
+
+def get_recorded_host_keys(minion_id, path=KNOWN_HOSTS_PATH):
+    '''Return the list of recorded host keys for a node, empty if there are none.'''
+    # The file is replaced atomically when saved, thus no lock is needed to read it
+    node_keys = load_known_hosts(path).lookup(minion_id)
+    return list(node_keys.values()) if node_keys else []
+
+
+def forget_host_keys(minion_id, path=KNOWN_HOSTS_PATH):
+    with lock_known_hosts(path):
+        host_keys = load_known_hosts(path)
+        if minion_id in host_keys:
+            del host_keys[minion_id]
+            save_known_hosts(host_keys, path)
+
+
+@contextlib.contextmanager
+def lock_known_hosts(path):
+    '''
+    Hold an exclusive lock on the known hosts file, for other threads and other
+    hart processes. The lock is taken on a separate file since the known hosts
+    file itself is replaced when it's saved.
+    '''
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _known_hosts_lock, open(path + '.lock', 'a') as lock_file:
+        # Released when the file is closed
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def load_known_hosts(path):
+    host_keys = paramiko.HostKeys()
+    try:
+        host_keys.load(os.path.expanduser(path))
+    except FileNotFoundError:
+        pass
+    return host_keys
+
+
+def save_known_hosts(host_keys, path):
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a unique temp file in the same directory first, to never leave
+    # a partially written file and to be able to rename it in place
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+        prefix='.%s-' % os.path.basename(path))
+    os.close(fd)
+    try:
+        host_keys.save(temp_path)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
         raise
 
 
+def configure_ssh_algorithms(**algorithms):
+    '''Override the preferred algorithms, with the same keys as DEFAULT_SSH_ALGORITHMS.'''
+    for option, preferred in algorithms.items():
+        if option not in DEFAULT_SSH_ALGORITHMS:
+            raise UserError('Unknown ssh option %r, must be one of %s' % (
+                option, ', '.join(sorted(DEFAULT_SSH_ALGORITHMS))))
+        # A single string would otherwise be split into characters
+        if not isinstance(preferred, (list, tuple)):
+            raise UserError('The ssh option %r must be a list of algorithms, got %r' % (
+                option, preferred))
+        _ssh_algorithms[option] = tuple(preferred)
+
+
+def build_transport(sock, **kwargs):
+    '''Transport factory for paramiko, applying the algorithm preferences.'''
+    transport = paramiko.Transport(sock, **kwargs)
+    security_options = transport.get_security_options()
+    for option, attribute in SECURITY_OPTION_ATTRIBUTES.items():
+        try:
+            setattr(security_options, attribute, _ssh_algorithms[option])
+        except ValueError as error:
+            transport.close()
+            raise UserError('Invalid ssh %s %s: %s' % (option, _ssh_algorithms[option], error))
+    return transport
+
+
+def generate_ed25519_key():
+    '''Generate an Ed25519 key, which paramiko can't do by itself.'''
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    private_bytes = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption(),
+    )
+    return paramiko.Ed25519Key(file_obj=io.StringIO(private_bytes.decode('utf-8')))
+
+
+class KeyPool:
+    '''
+    Keeps up to `size` ssh keys ready, generated in a background thread, to
+    keep key generation off the critical path when creating nodes.
+    '''
+
+    def __init__(self, generate, size):
+        self.size = size
+        self._generate = generate
+        self._keys = collections.deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    def get(self):
+        '''Get a ready key, or generate one now if the pool is empty.'''
+        with self._lock:
+            key = self._keys.popleft() if self._keys else None
+            self._start_refill()
+        if key is None:
+            key = self._generate()
+        return key
+
+
+    def fill(self):
+        '''Start filling the pool in the background.'''
+        with self._lock:
+            self._start_refill()
+
+
+    def _start_refill(self):
+        if self._thread is None and len(self._keys) < self.size:
+            self._thread = threading.Thread(target=self._refill, daemon=True, name='key-pool')
+            self._thread.start()
+
+
+    def _refill(self):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._keys) >= self.size:
+                        self._thread = None
+                        return
+                key = self._generate()
+                with self._lock:
+                    self._keys.append(key)
+        except Exception as error: # pylint: disable=broad-except
+            # Keys are generated on demand while the pool is empty, and the
+            # next get tries to refill it again
+            log_error('Failed to generate a key for the key pool: %s' % error)
+        finally:
+            with self._lock:
+                # Let the next get start a new refill, unless one has already
+                # been started after this one stopped
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+
+def wait_for_init_status(client, timeout, check_cloud_init=True):
+    '''
+    Poll the status file written by the init script until it's done, printing
+    each step as it starts. Raises a ValueError as soon as the script fails.
+
+    :param check_cloud_init: Also fail if cloud-init has finished without the
+        init script completing, like if the user data couldn't be parsed.
+    '''
+    command = 'cat %s 2>/dev/null; echo ---; cat /run/cloud-init/result.json 2>/dev/null; true' % (
+        INIT_STATUS_PATH)
+    start_time = time.time()
+    reported_lines = 0
+    while time.time() - start_time < timeout:
+        output = ssh_run_command(client, command, timeout=30, log_stdout=False)
+        status, _, cloud_init_result = output.partition('---\n')
+        lines = status.splitlines()
+        for line in lines[reported_lines:]:
+            kind, _, detail = line.partition(' ')
+            if kind == 'step':
+                print('Init step: %s' % detail)
+            elif kind == 'failed':
+                raise ValueError('Init script failed: %s' % detail)
+            elif kind == 'done':
+                log_action('init', start_time)
+                return
+        reported_lines = len(lines)
+
+        if check_cloud_init and cloud_init_result.strip():
+            errors = json.loads(cloud_init_result)['v1']['errors']
+            raise ValueError('cloud-init finished without completing the init script%s' % (
+                ': %s' % ', '.join(errors) if errors else ''))
+
+        time.sleep(INIT_STATUS_POLL_INTERVAL)
+
+    raise ValueError('Timed out waiting for the init script to finish')
+
+
+def stream_command_output(client, command):
+    '''
+    Print the output of the command in a background thread as it arrives.
+    Returns the channel, close it to stop.
+    '''
+    channel = client.get_transport().open_session()
+    channel.exec_command(command)
+
+    def stream():
+        try:
+            for line in channel.makefile('r'):
+                print(line, end='')
+        except (OSError, SSHException):
+            # The channel was closed
+            pass
+
+    threading.Thread(target=stream, daemon=True, name='log-stream').start()
+    return channel
+
+
 def log_action(action, start_time):
     print('action=%s time=%.2fs' % (action, time.time() - start_time))
 
 
-def connect_to_node(ip, client_ssh_key, username):
+def connect_to_node(ip, client_ssh_key, username, host_keys=None):
+    '''
+    :param host_keys: List of the host keys the node is known to have. If given,
+        the connection is rejected if the node doesn't have one of them.
+    '''
     client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(IgnorePolicy())
+    if host_keys is None:
+        client.set_missing_host_key_policy(IgnorePolicy())
+    else:
+        for host_key in host_keys:
+            client.get_host_keys().add(ip, host_key.get_name(), host_key)
+        client.set_missing_host_key_policy(UnknownHostKeyPolicy())
     timeout = 120
     start_time = time.time()
     while time.time() - start_time < timeout:
         try:
-            client.connect(ip, username=username, pkey=client_ssh_key, timeout=3)
+            with _handshake_semaphore:
+                client.connect(ip, username=username, pkey=client_ssh_key, timeout=3,
+                    transport_factory=build_transport)
+            client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
             log_action('connect', start_time)
             break
+        except BadHostKeyException:
+            # Not a node we trust, don't retry
+            raise
         except (socket.error, SSHException) as error:
             print('Could not connect yet, waiting (%s)' % error)
             time.sleep(2)
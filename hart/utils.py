@@ -1,5 +1,6 @@
 import base64
 import datetime
+import functools
 import os
 import sys
 from collections import namedtuple
@@ -12,6 +13,19 @@ from .exceptions import UserError
 
 HartNode = namedtuple('HartNode', 'minion_id public_ip node provider ssh_key ssh_canary node_extra')
 
+# Set from the cli with --verbose
+_verbose = False
+
+
+def set_verbose(verbose):
+    global _verbose # pylint: disable=global-statement
+    _verbose = verbose
+
+
+def is_verbose():
+    return _verbose
+
+
 class TerminalColors:
     WARNING = '\033[33m'
     FAIL = '\033[91m'
@@ -23,9 +37,29 @@ def create_token():
 
 
 def get_cloud_init_template(template_name='minion.sh'):
+    # The environment caches the compiled templates, including the ones
+    # included from them, thus each template is only compiled once
+    return get_cloud_init_environment().get_template(template_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cloud_init_environment():
     template_directory = os.path.join(os.path.dirname(__file__), 'cloud-init')
-    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(template_directory))
-    return environment.get_template(template_name)
+    bytecode_cache = None
+    # Optionally cache the compiled templates on disk too, to skip compiling
+    # them on startup
+    cache_directory = os.environ.get('HART_TEMPLATE_CACHE_DIR')
+    if cache_directory:
+        os.makedirs(cache_directory, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_directory)
+
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_directory),
+        bytecode_cache=bytecode_cache,
+        # The templates are shipped with the package and doesn't change while
+        # running, skip checking them for changes on every render
+        auto_reload=False,
+    )
 
 
 def build_ssh_key_name(minion_id):
@@ -6,9 +6,14 @@ import re
 from setuptools import setup, find_packages
 
 install_requires = [
-    'apache-libcloud>=2.6.1',
+    # Private driver methods are used for batch creates on DigitalOcean and GCE,
+    # which might change in a new major version
+    'apache-libcloud>=3.0,<4',
+    'cryptography',
     'jinja2',
-    'paramiko',
+    # 3.2 added the transport factory used to set the algorithm preferences,
+    # and 3.3 the AES-GCM ciphers preferred by default
+    'paramiko>=3.3',
     'pyyaml',
     'toml',
     'ifaddr',
@@ -1,5 +1,6 @@
 import tempfile
 import textwrap
+from unittest import mock
 
 from hart.providers import DOProvider
 from hart.config import build_provider_from_config, build_provider_from_file
@@ -23,3 +24,13 @@ def test_build_provider_from_config():
         },
     })
     assert isinstance(provider, DOProvider)
+
+
+def test_build_provider_with_ssh_key_pool():
+    with mock.patch.object(DOProvider, 'configure_ssh_key_pool') as configure_ssh_key_pool:
+        build_provider_from_config('do', {
+            'providers': {
+                'do': {'token': 'foo', 'ssh_key_pool_size': 3},
+            },
+        })
+    configure_ssh_key_pool.assert_called_once_with(3)
@@ -0,0 +1,41 @@
+import json
+import types
+from unittest import mock
+
+import pytest
+
+from hart.providers.digitalocean import DOProvider
+
+
+def test_create_nodes_single_request():
+    provider = DOProvider('foo')
+    driver = mock.Mock()
+    driver.connection.request.return_value.object = {
+        'droplets': [{'name': '2.app'}, {'name': '1.app'}],
+    }
+    driver._to_node.side_effect = lambda droplet: types.SimpleNamespace(name=droplet['name'])
+    provider.driver = driver
+    auth_key = mock.Mock(pubkey='ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIOMqqnkVzrm0SdG6UOoqKLsabgH5C9okWi0dh2l9GKJl')
+
+    with mock.patch.object(DOProvider, 'get_image', return_value=mock.Mock(id=1)), \
+            mock.patch.object(DOProvider, 'get_size', return_value=types.SimpleNamespace(name='s-1vcpu-1gb')), \
+            mock.patch.object(DOProvider, 'get_location', return_value=mock.Mock(id='sfo3')):
+        nodes = provider.create_nodes(['1.app', '2.app'], 'sfo3', 'bookworm', auth_key,
+            'cloud-init', False, ['hart-role:app'])
+
+    assert driver.connection.request.call_count == 1
+    payload = json.loads(driver.connection.request.call_args[1]['data'])
+    assert payload['names'] == ['1.app', '2.app']
+    assert payload['tags'] == ['hart-role:app']
+    assert [node.name for node, _ in nodes] == ['1.app', '2.app']
+
+
+@pytest.mark.parametrize('tags,expected', [
+    (None, ['hart-role:app']),
+    (['web'], ['web', 'hart-role:app']),
+])
+def test_add_role_marker(tags, expected):
+    arguments = {'tags': tags}
+    DOProvider.add_role_marker(arguments, 'app')
+
+    assert arguments['tags'] == expected
@@ -0,0 +1,140 @@
+import base64
+import datetime
+import gzip
+import os
+from unittest import mock
+
+import botocore.exceptions
+import pytest
+
+from hart.exceptions import UserError
+from hart.providers.ec2 import EC2Provider
+
+
+def build_provider():
+    provider = EC2Provider('foo', 'bar', region='us-east-1')
+    provider._ec2 = mock.Mock()
+    provider._ec2.describe_subnets.return_value = {
+        'Subnets': [{'SubnetId': 'subnet-1', 'VpcId': 'vpc-1'}],
+    }
+    provider._ec2.describe_images.return_value = {
+        'Images': [{'Name': 'debian-12-amd64', 'ImageId': 'ami-1', 'RootDeviceName': '/dev/xvda'}],
+    }
+    provider._ec2.create_security_group.return_value = {'GroupId': 'sg-1'}
+    provider._ec2.describe_security_groups.return_value = {
+        'SecurityGroups': [{'GroupId': 'sg-default'}],
+    }
+    return provider
+
+
+def test_create_nodes_single_call():
+    provider = build_provider()
+    provider.ec2.run_instances.return_value = {
+        'Instances': [{
+            'InstanceId': 'i-%d' % i,
+            'State': {'Name': 'pending'},
+            'PrivateIpAddress': '10.0.0.%d' % i,
+            'LaunchTime': datetime.datetime.utcnow(),
+        } for i in range(3)],
+    }
+
+    with mock.patch('hart.providers.ec2.get_host_public_ips', return_value=['1.2.3.4/32']):
+        nodes = provider.create_nodes(['1.app', '2.app', '3.app'], 'us-east-1', 'bookworm',
+            'key', 'cloud-init', False, {'hart-role': 'app'}, zone='us-east-1a')
+
+    assert provider.ec2.run_instances.call_count == 1
+    assert provider.ec2.run_instances.call_args[1]['ClientToken']
+    assert provider.ec2.run_instances.call_args[1]['MaxCount'] == 3
+    assert provider.ec2.create_security_group.call_count == 1
+    assert [node.name for node, _ in nodes] == ['1.app', '2.app', '3.app']
+    assert [c[1]['Resources'] for c in provider.ec2.create_tags.call_args_list] == [
+        ['i-0'], ['i-1'], ['i-2']]
+
+    # The shared security group should only be deleted when the last node is done with it
+    for node, extra in nodes:
+        provider.post_connect(mock.Mock(node=node, node_extra=extra))
+    assert provider.ec2.modify_instance_attribute.call_count == 3
+    provider.ec2.delete_security_group.assert_called_once_with(GroupId='sg-1')
+
+
+def test_create_node_shares_temp_security_group():
+    provider = build_provider()
+    provider.ec2.run_instances.side_effect = lambda **kwargs: {
+        'Instances': [{
+            'InstanceId': 'i-%d' % provider.ec2.run_instances.call_count,
+            'State': {'Name': 'pending'},
+            'PrivateIpAddress': '10.0.0.1',
+            'LaunchTime': datetime.datetime.utcnow(),
+        }],
+    }
+
+    with mock.patch('hart.providers.ec2.get_host_public_ips', return_value=['1.2.3.4/32']):
+        first = provider.create_node('1.app', 'us-east-1', 'bookworm', 'key', 'cloud-init',
+            False, {}, zone='us-east-1a')
+        second = provider.create_node('2.app', 'us-east-1', 'bookworm', 'key', 'cloud-init',
+            False, {}, zone='us-east-1a')
+
+    # Subnet and group should only be looked up and created once
+    assert provider.ec2.describe_subnets.call_count == 1
+    assert provider.ec2.create_security_group.call_count == 1
+    assert first[1]['groupId'] == second[1]['groupId'] == 'sg-1'
+
+    for node, extra in (first, second):
+        provider.post_connect(mock.Mock(node=node, node_extra=extra))
+    assert provider.ec2.describe_security_groups.call_count == 1
+    provider.ec2.delete_security_group.assert_called_once_with(GroupId='sg-1')
+
+    # A new group is created for the next node since the old one was deleted
+    with mock.patch('hart.providers.ec2.get_host_public_ips', return_value=['1.2.3.4/32']):
+        provider.create_node('3.app', 'us-east-1', 'bookworm', 'key', 'cloud-init',
+            False, {}, zone='us-east-1a')
+    assert provider.ec2.create_security_group.call_count == 2
+
+
+def test_build_user_data_compressed():
+    provider = build_provider()
+    cloud_init = '#!/bin/sh\necho hello\n' * 100
+
+    user_data = provider.build_user_data(cloud_init)
+
+    assert gzip.decompress(user_data).decode('utf-8') == cloud_init
+    assert len(user_data) < len(cloud_init)
+    # The same script should give the same user data
+    assert provider.build_user_data(cloud_init) == user_data
+
+
+def test_build_user_data_reports_bytes(capsys):
+    provider = build_provider()
+    cloud_init = '#!/bin/sh\necho blåbær\n'
+
+    user_data = provider.build_user_data(cloud_init)
+
+    assert capsys.readouterr().out == 'User data is %d bytes (%d uncompressed)\n' % (
+        len(user_data), len(cloud_init) + 2)
+
+
+def test_build_user_data_too_large():
+    provider = build_provider()
+    # Random data doesn't compress
+    cloud_init = '#!/bin/sh\necho %s\n' % base64.b64encode(os.urandom(20*1024)).decode('utf-8')
+
+    with pytest.raises(UserError):
+        provider.build_user_data(cloud_init)
+
+
+def test_retryable_errors():
+    provider = EC2Provider('foo', 'bar', region='us-east-1')
+    throttled = botocore.exceptions.ClientError({'Error': {'Code': 'RequestLimitExceeded'}},
+        'RunInstances')
+    internal_error = botocore.exceptions.ClientError({'Error': {'Code': 'InternalError'}},
+        'RunInstances')
+    connection_error = botocore.exceptions.EndpointConnectionError(endpoint_url='https://ec2')
+    read_timeout = botocore.exceptions.ReadTimeoutError(endpoint_url='https://ec2')
+
+    for error in (throttled, internal_error, connection_error, read_timeout):
+        assert provider.is_retryable_error(error)
+
+    assert provider.is_retryable_create_error(throttled)
+    assert provider.is_retryable_create_error(connection_error)
+    assert not provider.is_retryable_create_error(internal_error)
+    assert not provider.is_retryable_create_error(read_timeout)
@@ -0,0 +1,160 @@
+from unittest import mock
+
+import pytest
+
+from hart.environment import (build_plan, get_changes, get_minion_batches, parse_environment,
+    PlannedNode)
+from hart.exceptions import UserError
+from hart.providers import DOProvider
+from hart.providers.base import ListedNode
+
+
+CONFIG = {
+    'providers': {
+        'do': {'token': 'foo'},
+    },
+    'roles': {
+        'app': {
+            'provider': 'do',
+            'region': 'sfo3',
+            'size': 's-2vcpu-2gb',
+        },
+    },
+}
+
+
+def get_default_arguments(provider, master):
+    return {
+        'tags': [],
+        'debian_codename': 'bookworm',
+    }
+
+
+def test_parse_environment():
+    environment = parse_environment({
+        'roles': {
+            'app': {
+                'count': 3,
+                'size': 's-4vcpu-8gb',
+            },
+        },
+        'limits': {
+            'do': {'concurrency': 2},
+        },
+    })
+
+    assert environment.master is None
+    assert environment.roles[0].role == 'app'
+    assert environment.roles[0].count == 3
+    assert environment.roles[0].overrides == {'size': 's-4vcpu-8gb'}
+    assert environment.limits == {'do': {'concurrency': 2}}
+
+
+def test_parse_environment_invalid_count():
+    with pytest.raises(UserError):
+        parse_environment({'roles': {'app': {'count': -1}}})
+
+
+def test_parse_environment_master_without_provider():
+    with pytest.raises(UserError):
+        parse_environment({'master': {'minion_id': 'salt.example.com'}})
+
+
+def test_build_plan():
+    environment = parse_environment({
+        'master': {
+            'minion_id': 'salt.example.com',
+            'provider': 'do',
+            'region': 'sfo3',
+        },
+        'roles': {
+            'app': {
+                'count': 2,
+                'size': 's-4vcpu-8gb',
+            },
+        },
+    })
+
+    with mock.patch.object(DOProvider, 'list_nodes', return_value=[]):
+        plan = build_plan(environment, CONFIG, get_default_arguments)
+
+    assert [p.kind for p in plan] == ['master', 'minion', 'minion']
+    assert plan[0].minion_id == 'salt.example.com'
+    assert plan[1].minion_id != plan[2].minion_id
+    assert plan[1].arguments['size'] == 's-4vcpu-8gb'
+    assert plan[1].arguments['debian_codename'] == 'bookworm'
+    # The providers should be shared between all nodes in the same region
+    assert isinstance(plan[0].provider, DOProvider)
+    assert plan[0].provider is plan[1].provider is plan[2].provider
+
+
+def test_build_plan_reconciles_existing_nodes():
+    environment = parse_environment({
+        'master': {
+            'minion_id': 'salt.example.com',
+            'provider': 'do',
+            'region': 'sfo3',
+        },
+        'roles': {
+            'app': {'count': 2},
+        },
+    })
+    existing_nodes = [
+        ListedNode('salt.example.com', None, mock.Mock()),
+        ListedNode('1.app', 'app', mock.Mock()),
+        ListedNode('2.app', 'app', mock.Mock()),
+        ListedNode('3.app', 'app', mock.Mock()),
+        ListedNode('1.db', 'db', mock.Mock()),
+    ]
+
+    with mock.patch.object(DOProvider, 'list_nodes', return_value=existing_nodes) as list_nodes:
+        plan = build_plan(environment, CONFIG, get_default_arguments)
+
+    # All the nodes should be listed with a single call
+    assert list_nodes.call_count == 1
+    assert [(p.kind, p.minion_id) for p in get_changes(plan)] == [
+        ('destroy', '3.app'),
+    ]
+    assert get_changes(plan)[0].arguments['node'] is existing_nodes[3].node
+
+
+def test_build_plan_creates_missing_nodes():
+    environment = parse_environment({
+        'roles': {
+            'app': {'count': 3},
+        },
+    })
+    existing_nodes = [
+        ListedNode('1.app', 'app', mock.Mock()),
+    ]
+
+    with mock.patch.object(DOProvider, 'list_nodes', return_value=existing_nodes):
+        plan = build_plan(environment, CONFIG, get_default_arguments)
+
+    changes = get_changes(plan)
+    assert [p.kind for p in changes] == ['minion', 'minion']
+    assert changes[0].arguments['tags'] == ['hart-role:app']
+
+
+def test_get_minion_batches():
+    batch_provider = mock.Mock(batch_minion_id_script='ec2-minion-id.sh', max_batch_size=2)
+    single_provider = mock.Mock(batch_minion_id_script=None)
+    plan = [
+        PlannedNode('minion', '1.app', batch_provider, {'minion_id': '1.app', 'size': 'small'}),
+        PlannedNode('minion', '2.app', batch_provider, {'minion_id': '2.app', 'size': 'small'}),
+        PlannedNode('minion', '3.app', batch_provider, {'minion_id': '3.app', 'size': 'small'}),
+        PlannedNode('minion', '1.db', batch_provider, {'minion_id': '1.db', 'size': 'large'}),
+        PlannedNode('destroy', '4.app', batch_provider, {}),
+        PlannedNode('minion', '1.web', single_provider, {'minion_id': '1.web'}),
+        PlannedNode('minion', '2.web', single_provider, {'minion_id': '2.web'}),
+    ]
+
+    batches = get_minion_batches(plan)
+
+    assert [[p.minion_id for p in batch] for batch in batches] == [
+        ['1.app', '2.app'],
+        ['3.app'],
+        ['1.db'],
+        ['1.web'],
+        ['2.web'],
+    ]
@@ -1,3 +1,4 @@
+from unittest import mock
 from unittest.mock import Mock
 
 import pytest
@@ -48,3 +49,37 @@ def test_get_selected_or_default_subnet_none_matching():
 def test_instance_name_generation():
     minion_id = '01.db.example.com'
     assert gce.name_from_minion_id(minion_id) == 'hart-com-example-db-01-b64faa'
+
+
+def test_wait_for_operations_lists_pending_per_zone():
+    provider = gce.GCEProvider.__new__(gce.GCEProvider)
+    driver = Mock()
+    zone = 'https://www.googleapis.com/compute/v1/projects/foo/zones/europe-north1-a'
+    driver.connection.request.side_effect = [
+        Mock(object={
+            'items': [{'name': 'op-2', 'zone': zone, 'status': 'RUNNING'}],
+            'nextPageToken': 'page-2',
+        }),
+        Mock(object={'items': [{'name': 'op-3', 'zone': zone, 'status': 'DONE'}]}),
+        Mock(object={'items': [{'name': 'op-2', 'zone': zone, 'status': 'DONE'}]}),
+    ]
+    provider.driver = driver
+
+    with mock.patch('hart.providers.gce.time.sleep'):
+        operations = provider.wait_for_operations([
+            {'name': 'op-1', 'zone': zone, 'status': 'DONE'},
+            {'name': 'op-2', 'zone': zone, 'status': 'PENDING'},
+            {'name': 'op-3', 'zone': zone, 'status': 'PENDING'},
+        ])
+
+    assert [op['status'] for op in operations] == ['DONE', 'DONE', 'DONE']
+    calls = driver.connection.request.call_args_list
+    assert [c[0][0] for c in calls] == ['/zones/europe-north1-a/operations'] * 3
+    assert calls[0][1]['params']['filter'] == '(name = "op-2") OR (name = "op-3")'
+    assert calls[1][1]['params']['pageToken'] == 'page-2'
+    assert calls[2][1]['params']['filter'] == '(name = "op-2")'
+
+
+def test_format_operation_error():
+    operation = {'error': {'errors': [{'code': 'QUOTA_EXCEEDED', 'message': 'Quota exceeded'}]}}
+    assert gce.format_operation_error(operation) == 'Quota exceeded'
@@ -0,0 +1,89 @@
+import contextlib
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from hart import keys
+
+
+@pytest.fixture
+def pki_dir(tmp_path):
+    (tmp_path / 'minions').mkdir()
+    (tmp_path / 'minions_pre').mkdir()
+    return tmp_path
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_trust(pki_dir):
+    acceptor = keys.KeyAcceptor(str(pki_dir))
+
+    acceptor.trust('foo', 'pubkey')
+
+    assert (pki_dir / 'minions' / 'foo').read_text() == 'pubkey'
+    assert list(pki_dir.glob('.hart-*')) == []
+    acceptor.forget('foo')
+
+
+def test_trust_accepts_existing_pending_key(pki_dir):
+    (pki_dir / 'minions_pre' / 'foo').write_text('pubkey\n')
+    acceptor = keys.KeyAcceptor(str(pki_dir))
+
+    acceptor.trust('foo', 'pubkey')
+
+    assert not (pki_dir / 'minions_pre' / 'foo').exists()
+    assert (pki_dir / 'minions' / 'foo').read_text() == 'pubkey\n'
+    acceptor.forget('foo')
+
+
+def test_trust_ignores_mismatching_pending_key(pki_dir):
+    (pki_dir / 'minions_pre' / 'foo').write_text('other-pubkey')
+    acceptor = keys.KeyAcceptor(str(pki_dir))
+
+    with mock.patch('hart.keys.log_warning') as log_warning:
+        acceptor.trust('foo', 'pubkey')
+
+    log_warning.assert_called_once()
+    assert (pki_dir / 'minions_pre' / 'foo').exists()
+    assert (pki_dir / 'minions' / 'foo').read_text() == 'pubkey'
+    acceptor.forget('foo')
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_accepts_pending_key_when_it_appears(pki_dir, use_inotify):
+    acceptor = keys.KeyAcceptor(str(pki_dir), poll_interval=0.05)
+    if use_inotify:
+        watch_directory = contextlib.nullcontext()
+    else:
+        watch_directory = mock.patch('hart.keys.watch_directory', return_value=None)
+
+    with watch_directory:
+        acceptor.trust('foo', 'pubkey')
+
+        (pki_dir / 'minions_pre' / 'foo').write_text('pubkey')
+
+        wait_until(lambda: not (pki_dir / 'minions_pre' / 'foo').exists())
+        assert (pki_dir / 'minions' / 'foo').read_text() == 'pubkey'
+
+        acceptor.forget('foo')
+        wait_until(lambda: acceptor._thread is None)
+
+
+def test_watch_directory(tmp_path):
+    inotify_fd = keys.watch_directory(str(tmp_path))
+    if inotify_fd is None:
+        pytest.skip('inotify not available')
+
+    try:
+        assert keys.wait_for_events(inotify_fd, 0) == []
+        (tmp_path / 'foo').write_text('pubkey')
+        assert keys.wait_for_events(inotify_fd, 1) == ['foo']
+    finally:
+        os.close(inotify_fd)
@@ -0,0 +1,27 @@
+from unittest import mock
+
+from hart import master
+
+
+def build_hart_node(private_ips, username='root'):
+    node = mock.Mock(private_ips=private_ips)
+    return mock.Mock(node=node, provider=mock.Mock(username=username))
+
+
+def test_configure_apt_cache_binds_private_ip(capsys):
+    with mock.patch('hart.master.ssh_run_command') as ssh_run_command:
+        master.configure_apt_cache(mock.Mock(), build_hart_node(['10.0.0.2'], 'admin'))
+
+    command = ssh_run_command.call_args[0][1]
+    assert "echo 'BindAddress: localhost 10.0.0.2' | sudo tee /etc/apt-cacher-ng/zz_hart.conf" in (
+        command)
+    assert 'sudo systemctl restart apt-cacher-ng' in command
+    assert 'http://10.0.0.2:3142' in capsys.readouterr().out
+
+
+def test_configure_apt_cache_without_private_ip(capsys):
+    with mock.patch('hart.master.ssh_run_command') as ssh_run_command:
+        master.configure_apt_cache(mock.Mock(), build_hart_node([]))
+
+    ssh_run_command.assert_not_called()
+    assert 'only listens on localhost' in capsys.readouterr().err
@@ -0,0 +1,112 @@
+import contextlib
+import threading
+from unittest import mock
+
+from hart import minions
+
+
+@contextlib.contextmanager
+def temp_ssh_key(events):
+    events.append('key created')
+    yield 'ssh-key', 'auth-key'
+    events.append('key deleted')
+
+
+def build_provider(events):
+    provider = mock.Mock(username='root', batch_minion_id_script=None)
+    provider.create_temp_ssh_key.side_effect = lambda key_name: temp_ssh_key(events)
+    provider.build_user_data.side_effect = lambda cloud_init: cloud_init
+    return provider
+
+
+def test_prepare_nodes():
+    events = []
+    provider = build_provider(events)
+
+    with mock.patch('hart.minions.get_master_pubkey', return_value='master-pubkey'), \
+            mock.patch('hart.minions.find_existing_minions', return_value={}):
+        with contextlib.ExitStack() as stack:
+            cloud_init, ssh_keys = minions.prepare_nodes(stack, ['foo'], provider, 'sfo3',
+                'bookworm', None, {'ssh_canary': 'canary', 'minion_config': 'id: foo'})
+            assert events == ['key created']
+
+    assert 'master-pubkey' in cloud_init
+    assert ssh_keys == ('ssh-key', 'auth-key')
+    provider.prepare_create_node.assert_called_once_with('sfo3', 'bookworm', None)
+    assert events == ['key created', 'key deleted']
+
+
+def test_prepare_nodes_existing_minion():
+    events = []
+    provider = build_provider(events)
+
+    main_thread = threading.current_thread()
+    asked_from = []
+
+    def confirm_overwrite(existing_minions):
+        asked_from.append(threading.current_thread())
+        assert existing_minions == {'foo': ['minions']}
+        return False
+
+    with mock.patch('hart.minions.get_master_pubkey', return_value='master-pubkey'), \
+            mock.patch('hart.minions.find_existing_minions',
+                return_value={'foo': ['minions']}), \
+            mock.patch('hart.minions.confirm_overwrite', side_effect=confirm_overwrite):
+        with contextlib.ExitStack() as stack:
+            prepared = minions.prepare_nodes(stack, ['foo'], provider, 'sfo3',
+                'bookworm', None, {'ssh_canary': 'canary', 'minion_config': 'id: foo'})
+
+    assert prepared is None
+    # Only asked once, from the calling thread
+    assert asked_from == [main_thread]
+    # The key was created in parallel with the check, but should be cleaned up
+    assert events == ['key created', 'key deleted']
+
+
+def test_prepare_nodes_overwrite_skips_lookup():
+    provider = build_provider([])
+
+    with mock.patch('hart.minions.get_master_pubkey', return_value='master-pubkey'), \
+            mock.patch('hart.minions.find_existing_minions') as find_existing_minions:
+        with contextlib.ExitStack() as stack:
+            prepared = minions.prepare_nodes(stack, ['foo'], provider, 'sfo3',
+                'bookworm', None, {'ssh_canary': 'canary', 'minion_config': 'id: foo'},
+                overwrite=True)
+
+    assert prepared is not None
+    find_existing_minions.assert_not_called()
+
+
+def test_find_existing_minions():
+    keys = b'{"minions": ["foo", "bar"], "minions_pre": ["baz"], "minions_rejected": ["foo"]}'
+    with mock.patch('hart.minions.subprocess.check_output', return_value=keys):
+        assert minions.find_existing_minions(['foo', 'baz', 'new']) == {
+            'foo': ['minions', 'minions_rejected'],
+            'baz': ['minions_pre'],
+        }
+
+
+def test_connect_minion_starts_minion_after_trusting_key():
+    events = []
+    provider = build_provider(events)
+    hart_node = mock.Mock(minion_id='foo', provider=provider)
+
+    def ssh_run_command(client, command, **kwargs):
+        events.append(command)
+        return 'minion-pubkey' if command.startswith('cat ') else ''
+
+    with mock.patch('hart.minions.get_verified_ssh_client'), \
+            mock.patch('hart.minions.ssh_run_command', side_effect=ssh_run_command), \
+            mock.patch('hart.minions.trust_minion_key',
+                side_effect=lambda *args: events.append('trust %s %s' % args)), \
+            mock.patch('hart.minions.subprocess.run'), \
+            mock.patch('hart.minions._key_acceptor'):
+        minions.connect_minion(hart_node, None)
+
+    assert events == [
+        'cat /etc/salt/pki/minion/minion.pub',
+        'trust foo minion-pubkey',
+        'service salt-minion start',
+        'salt-call test.ping',
+        'rm /root/.ssh/authorized_keys',
+    ]
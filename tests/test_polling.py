@@ -0,0 +1,83 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from hart.providers.polling import NodePoller
+
+
+def build_node(node_id, public_ips=()):
+    return mock.Mock(id=node_id, public_ips=list(public_ips))
+
+
+def test_node_poller_polls_all_nodes_at_once():
+    calls = []
+    def get_nodes(nodes):
+        calls.append(sorted(node.id for node in nodes))
+        return {node.id: build_node(node.id, ['10.0.0.1']) for node in nodes}
+
+    poller = NodePoller(get_nodes, interval=0.05)
+    barrier = threading.Barrier(3)
+    results = {}
+    def wait(node_id):
+        node = build_node(node_id)
+        barrier.wait()
+        results[node_id] = poller.wait_for(node, lambda n: n.public_ips, timeout=2)
+
+    threads = [threading.Thread(target=wait, args=(node_id,)) for node_id in 'abc']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(results[node_id].public_ips == ['10.0.0.1'] for node_id in 'abc')
+    # Depending on timing the first tick can happen before all waiters are
+    # registered, but never more than one call per tick
+    assert len(calls) <= 2
+    assert calls[-1] == ['a', 'b', 'c']
+
+
+def test_node_poller_waits_for_missing_nodes():
+    responses = [{}, {'a': build_node('a')}, {'a': build_node('a', ['10.0.0.1'])}]
+    poller = NodePoller(lambda nodes: responses.pop(0), interval=0.01)
+
+    node = poller.wait_for(build_node('a'), lambda n: n.public_ips, timeout=2)
+
+    assert node.public_ips == ['10.0.0.1']
+    assert not responses
+
+
+def test_node_poller_timeout():
+    poller = NodePoller(lambda nodes: {}, interval=0.01)
+
+    assert poller.wait_for(build_node('a'), lambda n: n.public_ips, timeout=0.05) is None
+
+
+def test_node_poller_retries_failed_polls():
+    responses = [
+        ValueError('API down'),
+        ValueError('API down'),
+        {'a': build_node('a', ['10.0.0.1'])},
+    ]
+    def get_nodes(nodes):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    poller = NodePoller(get_nodes, interval=0.01)
+
+    with mock.patch('hart.providers.polling.log_warning'):
+        node = poller.wait_for(build_node('a'), lambda n: n.public_ips, timeout=2)
+
+    assert node.public_ips == ['10.0.0.1']
+
+
+def test_node_poller_fails_after_consecutive_failures():
+    def get_nodes(nodes):
+        raise ValueError('API down')
+    poller = NodePoller(get_nodes, interval=0.01, max_failures=2)
+
+    with mock.patch('hart.providers.polling.log_warning') as log_warning, \
+            pytest.raises(ValueError, match='API down'):
+        poller.wait_for(build_node('a'), lambda n: n.public_ips, timeout=2)
+    assert log_warning.call_count == 1
@@ -7,7 +7,12 @@ import pytest
 
 from hart.exceptions import UserError
 from hart.providers import DOProvider, EC2Provider
-from hart.roles import get_minion_arguments_for_role, get_provider_for_role, build_minion_id
+from hart.roles import (
+    build_minion_id,
+    compile_roles,
+    get_minion_arguments_for_role,
+    get_provider_for_role,
+)
 
 
 def test_get_minion_arguments_provider_inheritance(named_tempfile):
@@ -253,6 +258,175 @@ def test_get_provider_from_role(named_tempfile):
     assert isinstance(provider, EC2Provider)
 
 
+def test_hart_provider_takes_precedence_over_role(named_tempfile):
+    named_tempfile.write(textwrap.dedent('''
+        [hart]
+        provider = "do"
+
+        [providers.do]
+        token = "foo"
+
+        [providers.ec2]
+        aws_access_key_id = "foo"
+        aws_secret_access_key = "bar"
+
+        [roles.myrole]
+        provider = "ec2"
+    ''').encode('utf-8'))
+    named_tempfile.close()
+
+    provider = get_provider_for_role(named_tempfile.name, 'myrole', None)
+
+    assert isinstance(provider, DOProvider)
+
+
+def test_compile_roles_only_given_roles():
+    config = {
+        'roles': {
+            'app': {'provider': 'do', 'region': 'sfo3'},
+            'db': {'provider': 'do', 'region': 'sfo3'},
+        },
+    }
+
+    index = compile_roles(config, ['app'])
+
+    assert index.roles == ['app']
+    with pytest.raises(UserError, match="Unknown role 'web', must be one of 'app', 'db'"):
+        compile_roles(config, ['web'])
+
+
+def test_compile_roles_lists_declared_targets():
+    index = compile_roles({
+        'hart': {
+            'provider': 'do',
+        },
+        'roles': {
+            'app': {
+                'size': 's-2vcpu-2gb',
+                'region': 'sfo3',
+                'do': {
+                    'nyc3': {
+                        'size': 's-4vcpu-4gb',
+                    },
+                },
+                'ec2': {
+                    'region': 'eu-west-1',
+                    'size': 't3.medium',
+                },
+            },
+        },
+    })
+
+    targets = [(t.provider, t.region, t.parameters['size']) for t in index.targets()]
+    assert targets == [
+        ('do', 'nyc3', 's-4vcpu-4gb'),
+        ('do', 'sfo3', 's-2vcpu-2gb'),
+        ('ec2', 'eu-west-1', 't3.medium'),
+    ]
+
+
+def test_compile_roles_applies_table_for_default_region():
+    index = compile_roles({
+        'roles': {
+            'app': {
+                'provider': 'do',
+                'do': {
+                    'region': 'sfo3',
+                    'sfo3': {
+                        'size': 's-4vcpu-4gb',
+                    },
+                },
+            },
+        },
+    })
+
+    compiled_role = index.get('app')
+    assert compiled_role.region == 'sfo3'
+    assert compiled_role.parameters['size'] == 's-4vcpu-4gb'
+
+
+def test_compile_roles_does_not_treat_labels_as_region():
+    index = compile_roles({
+        'roles': {
+            'app': {
+                'gce': {
+                    'labels': {
+                        'team': 'web',
+                    },
+                },
+            },
+        },
+    })
+
+    assert [t.region for t in index.targets()] == [None]
+    assert index.get('app', 'gce', 'us-east1').parameters['labels'] == {'team': 'web'}
+
+
+def test_compile_roles_only_compiles_declared_providers():
+    index = compile_roles({
+        'hart': {
+            'size': 'small',
+        },
+        'roles': {
+            'app': {
+                'provider': 'do',
+                'region': 'sfo3',
+            },
+        },
+    })
+
+    assert {key[1] for key in index._compiled_roles} == {'do'}
+    # Other providers are still compiled when asked for
+    compiled_role = index.get('app', 'vultr')
+    assert compiled_role.provider == 'vultr'
+    assert compiled_role.region == 'sfo3'
+    assert compiled_role.parameters['size'] == 'small'
+    with pytest.raises(UserError, match='Unknown provider'):
+        index.get('app', 'nope')
+
+
+def test_compiled_roles_are_immutable():
+    config = {
+        'roles': {
+            'app': {
+                'provider': 'do',
+                'region': 'sfo3',
+                'minion_config': {
+                    'grains': {'foo': 'bar'},
+                },
+            },
+        },
+    }
+    index = compile_roles(config)
+
+    arguments = index.get_minion_arguments('app', DOProvider('foo'))
+    arguments['minion_config']['grains']['foo'] = 'baz'
+
+    with pytest.raises(TypeError):
+        index.get('app').parameters['size'] = 'huge'
+    assert index.get('app').parameters['minion_config']['grains']['foo'] == 'bar'
+    assert config['roles']['app']['provider'] == 'do'
+
+
+def test_compiled_roles_validate():
+    index = compile_roles({
+        'roles': {
+            'good': {
+                'provider': 'do',
+                'region': 'sfo3',
+            },
+            'bad': {
+                'provider': 'do',
+                'region': 'sfo3',
+                'role_naming_scheme': '{nope}.example.com',
+            },
+        },
+    })
+
+    with pytest.raises(UserError, match=r'bad \(do, sfo3\): Invalid minion id template'):
+        index.validate()
+
+
 def is_subdict(subset, superset):
     # Kudos to https://stackoverflow.com/a/57675231/5590192 for this, using this
     # for testing to avoid config values added by hart from bloating the test assertions
@@ -261,3 +435,20 @@ def is_subdict(subset, superset):
 
     # Assume that subset is a plain value if the above doesn't match match
     return subset == superset
+
+
+def test_validate_doesnt_warn_about_role_markers():
+    index = compile_roles({
+        'roles': {
+            'app': {
+                'provider': 'vultr',
+                'region': 'ams',
+                'tags': ['web'],
+            },
+        },
+    })
+
+    with mock.patch('hart.providers.vultr.log_warning') as log_warning:
+        index.validate()
+
+    log_warning.assert_not_called()
@@ -0,0 +1,134 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from hart.scheduler import DependencyFailed, Scheduler, TokenBucket, run_steps
+
+
+def test_scheduler_runs_dependencies_first():
+    order = []
+    scheduler = Scheduler()
+    scheduler.add('master', lambda: order.append('master'))
+    scheduler.add('minion-1', lambda: order.append('minion'), dependencies=['master'])
+    scheduler.add('minion-2', lambda: order.append('minion'), dependencies=['master'])
+
+    results = scheduler.run()
+
+    assert order == ['master', 'minion', 'minion']
+    assert all(result.error is None for result in results.values())
+
+
+def test_scheduler_skips_tasks_with_failed_dependencies():
+    def fail():
+        raise ValueError('Boom')
+
+    scheduler = Scheduler()
+    scheduler.add('master', fail)
+    scheduler.add('minion', lambda: 'created', dependencies=['master'])
+    scheduler.add('unrelated', lambda: 'created')
+
+    results = scheduler.run()
+
+    assert isinstance(results['master'].error, ValueError)
+    assert isinstance(results['minion'].error, DependencyFailed)
+    assert results['unrelated'].value == 'created'
+
+
+def test_scheduler_group_concurrency():
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def task():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    scheduler = Scheduler()
+    scheduler.set_group_limits('do', concurrency=2)
+    for i in range(6):
+        scheduler.add('task-%d' % i, task, group='do')
+
+    scheduler.run()
+
+    assert max_running[0] == 2
+
+
+def test_scheduler_unknown_dependency():
+    scheduler = Scheduler()
+    with pytest.raises(ValueError):
+        scheduler.add('minion', lambda: None, dependencies=['master'])
+
+
+def test_scheduler_rate_limit_skips_unlimited_tasks():
+    scheduler = Scheduler()
+    scheduler.set_group_limits('do', rate=1)
+    for i in range(5):
+        scheduler.add('destroy-%d' % i, lambda: None, group='do', rate_limited=False)
+    scheduler.add('create', lambda: None, group='do')
+
+    start_time = time.monotonic()
+    scheduler.run()
+
+    # Only the create takes a token, the first one is free
+    assert time.monotonic() - start_time < 0.5
+
+
+def test_scheduler_interrupt_doesnt_wait_for_running_tasks():
+    release = threading.Event()
+    started = []
+    scheduler = Scheduler(max_workers=1)
+    scheduler.add('slow', release.wait)
+    scheduler.add('queued', lambda: started.append('queued'))
+
+    try:
+        with mock.patch('hart.scheduler.wait', side_effect=KeyboardInterrupt):
+            start_time = time.monotonic()
+            with pytest.raises(KeyboardInterrupt):
+                scheduler.run()
+            assert time.monotonic() - start_time < 1
+    finally:
+        release.set()
+
+    time.sleep(0.05)
+    assert started == []
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=100, burst=1)
+    start_time = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start_time >= 0.035
+
+
+def test_run_steps_passes_dependency_results():
+    started = threading.Barrier(2, timeout=2)
+    def independent(value):
+        # Both independent steps have to run at the same time to pass the barrier
+        started.wait()
+        return value
+
+    values = run_steps({
+        'a': (lambda: independent(1), ()),
+        'b': (lambda: independent(2), ()),
+        'sum': (lambda a, b: a + b, ('a', 'b')),
+    })
+
+    assert values == {'a': 1, 'b': 2, 'sum': 3}
+
+
+def test_run_steps_raises_first_error():
+    def fail():
+        raise KeyError('missing')
+
+    with pytest.raises(KeyError):
+        run_steps({
+            'a': (fail, ()),
+            'b': (lambda a: a, ('a',)),
+        })
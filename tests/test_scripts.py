@@ -0,0 +1,98 @@
+from unittest import mock
+
+import paramiko
+import pytest
+
+from hart import scripts
+from hart.exceptions import UserError
+from hart.providers.base import ListedNode
+
+
+CONFIG = {
+    'providers': {
+        'do': {'token': 'foo'},
+    },
+    'roles': {
+        'app': {
+            'provider': 'do',
+            'region': 'sfo3',
+        },
+        'db': {
+            'provider': 'do',
+            'region': 'sfo3',
+        },
+    },
+}
+
+
+def listed_node(minion_id, role, public_ips):
+    return ListedNode(minion_id, role, mock.Mock(public_ips=public_ips))
+
+
+def find_hosts(role=None, target=None, salt_output=None, config=CONFIG):
+    provider = mock.Mock(username='root')
+    provider.list_nodes.return_value = [
+        listed_node('1.app', 'app', ['1.1.1.1']),
+        listed_node('2.app', 'app', ['2.2.2.2']),
+        listed_node('3.app', 'app', []),
+        listed_node('1.db', 'db', ['3.3.3.3']),
+    ]
+    with mock.patch('hart.scripts.build_provider_from_config',
+                return_value=provider) as build_provider_from_config, \
+            mock.patch('hart.scripts.run_salt', return_value=salt_output) as run_salt:
+        hosts = scripts.find_hosts(config, role, target)
+    locations = [(c[0][0], c[1]['region']) for c in build_provider_from_config.call_args_list]
+    return {minion_id: public_ip for minion_id, (_, public_ip) in hosts.items()}, run_salt, (
+        locations)
+
+
+def test_find_hosts_by_role():
+    hosts, run_salt, _ = find_hosts(role='app')
+
+    # Nodes without a public IP can't be reached
+    assert hosts == {'1.app': '1.1.1.1', '2.app': '2.2.2.2'}
+    assert not run_salt.called
+
+
+def test_find_hosts_by_target():
+    hosts, _, _ = find_hosts(target='G@roles:app', salt_output={
+        '1.app': True,
+        '2.app': 'Minion did not return. [No response]',
+    })
+
+    assert hosts == {'1.app': '1.1.1.1'}
+
+
+def test_find_hosts_by_target_lists_other_providers():
+    config = dict(CONFIG, providers={
+        'do': {'token': 'foo'},
+        'vultr': {'token': 'bar'},
+    })
+    hosts, _, locations = find_hosts(target='foo', salt_output={'1.db': True}, config=config)
+
+    assert hosts == {'1.db': '3.3.3.3'}
+    assert locations == [('do', 'sfo3'), ('vultr', None)]
+
+
+def test_find_hosts_by_target_not_found():
+    with pytest.raises(UserError, match='found in the configured providers for 3.app, other'):
+        find_hosts(target='foo', salt_output={'1.app': True, '3.app': True, 'other': True})
+
+
+def test_find_hosts_by_role_and_target_ignores_other_minions():
+    hosts, _, _ = find_hosts(role='app', target='foo', salt_output={'1.app': True, '1.db': True})
+
+    assert hosts == {'1.app': '1.1.1.1'}
+
+
+def test_parse_host_keys():
+    host_key = paramiko.ECDSAKey.generate()
+    output = '\n'.join([
+        '%s %s root@app' % (host_key.get_name(), host_key.get_base64()),
+        'cat: /etc/ssh/ssh_host_dsa_key.pub: No such file or directory',
+    ])
+
+    host_keys = scripts.parse_host_keys(output)
+
+    assert [key.get_base64() for key in host_keys] == [host_key.get_base64()]
+    assert scripts.parse_host_keys('Minion did not return. [No response]') == []
@@ -0,0 +1,379 @@
+import hashlib
+import io
+import socket
+import subprocess
+import sys
+import threading
+import time
+from unittest import mock
+
+import paramiko
+import pytest
+
+from hart import ssh
+from hart.exceptions import UserError
+
+
+class FakeRemoteFile(io.BytesIO):
+    def __init__(self, files, path, initial=b''):
+        super().__init__(initial)
+        self.files = files
+        self.path = path
+
+
+    def set_pipelined(self, pipelined):
+        pass
+
+
+    def close(self):
+        self.files[self.path] = self.getvalue()
+        super().close()
+
+
+def build_sftp_client(files):
+    sftp_client = mock.Mock()
+
+    def stat(path):
+        if path not in files:
+            raise FileNotFoundError(path)
+        return mock.Mock(st_size=len(files[path]))
+
+    def open_file(path, mode):
+        return FakeRemoteFile(files, path, files[path] if mode == 'r+b' else b'')
+
+    def rename(source, destination):
+        if destination in files:
+            raise IOError('Failure')
+        files[destination] = files.pop(source)
+
+    sftp_client.stat.side_effect = stat
+    sftp_client.file.side_effect = open_file
+    sftp_client.rename.side_effect = rename
+    sftp_client.remove.side_effect = files.pop
+    return sftp_client
+
+
+def upload(tmpdir, files, content):
+    local_path = tmpdir.join('script')
+    local_path.write_binary(content)
+
+    def get_remote_checksum(client, path, size=None):
+        if path not in files:
+            return None
+        return hashlib.sha256(files[path][:size]).hexdigest()
+
+    sftp_client = build_sftp_client(files)
+    with mock.patch('paramiko.SFTPClient.from_transport', return_value=sftp_client), \
+            mock.patch('hart.ssh.get_remote_checksum', side_effect=get_remote_checksum):
+        ssh.upload_file(mock.Mock(), str(local_path), '/root/hart-init')
+    return sftp_client
+
+
+def test_upload_file(tmpdir):
+    files = {}
+    sftp_client = upload(tmpdir, files, b'foo' * 1000)
+
+    assert files == {'/root/hart-init': b'foo' * 1000}
+    sftp_client.chmod.assert_called_once_with('/root/hart-init.part', 0o600)
+
+
+def test_upload_file_already_uploaded(tmpdir):
+    files = {'/root/hart-init': b'foo'}
+    sftp_client = upload(tmpdir, files, b'foo')
+
+    assert not sftp_client.file.called
+
+
+def test_upload_file_resumes(tmpdir):
+    files = {'/root/hart-init.part': b'foo'}
+    upload(tmpdir, files, b'foobar')
+
+    assert files == {'/root/hart-init': b'foobar'}
+
+
+def test_upload_file_restarts_other_partial_file(tmpdir):
+    # A partial file from a different upload than the local file
+    files = {'/root/hart-init.part': b'bar'}
+    sftp_client = upload(tmpdir, files, b'foobar')
+
+    assert files == {'/root/hart-init': b'foobar'}
+    sftp_client.file.assert_called_once_with('/root/hart-init.part', 'wb')
+
+
+def test_upload_file_doesnt_replace_other_file(tmpdir):
+    files = {'/root/hart-init': b'bar'}
+    with pytest.raises(ValueError):
+        upload(tmpdir, files, b'foo')
+
+    assert files == {'/root/hart-init': b'bar'}
+
+
+def test_upload_file_target_created_during_upload(tmpdir):
+    files = {}
+    sftp_client = build_sftp_client(files)
+    def chmod(path, mode):
+        files['/root/hart-init'] = b'bar'
+
+    sftp_client.chmod.side_effect = chmod
+    local_path = tmpdir.join('script')
+    local_path.write_binary(b'foo')
+
+    with mock.patch('paramiko.SFTPClient.from_transport', return_value=sftp_client), \
+            mock.patch('hart.ssh.get_remote_checksum', side_effect=lambda client, path, size=None:
+                hashlib.sha256(files[path]).hexdigest() if path in files else None):
+        with pytest.raises(ValueError):
+            ssh.upload_file(mock.Mock(), str(local_path), '/root/hart-init')
+
+    assert files['/root/hart-init'] == b'bar'
+
+
+def test_upload_file_checksum_mismatch(tmpdir):
+    files = {}
+    with mock.patch('hart.ssh.get_file_checksum', return_value='other'):
+        with pytest.raises(ValueError):
+            upload(tmpdir, files, b'foobar')
+
+    assert files == {}
+
+
+def test_get_file_checksum_cached(tmpdir):
+    local_path = tmpdir.join('script')
+    local_path.write_binary(b'foo')
+    expected = hashlib.sha256(b'foo').hexdigest()
+
+    with mock.patch('hashlib.sha256', wraps=hashlib.sha256) as sha256:
+        assert ssh.get_file_checksum(str(local_path)) == expected
+        assert ssh.get_file_checksum(str(local_path)) == expected
+
+    assert sha256.call_count == 1
+
+
+def test_prefixed_log():
+    lines = []
+    log = ssh.PrefixedLog(lambda line: lines.append(line), '[foo] ')
+
+    log.write('first\nsec')
+    assert lines == ['[foo] first']
+
+    log.write('ond\nthird')
+    assert lines == ['[foo] first', '[foo] second']
+
+    log.flush()
+    assert lines == ['[foo] first', '[foo] second', '[foo] third']
+
+
+def test_verified_ssh_client_closed_on_failed_canary():
+    client = mock.Mock()
+    with mock.patch('hart.ssh.connect_to_node', return_value=client), \
+            mock.patch('hart.ssh.seed_client_random_pool'), \
+            mock.patch('hart.ssh.wait_for_verified_ssh_canary', side_effect=ValueError):
+        with pytest.raises(ValueError):
+            with ssh.get_verified_ssh_client('1.2.3.4', 'key', 'canary'):
+                pass
+
+    client.close.assert_called_once_with()
+
+
+def test_verified_ssh_client_closed_on_exit():
+    client = mock.Mock()
+    with mock.patch('hart.ssh.connect_to_node', return_value=client), \
+            mock.patch('hart.ssh.seed_client_random_pool'), \
+            mock.patch('hart.ssh.wait_for_verified_ssh_canary'):
+        with ssh.get_verified_ssh_client('1.2.3.4', 'key', 'canary') as verified_client:
+            assert verified_client is client
+            assert not client.close.called
+
+    client.close.assert_called_once_with()
+
+
+def test_generate_ed25519_key():
+    key = ssh.generate_ed25519_key()
+
+    assert key.get_name() == 'ssh-ed25519'
+    # The public key should verify signatures from the private key
+    public_key = paramiko.Ed25519Key(data=key.asbytes())
+    signature = key.sign_ssh_data(b'foo')
+    signature.rewind()
+    assert public_key.verify_ssh_sig(b'foo', signature)
+
+
+def test_build_transport_applies_algorithms():
+    client_socket, server_socket = socket.socketpair()
+    with mock.patch.dict('hart.ssh._ssh_algorithms'):
+        ssh.configure_ssh_algorithms(ciphers=['aes256-ctr'], kex=['curve25519-sha256@libssh.org'])
+        transport = ssh.build_transport(client_socket)
+
+    try:
+        security_options = transport.get_security_options()
+        assert security_options.ciphers == ('aes256-ctr',)
+        assert security_options.kex == ('curve25519-sha256@libssh.org',)
+        assert security_options.key_types == ssh.DEFAULT_SSH_ALGORITHMS['host_key_types']
+    finally:
+        transport.close()
+        server_socket.close()
+
+
+def test_configure_ssh_algorithms_invalid():
+    with mock.patch.dict('hart.ssh._ssh_algorithms'):
+        with pytest.raises(UserError):
+            ssh.configure_ssh_algorithms(cipher=['aes256-ctr'])
+
+        with pytest.raises(UserError):
+            ssh.configure_ssh_algorithms(ciphers='aes256-ctr')
+
+        ssh.configure_ssh_algorithms(ciphers=['rot13'])
+        with pytest.raises(UserError):
+            ssh.build_transport(socket.socketpair()[0])
+
+
+def test_key_pool():
+    generated = []
+    generated_event = threading.Event()
+
+    def generate():
+        generated.append(object())
+        if len(generated) == 2:
+            generated_event.set()
+        return generated[-1]
+
+    pool = ssh.KeyPool(generate, 2)
+    pool.fill()
+    assert generated_event.wait(1)
+
+    # Keys are handed out in the order they were generated
+    assert pool.get() is generated[0]
+    assert pool.get() is generated[1]
+
+
+def test_key_pool_empty():
+    pool = ssh.KeyPool(lambda: 'generated-now', 1)
+
+    # Should generate a key right away instead of waiting for the refill
+    with mock.patch.object(pool, '_start_refill') as start_refill:
+        assert pool.get() == 'generated-now'
+    start_refill.assert_called_once_with()
+
+
+def test_key_pool_generate_fails(capsys):
+    def fill_and_wait(pool):
+        pool.fill()
+        # The thread might already be done
+        thread = pool._thread
+        if thread is not None:
+            thread.join(1)
+
+    pool = ssh.KeyPool(mock.Mock(side_effect=[ValueError('no entropy'), 'key', 'key']), 1)
+    fill_and_wait(pool)
+
+    assert pool._thread is None
+    assert 'no entropy' in capsys.readouterr().err
+
+    # The next refill is started again
+    fill_and_wait(pool)
+    assert pool.get() == 'key'
+
+
+def test_record_host_key(tmpdir):
+    path = str(tmpdir.join('hart', 'known_hosts'))
+    old_key = ssh.generate_ed25519_key()
+    new_key = ssh.generate_ed25519_key()
+
+    assert ssh.get_recorded_host_keys('foo', path) == []
+
+    ssh.record_host_key('foo', old_key, path)
+    ssh.record_host_key('bar', old_key, path)
+    # A new node with the same minion id replaces the old key
+    ssh.record_host_key('foo', new_key, path)
+
+    assert [key.get_base64() for key in ssh.get_recorded_host_keys('foo', path)] == [
+        new_key.get_base64()]
+
+    ssh.forget_host_keys('foo', path)
+    assert ssh.get_recorded_host_keys('foo', path) == []
+    assert len(ssh.get_recorded_host_keys('bar', path)) == 1
+    # Only the file and its lock file are left, without any temp files
+    assert sorted(tmpdir.join('hart').listdir()) == [
+        tmpdir.join('hart', 'known_hosts'), tmpdir.join('hart', 'known_hosts.lock')]
+
+
+def test_known_hosts_locked_between_processes(tmpdir):
+    path = str(tmpdir.join('known_hosts'))
+    script = (
+        'import fcntl, sys, time\n'
+        'with open(sys.argv[1] + ".lock", "a") as fh:\n'
+        '    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)\n'
+        '    print("locked", flush=True)\n'
+        '    time.sleep(0.5)\n'
+    )
+    other_process = subprocess.Popen([sys.executable, '-c', script, path],
+        stdout=subprocess.PIPE)
+    try:
+        assert other_process.stdout.readline() == b'locked\n'
+        start_time = time.time()
+        ssh.record_host_key('foo', ssh.generate_ed25519_key(), path)
+        # Waited for the other process to release the lock
+        assert time.time() - start_time > 0.2
+    finally:
+        other_process.wait()
+        other_process.stdout.close()
+
+
+def test_verified_ssh_client_records_host_key():
+    client = mock.Mock()
+    with mock.patch('hart.ssh.connect_to_node', return_value=client), \
+            mock.patch('hart.ssh.seed_client_random_pool'), \
+            mock.patch('hart.ssh.wait_for_verified_ssh_canary'), \
+            mock.patch('hart.ssh.record_host_key') as record_host_key:
+        with ssh.get_verified_ssh_client('1.2.3.4', 'key', 'canary', minion_id='foo'):
+            pass
+
+    record_host_key.assert_called_once_with('foo',
+        client.get_transport().get_remote_server_key())
+
+
+def wait_for_init_status(outputs, check_cloud_init=True):
+    with mock.patch('hart.ssh.ssh_run_command', side_effect=outputs) as ssh_run_command, \
+            mock.patch('hart.ssh.time.sleep'):
+        ssh.wait_for_init_status(mock.Mock(), 60, check_cloud_init)
+    return ssh_run_command
+
+
+def test_wait_for_init_status():
+    ssh_run_command = wait_for_init_status([
+        '---\n',
+        'step configure\n---\n',
+        'step configure\nstep install-salt\ndone\n---\n',
+    ])
+
+    assert ssh_run_command.call_count == 3
+
+
+def test_wait_for_init_status_failed():
+    with pytest.raises(ValueError) as excinfo:
+        wait_for_init_status([
+            'step configure\n---\n',
+            'step configure\nstep install-salt\nfailed install-salt exited with 100\n---\n',
+            'step configure\nstep install-salt\ndone\n---\n',
+        ])
+
+    assert 'install-salt exited with 100' in str(excinfo.value)
+
+
+def test_wait_for_init_status_cloud_init_failed():
+    cloud_init_result = '{"v1": {"errors": ["user data is invalid"]}}'
+    with pytest.raises(ValueError) as excinfo:
+        wait_for_init_status(['---\n' + cloud_init_result])
+
+    assert 'user data is invalid' in str(excinfo.value)
+
+
+def test_wait_for_init_status_without_cloud_init():
+    # A leftover result from an earlier boot is ignored when the script isn't
+    # run by cloud-init
+    cloud_init_result = '{"v1": {"errors": []}}'
+    ssh_run_command = wait_for_init_status([
+        '---\n' + cloud_init_result,
+        'done\n---\n' + cloud_init_result,
+    ], check_cloud_init=False)
+
+    assert ssh_run_command.call_count == 2
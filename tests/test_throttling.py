@@ -0,0 +1,142 @@
+from unittest import mock
+
+import pytest
+from libcloud.common.exceptions import BaseHTTPError, RateLimitReachedError
+
+from hart.config import build_provider_from_config
+from hart.providers.base import cached_lookup, is_creating_call
+from hart.providers.digitalocean import DOProvider
+from hart.providers.libcloud import get_private_method
+from hart.providers.throttling import ThrottledClient, call_with_retries
+
+
+@pytest.fixture(autouse=True)
+def no_sleep():
+    with mock.patch('hart.providers.throttling.time.sleep'):
+        yield
+
+
+def test_call_with_retries_retries_retryable_errors():
+    func = mock.Mock(side_effect=[ValueError('throttled'), ValueError('throttled'), 'ok'])
+
+    assert call_with_retries(func, lambda e: True, max_retries=2) == 'ok'
+    assert func.call_count == 3
+
+
+def test_call_with_retries_gives_up():
+    func = mock.Mock(side_effect=ValueError('throttled'))
+
+    with pytest.raises(ValueError):
+        call_with_retries(func, lambda e: True, max_retries=2)
+
+    assert func.call_count == 3
+
+
+def test_call_with_retries_doesnt_retry_other_errors():
+    func = mock.Mock(side_effect=KeyError('missing'))
+
+    with pytest.raises(KeyError):
+        call_with_retries(func, lambda e: isinstance(e, ValueError), max_retries=2)
+
+    assert func.call_count == 1
+
+
+def test_throttled_client_wraps_nested_calls():
+    calls = []
+    def call(func, *args, **kwargs):
+        calls.append(func.__name__)
+        return func(*args, **kwargs)
+
+    client = mock.Mock()
+    client.list_nodes.__name__ = 'list_nodes'
+    client.connection.request.__name__ = 'request'
+    client.region = 'sfo3'
+    throttled = ThrottledClient(client, call, nested=('connection',))
+
+    throttled.list_nodes()
+    throttled.connection.request('/v2/droplets')
+
+    assert calls == ['list_nodes', 'request']
+    assert throttled.region == 'sfo3'
+
+
+def test_libcloud_provider_retries_rate_limited_calls():
+    provider = DOProvider('foo', region='sfo3')
+    provider.configure_throttling(requests_per_second=100)
+    sizes = [mock.Mock()]
+    with mock.patch.object(provider.driver._client, 'list_sizes', side_effect=[
+            RateLimitReachedError(), sizes]):
+        assert provider.driver.list_sizes() == sizes
+
+
+def test_libcloud_provider_doesnt_retry_server_errors_for_creates():
+    provider = DOProvider('foo', region='sfo3')
+    provider.configure_throttling(requests_per_second=100)
+    node = mock.Mock()
+
+    def create_node(*args, **kwargs):
+        raise BaseHTTPError(500, 'Internal error')
+    create_node = mock.Mock(side_effect=create_node, __name__='create_node')
+
+    with mock.patch.object(provider.driver._client, 'create_node', create_node):
+        with pytest.raises(BaseHTTPError):
+            provider.driver.create_node('foo')
+    assert create_node.call_count == 1
+
+    create_node = mock.Mock(side_effect=[RateLimitReachedError(), node], __name__='create_node')
+    with mock.patch.object(provider.driver._client, 'create_node', create_node):
+        assert provider.driver.create_node('foo') is node
+
+
+@pytest.mark.parametrize('name,kwargs,expected', [
+    ('list_nodes', {}, False),
+    ('create_node', {}, True),
+    ('run_instances', {}, True),
+    ('run_instances', {'ClientToken': 'token'}, False),
+    ('post', {}, True),
+    ('request', {}, False),
+    ('request', {'method': 'POST'}, True),
+])
+def test_is_creating_call(name, kwargs, expected):
+    assert is_creating_call(mock.Mock(__name__=name), kwargs) == expected
+
+
+def test_build_provider_from_config_throttling():
+    config = {
+        'providers': {
+            'do': {
+                'token': 'foo',
+                'requests_per_second': 0.5,
+                'max_retries': 2,
+            },
+        },
+    }
+
+    provider = build_provider_from_config('do', config, region='sfo3')
+
+    assert provider.requests_per_second == 0.5
+    assert provider.max_retries == 2
+    assert provider.request_burst == DOProvider.request_burst
+
+
+def test_cached_lookup_caches_per_instance():
+    lookup = mock.Mock(side_effect=lambda self, name: name.upper(), __name__='lookup')
+
+    class Provider:
+        get = cached_lookup(lookup)
+
+    first, second = Provider(), Provider()
+    assert first.get('foo') == 'FOO'
+    assert first.get('foo') == 'FOO'
+    assert lookup.call_count == 1
+    assert second.get('foo') == 'FOO'
+    assert lookup.call_count == 2
+
+
+def test_get_private_method_fails_clearly():
+    provider = DOProvider('foo', region='sfo3')
+    assert get_private_method(provider.driver, '_to_node') == provider.driver._client._to_node
+
+    with mock.patch.object(type(provider.driver._client), '_to_node', None):
+        with pytest.raises(ValueError, match='DigitalOcean_v2_NodeDriver._to_node'):
+            get_private_method(provider.driver, '_to_node')
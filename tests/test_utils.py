@@ -1,4 +1,7 @@
 import argparse
+import subprocess
+
+import pytest
 
 from hart import utils as uut
 
@@ -27,3 +30,118 @@ def test_remove_argument_from_parser_multiple_flags():
 
     # This shouldn't crash
     parser.add_argument('-f', '--foo', help='Something')
+
+
+def test_get_cloud_init_template_is_cached():
+    assert uut.get_cloud_init_template() is uut.get_cloud_init_template()
+    assert uut.get_cloud_init_template('master.sh') is not uut.get_cloud_init_template()
+
+
+def render_minion_script(**kwargs):
+    context = {
+        'random_seed': 'seed',
+        'minion_config': 'id: foo',
+        'master_pubkey': 'pubkey',
+        'ssh_canary': 'canary',
+        'wait_for_apt': True,
+        'permit_root_ssh': True,
+    }
+    context.update(kwargs)
+    return uut.get_cloud_init_template().render(**context)
+
+
+def test_cloud_init_installs_salt_with_security_updates():
+    script = render_minion_script()
+
+    assert script.count('apt-get update') == 1
+    assert 'gpg' not in script.replace('keyring-2023.gpg', '')
+    assert 'apt_get_install salt-minion' in script
+    assert 'security_updates=$(apt-get --simulate upgrade' in script
+    assert 'hart-security-updates' not in script
+
+
+def test_cloud_init_defer_security_updates():
+    script = render_minion_script(defer_security_updates=True)
+
+    assert 'security_updates=\n' in script
+    assert 'systemd-run' in script.split('trap ')[0]
+    assert '--unit=hart-security-updates' in script
+
+
+def test_cloud_init_apt_proxy():
+    script = render_minion_script(apt_proxy='http://salt.example.com:3142')
+
+    assert 'Acquire::http::Proxy "http://salt.example.com:3142";' in script
+    # Only rewritten for apt-cacher-ng when asked to
+    assert 'salt_repo=https://packages.broadcom.com/' in script
+
+
+def test_cloud_init_apt_proxy_https():
+    script = render_minion_script(apt_proxy='http://salt.example.com:3142',
+        apt_proxy_https=True)
+
+    assert 'salt_repo=http://HTTPS///packages.broadcom.com/' in script
+    assert 'salt_repo=https://' not in script
+
+
+def test_cloud_init_without_apt_proxy():
+    script = render_minion_script()
+
+    assert 'Acquire::http::Proxy' not in script
+    assert 'salt_repo=https://packages.broadcom.com/' in script
+
+
+def test_cloud_init_master_apt_cache():
+    script = uut.get_cloud_init_template('master.sh').render(apt_cache=True)
+
+    assert 'apt_get_install salt-master salt-minion python3 python3-venv apt-cacher-ng' in script
+    # Not listening on the public IP before hart has bound it to the private one
+    assert script.index("'BindAddress: localhost'") < script.index('apt_get_install salt-master')
+
+
+def run_policy_rc_d_section(tmpdir, install_exit_code):
+    '''
+    Run the part of the minion script installing salt-minion against a fake
+    root in tmpdir, with apt-get replaced by a function.
+    '''
+    script = render_minion_script()
+    section = script[script.index('step install-salt'):script.index('# Salt versions')]
+    for path in ('/usr/sbin/', '/run/hart/'):
+        tmpdir.join(path[1:]).ensure(dir=True)
+        section = section.replace(path, str(tmpdir.join(path[1:])) + '/')
+    return subprocess.run(['sh', '-c', """
+        set -eu -o noclobber
+        step () { :; }
+        hart_exit () { echo "exit $1" > %s; }
+        trap 'hart_exit $?' EXIT
+        apt_get_install () {
+            # salt-minion must not be started by the package
+            if %s salt-minion; then
+                return 1
+            fi
+            return %d
+        }
+        %s
+    """ % (tmpdir.join('status'), tmpdir.join('usr/sbin/policy-rc.d'), install_exit_code,
+        section)])
+
+
+@pytest.mark.parametrize('install_exit_code', [0, 3])
+def test_cloud_init_policy_rc_d_restored(tmpdir, install_exit_code):
+    existing_policy = tmpdir.join('usr/sbin/policy-rc.d')
+    existing_policy.ensure().write('#!/bin/sh\nexit 101\n')
+
+    result = run_policy_rc_d_section(tmpdir, install_exit_code)
+
+    assert result.returncode == install_exit_code
+    assert tmpdir.join('status').read() == 'exit %d\n' % install_exit_code
+    assert existing_policy.read() == '#!/bin/sh\nexit 101\n'
+    assert not tmpdir.join('run/hart/policy-rc.d').exists()
+
+
+@pytest.mark.parametrize('install_exit_code', [0, 3])
+def test_cloud_init_policy_rc_d_removed(tmpdir, install_exit_code):
+    result = run_policy_rc_d_section(tmpdir, install_exit_code)
+
+    assert result.returncode == install_exit_code
+    assert not tmpdir.join('usr/sbin/policy-rc.d').exists()
@@ -1,3 +1,4 @@
+import time
 from unittest import mock
 
 import pytest
@@ -38,6 +39,20 @@ def test_add_private_ip_to_device():
     ], check=True)
 
 
+def test_add_private_ip_over_ssh():
+    client = mock.Mock()
+    with mock.patch('hart.providers.vultr.ssh_run_command') as ssh_run_command, \
+            mock.patch('hart.providers.vultr.subprocess') as mock_subprocess:
+        vultr.add_private_ip_over_ssh(client, 'ens7', '10.0.0.1', '255.255.240.0')
+
+    assert not mock_subprocess.run.called
+    command = ssh_run_command.call_args[0][1]
+    assert ssh_run_command.call_args[0][0] is client
+    assert ("printf '%s\\n' 'auto ens7' 'iface ens7 inet static' 'address 10.0.0.1' "
+        "'netmask 255.255.240.0' 'mtu 1450' > /etc/network/interfaces.d/20-hart-private-ip") in command
+    assert command.endswith('ifup ens7')
+
+
 def test_add_reserved_ip_to_device():
     with mock.patch('hart.providers.vultr.subprocess') as mock_subprocess:
         vultr.add_ip_to_device('minion', 'reserved', 'ens3:0', '1.2.3.4', '255.255.255.0')
@@ -53,3 +68,133 @@ def test_add_reserved_ip_to_device():
 def test_get_device_from_missing_interface():
     with pytest.raises(ValueError):
         vultr.get_device_and_next_label_from_interfaces({}, '1.2.3.4')
+
+
+def test_startup_scripts_are_shared_by_content():
+    provider = vultr.VultrProvider('foo')
+    driver = mock.Mock()
+    driver.connection.post.return_value = mock.Mock(status=200, object={'SCRIPTID': 42})
+    provider.driver = driver
+
+    first = provider.acquire_startup_script('#!/bin/sh\necho hi', node_count=2)
+    second = provider.acquire_startup_script('#!/bin/sh\necho hi')
+
+    assert first == second == 42
+    assert driver.connection.post.call_count == 1
+
+    for _ in range(3):
+        provider.delete_startup_script({'script_id': 42})
+
+    # Only deleted once, after the last node released it
+    assert [c[0][0] for c in driver.connection.post.call_args_list] == [
+        '/v1/startupscript/create',
+        '/v1/startupscript/destroy',
+    ]
+
+
+def test_ssh_key_deleted_after_nodes_boot():
+    provider = vultr.VultrProvider('foo')
+    driver = mock.Mock()
+    provider.driver = driver
+    key = mock.Mock(id='key-1')
+    pending_node = mock.Mock(id='1', state=vultr.NodeState.PENDING)
+    running_node = mock.Mock(id='1', state=vultr.NodeState.RUNNING)
+
+    with mock.patch.object(vultr.VultrProvider, 'node_poller') as node_poller:
+        node_poller.wait_for.return_value = running_node
+        provider.destroy_ssh_key_after_boot(key, [pending_node])
+
+    node_poller.wait_for.assert_called_once_with(pending_node, vultr.is_booted, 180)
+    driver.delete_key_pair.assert_called_once_with(key)
+
+
+def test_ssh_key_deleted_when_polling_fails(capsys):
+    provider = vultr.VultrProvider('foo')
+    driver = mock.Mock()
+    provider.driver = driver
+    key = mock.Mock(id='key-1')
+    pending_node = mock.Mock(id='1', state=vultr.NodeState.PENDING)
+
+    with mock.patch.object(vultr.VultrProvider, 'node_poller') as node_poller:
+        node_poller.wait_for.side_effect = ValueError('API down')
+        provider.destroy_ssh_key_after_boot(key, [pending_node])
+
+    driver.delete_key_pair.assert_called_once_with(key)
+    assert 'API down' in capsys.readouterr().err
+
+
+def test_wait_for_ssh_key_cleanup_reports_failed_keys(capsys):
+    provider = vultr.VultrProvider('foo')
+    driver = mock.Mock()
+    driver.delete_key_pair.side_effect = ValueError('API down')
+    provider.driver = driver
+    key = mock.Mock(id='key-1')
+    key.name = 'hart-minion'
+
+    provider.destroy_remote_ssh_key(key)
+
+    assert not vultr.wait_for_ssh_key_cleanup()
+    assert not vultr._key_cleanup_threads
+    error = capsys.readouterr().err
+    assert 'hart-minion' in error
+    assert 'key-1' in error
+    assert 'API down' in error
+
+    # Errors are only reported once
+    assert vultr.wait_for_ssh_key_cleanup()
+
+
+def test_wait_for_ssh_key_cleanup_joins_threads():
+    provider = vultr.VultrProvider('foo')
+    driver = mock.Mock()
+    provider.driver = driver
+    key = mock.Mock(id='key-1')
+
+    with mock.patch.object(vultr.VultrProvider, 'destroy_ssh_key_after_boot',
+            side_effect=lambda remote_key, nodes: time.sleep(0.05)) as destroy:
+        provider.destroy_remote_ssh_key(key)
+        assert vultr.wait_for_ssh_key_cleanup()
+
+    destroy.assert_called_once_with(key, [])
+    assert not vultr._key_cleanup_threads
+
+
+@pytest.mark.parametrize('debian_codename,log_command,check_cloud_init', [
+    ('buster', 'tail -f -n +1 /var/log/firstboot.log', False),
+    ('bookworm', 'tail -f -n +1 /var/log/cloud-init-output.log', True),
+])
+def test_wait_for_init_script(debian_codename, log_command, check_cloud_init):
+    provider = vultr.VultrProvider('foo')
+    client = mock.Mock()
+
+    with mock.patch.object(provider, 'delete_startup_script'), \
+            mock.patch.object(provider, 'follow_init_script') as follow_init_script:
+        provider.wait_for_init_script(client, {'debian_codename': debian_codename})
+
+    follow_init_script.assert_called_once_with(client, log_command,
+        check_cloud_init=check_cloud_init)
+
+
+def test_add_role_marker():
+    arguments = {}
+    vultr.VultrProvider.add_role_marker(arguments, 'app')
+
+    assert arguments['tags'] == ['hart-role:app']
+
+
+def test_add_role_marker_with_tag_warns():
+    arguments = {'tags': ['web']}
+    with mock.patch('hart.providers.vultr.log_warning') as log_warning:
+        vultr.VultrProvider.add_role_marker(arguments, 'app')
+
+    assert arguments['tags'] == ['web']
+    log_warning.assert_called_once()
+
+
+def test_add_role_marker_with_tag_without_warning():
+    arguments = {'tags': ['web']}
+    with mock.patch('hart.providers.vultr.log_warning') as log_warning:
+        vultr.VultrProvider.add_role_marker(arguments, 'app', warn=False)
+
+    assert arguments['tags'] == ['web']
+    log_warning.assert_not_called()
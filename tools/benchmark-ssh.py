@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+Measure the cost of generating the temporary ssh keys and of the ssh handshake
+with each key type, with paramiko's default algorithm preferences and with the
+ones hart uses.
+
+The handshakes are done against a paramiko server on localhost, thus this only
+measures the CPU cost on the saltmaster, not network latency.
+
+Usage: ./tools/benchmark-ssh.py [iterations]
+'''
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hart.ssh import build_transport, generate_ed25519_key # pylint: disable=wrong-import-position
+
+
+KEY_GENERATORS = {
+    'rsa-2048': lambda: paramiko.RSAKey.generate(2048),
+    'ecdsa-p256': paramiko.ECDSAKey.generate,
+    'ed25519': generate_ed25519_key,
+}
+
+
+class AcceptAllServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+def main():
+    args = get_args()
+    host_key = generate_ed25519_key()
+    port = start_server(host_key)
+
+    print('Key generation (%d iterations)' % args.iterations)
+    keys = {}
+    for key_type, generate in KEY_GENERATORS.items():
+        duration, keys[key_type] = measure(generate, args.iterations)
+        print('  %-12s %7.2fms' % (key_type, duration*1000))
+
+    print('Handshake and authentication (%d iterations)' % args.iterations)
+    for key_type, key in keys.items():
+        for name, transport_factory in (('default', None), ('hart', build_transport)):
+            duration, _ = measure(lambda: connect(port, key, transport_factory), args.iterations)
+            print('  %-12s %-8s %7.2fms' % (key_type, name, duration*1000))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('iterations', type=int, nargs='?', default=20)
+    return parser.parse_args()
+
+
+def measure(func, iterations):
+    '''Return the average duration of calling func, and the last result.'''
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        result = func()
+    return (time.perf_counter() - start_time) / iterations, result
+
+
+def connect(port, key, transport_factory):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect('127.0.0.1', port=port, username='root', pkey=key, allow_agent=False,
+        look_for_keys=False, transport_factory=transport_factory)
+    client.close()
+
+
+def start_server(host_key):
+    server_socket = socket.socket()
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(10)
+
+    def serve():
+        while True:
+            connection, _ = server_socket.accept()
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(host_key)
+            transport.start_server(server=AcceptAllServer())
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return server_socket.getsockname()[1]
+
+
+if __name__ == '__main__':
+    main()